@@ -2,12 +2,11 @@ from __future__ import division
 
 import onmt
 import onmt.Markdown
+import onmt.Checkpoints
 import torch
 import argparse
-import math
-import numpy
 
-parser = argparse.ArgumentParser(description='translate.py')
+parser = argparse.ArgumentParser(description='average_models.py')
 onmt.Markdown.add_md_help_argument(parser)
 
 parser.add_argument('-models', required=True,
@@ -15,105 +14,124 @@ parser.add_argument('-models', required=True,
 parser.add_argument('-output', default='model.averaged',
                     help="""Path to output averaged model""")
 parser.add_argument('-gpu', type=int, default=-1,
-                    help="Device to run on")
-                    
-def build_model(model_opt, model_state, generator_state, dicts, nSets, cuda):
-    encoder = onmt.Models.Encoder(model_opt, dicts['src'])
-    decoder = onmt.Models.Decoder(model_opt, dicts['tgt'], nSets)
-    this_model = onmt.Models.NMTModel(encoder, decoder)
-    generator = onmt.Models.Generator(model_opt, dicts['tgt'])
-    
-    # load weights
-    this_model.load_state_dict(model_state)
-    generator.load_state_dict(generator_state)
-    
-    # ship to cuda if necessary
-    if cuda:
-        this_model.cuda()
-        generator.cuda()
+                    help="""Kept for compatibility, the averaging runs on
+                    the CPU.""")
+parser.add_argument('-weights', default="",
+                    help="""Weights of the models, split by | (default: the
+                    plain average).""")
+parser.add_argument('-ema', type=float, default=0,
+                    help="""Exponential moving average with this decay over
+                    the models in the given order (oldest first), instead of
+                    the plain average.""")
+
+
+def _isFloat(tensor):
+    return tensor.type() in ('torch.FloatTensor', 'torch.DoubleTensor',
+                             'torch.HalfTensor')
+
+
+def _load(fileName):
+    """
+    Load a checkpoint on the CPU, memory mapped when torch supports it
+    so that only the tensors being summed are read.
+    """
+    try:
+        return torch.load(fileName, map_location=lambda storage, loc: storage,
+                          mmap=True)
+    except TypeError:
+        return torch.load(fileName, map_location=lambda storage, loc: storage)
+
+
+def modelWeights(opt, n_models):
+    "The (normalized) weight of every model."
+    if opt.ema > 0:
+        # avg = decay * avg + (1 - decay) * model, starting from the first
+        weights = [opt.ema ** (n_models - 1)]
+        weights += [(1 - opt.ema) * opt.ema ** (n_models - 1 - i)
+                    for i in range(1, n_models)]
+    elif opt.weights:
+        weights = [float(w) for w in opt.weights.split("|")]
+        assert len(weights) == n_models, \
+            "-weights needs one weight for each model"
     else:
-        this_model.cpu()
-        generator.cpu()
+        weights = [1.0] * n_models
+
+    total = sum(weights)
+    return [w / total for w in weights]
+
+
+class StateSum(object):
+    """
+    Weighted running sum of state dicts with the same keys and shapes, in
+    float64. Other entries (integer buffers) are taken from the first one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.sums = None
+
+    def add(self, state, weight):
+        if self.sums is None:
+            self.types = dict((k, v.type()) for k, v in state.items())
+            self.sums = dict()
+            for k, v in state.items():
+                self.sums[k] = v.double() * weight if _isFloat(v) else v.clone()
+            return
+
+        if set(state) != set(self.sums):
+            raise ValueError("The %s state dicts have different keys" % self.name)
+        for k, v in state.items():
+            if v.size() != self.sums[k].size():
+                raise ValueError("Size mismatch for %s %s: %s vs %s"
+                                 % (self.name, k, v.size(), self.sums[k].size()))
+            if _isFloat(v):
+                self.sums[k].add_(weight, v.double())
+
+    def result(self):
+        return dict((k, v.type(self.types[k])) for k, v in self.sums.items())
+
 
-    this_model.generator = generator
-    
-    return this_model
-                    
 def main():
-    
+
     opt = parser.parse_args()
-    
-    opt.cuda = opt.gpu > -1
-    if opt.cuda:
-        torch.cuda.set_device(opt.gpu)
-    
+
     # opt.model should be a string of models, split by |
-        
+
     models = opt.models.split("|")
-    #~ print(models)
     n_models = len(models)
-    
-    print("Loading main model from %s ..." % models[0])
-    checkpoint = torch.load(models[0], map_location=lambda storage, loc: storage)
-    
-    if 'optim' in checkpoint:
-        del checkpoint['optim']
-    
-    main_checkpoint = checkpoint
-    model_opt = checkpoint['opt']
-    dicts = checkpoint['dicts']
-    nSets = dicts['nSets']
-    
-    main_model = build_model(model_opt, main_checkpoint['model'], main_checkpoint['generator'], dicts, nSets, opt.cuda)
-    
-    for i in range(1, len(models)):
-        
-        model = models[i]
-        print("Loading model from %s ..." % models[i])
-        checkpoint = torch.load(model, map_location=lambda storage, loc: storage    )
-
-        model_opt = checkpoint['opt']
-
-        # delete optim information to save GPU memory
-        if 'optim' in checkpoint:
-            del checkpoint['optim']
-        
-        current_model = build_model(model_opt, checkpoint['model'], checkpoint['generator'], dicts, nSets, opt.cuda)
-        
-        # Sum the parameter values 
-        for (main_param, param) in zip(main_model.parameters(), current_model.parameters()):
-            main_param.data.add_(param.data)
-    
-    # Normalizing
-    for main_param in main_model.parameters():
-        main_param.data.div_(n_models) 
-    
+    weights = modelWeights(opt, n_models)
+
+    # only the running sums and the checkpoint being read are in memory
+    modelSum = StateSum('model')
+    generatorSum = StateSum('generator')
+
+    for i, model in enumerate(models):
+        print("Loading model from %s (weight %.4f) ..." % (model, weights[i]))
+        if i == 0:
+            checkpoint = onmt.Checkpoints.loadCheckpoint(
+                model, map_location=lambda storage, loc: storage)
+            model_opt = checkpoint['opt']
+            dicts = checkpoint['dicts']
+        else:
+            checkpoint = _load(model)
+
+        modelSum.add(checkpoint['model'], weights[i])
+        generatorSum.add(checkpoint['generator'], weights[i])
+        del checkpoint
+
     # Saving
-    model_state_dict = main_model.state_dict()
-    
-    model_state_dict = {k: v for k, v in model_state_dict.items()
-                            if 'generator' not in k}
-    generator_state_dict = main_model.generator.state_dict()
-                            
-    
     save_checkpoint = {
-            'model': model_state_dict,
-            'generator': generator_state_dict,
+            'model': modelSum.result(),
+            'generator': generatorSum.result(),
             'dicts': dicts,
             'opt': model_opt,
             'epoch': -1,
             'iteration' : -1,
-            'batchOrder' : None
+            'scheduler' : None
     }
-    
+
     torch.save(save_checkpoint, opt.output)
-    
-                    
 
-    
-    
+
 if __name__ == "__main__":
     main()
-    
-    
-                                     
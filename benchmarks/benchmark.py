@@ -0,0 +1,553 @@
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import multiprocessing
+import subprocess
+import timeit
+
+# the benchmarks run from a checkout, without installing onmt
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import torch
+from torch.autograd import Variable
+
+import onmt
+import onmt.Markdown
+import onmt.modules
+
+parser = argparse.ArgumentParser(description='benchmark.py')
+onmt.Markdown.add_md_help_argument(parser)
+
+parser.add_argument('-output', default="",
+                    help="""Write the results (and the environment) to this
+                    JSON file""")
+parser.add_argument('-compare', default="",
+                    help="""JSON file of a previous run: report the change of
+                    every benchmark and exit with status 1 if one of them
+                    regressed""")
+parser.add_argument('-threshold', type=float, default=0.1,
+                    help="""Relative slowdown of the median time flagged as a
+                    regression by -compare""")
+parser.add_argument('-only', default="",
+                    help="""Comma separated names of the benchmarks to run
+                    (default: all)""")
+parser.add_argument('-list', action='store_true',
+                    help="List the benchmarks and exit")
+
+parser.add_argument('-repeat', type=int, default=5,
+                    help="Number of timed runs of every benchmark")
+parser.add_argument('-min_time', type=float, default=0.2,
+                    help="""Minimum duration of a timed run in seconds, the
+                    number of calls per run is chosen to reach it""")
+parser.add_argument('-threads', type=int, default=0,
+                    help="Number of torch CPU threads (default: torch's own)")
+parser.add_argument('-seed', type=int, default=3435,
+                    help="Random seed of the synthetic models and data")
+
+# **Synthetic model and data**
+parser.add_argument('-vocab_size', type=int, default=10000,
+                    help="Size of the source and target vocabularies")
+parser.add_argument('-layers', type=int, default=2,
+                    help="Number of layers of the encoder and decoder")
+parser.add_argument('-rnn_size', type=int, default=256,
+                    help="Size of the LSTM hidden states")
+parser.add_argument('-word_vec_size', type=int, default=256,
+                    help="Word embedding sizes")
+parser.add_argument('-brnn', type=int, default=1,
+                    help="Use a bidirectional encoder")
+parser.add_argument('-batch_size', type=int, default=32,
+                    help="Number of sentences of the batches")
+parser.add_argument('-src_length', type=int, default=30,
+                    help="""Maximum source length, the lengths are drawn
+                    between half of it and it""")
+parser.add_argument('-beam_size', type=int, default=5,
+                    help="Beam size of Beam.advance and translateBatch")
+parser.add_argument('-max_sent_length', type=int, default=30,
+                    help="""Decoding steps of Beam.advance and
+                    translateBatch (a random model rarely stops earlier)""")
+parser.add_argument('-sentences', type=int, default=10000,
+                    help="""Number of sentences of the Dataset collation and
+                    of the training corpus of preprocess.py""")
+
+
+def environment(opt):
+    "Metadata of the machine and of the code the benchmarks ran on."
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.STDOUT)
+        commit = commit.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': _cpuCount(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'git_commit': commit,
+        'options': vars(opt),
+    }
+
+
+def _cpuCount():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return None
+
+
+def makeDict(size):
+    "A vocabulary of `size` words: the specials and w4, w5, ..."
+    vocab = onmt.Dict([onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD,
+                       onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD])
+    for i in range(vocab.size(), size):
+        vocab.add('w%d' % i)
+    return vocab
+
+
+def makeDicts(opt):
+    "The dicts of a one pair (en -> de) model, as preprocess.py builds them."
+    srcDict, tgtDict = makeDict(opt.vocab_size), makeDict(opt.vocab_size)
+    return {'langs': ['en', 'de'],
+            'vocabs': {'en': srcDict, 'de': tgtDict},
+            'nSets': 1,
+            'srcLangs': ['en'],
+            'tgtLangs': ['de'],
+            'setIDs': [[0, 0]],
+            'setLangs': [['en', 'de']],
+            'src': {0: srcDict},
+            'tgt': {0: tgtDict}}
+
+
+def modelOptions(opt):
+    "The training options the model classes read."
+    return argparse.Namespace(layers=opt.layers, rnn_size=opt.rnn_size,
+                              word_vec_size=opt.word_vec_size,
+                              brnn=bool(opt.brnn), brnn_merge='concat',
+                              input_feed=1, dropout=0.0,
+                              share_rnn_enc=False, share_rnn_dec=False,
+                              share_embedding=False, share_attention=False)
+
+
+def makeModel(opt, dicts):
+    modelOpt = modelOptions(opt)
+    encoder = onmt.Models.Encoder(modelOpt, dicts['src'])
+    decoder = onmt.Models.Decoder(modelOpt, dicts['tgt'], dicts['nSets'])
+    model = onmt.Models.NMTModel(encoder, decoder)
+    generator = onmt.Models.Generator(modelOpt, dicts['tgt'])
+    model.eval()
+    generator.eval()
+    return model, generator, modelOpt
+
+
+def randomSentence(rng, opt, length):
+    "Ids of a sentence without specials."
+    return [rng.randint(onmt.Constants.EOS + 1, opt.vocab_size - 1)
+            for _ in range(length)]
+
+
+def randomLength(rng, opt):
+    return rng.randint(max(1, opt.src_length // 2), opt.src_length)
+
+
+def makeSourceBatch(rng, opt):
+    "A T x B source batch sorted by decreasing length, with its lengths."
+    lengths = sorted([randomLength(rng, opt) for _ in range(opt.batch_size)],
+                     reverse=True)
+    src = torch.LongTensor(lengths[0], opt.batch_size).fill_(onmt.Constants.PAD)
+    for b, length in enumerate(lengths):
+        src[:length, b].copy_(torch.LongTensor(randomSentence(rng, opt, length)))
+    return src, torch.LongTensor(lengths)
+
+
+class Benchmark(object):
+    """
+    A timed function. setup() builds the inputs (not timed) and returns
+    the function to time and the number of items (tokens, sentences ...)
+    one call processes.
+    """
+
+    name = None
+    unit = None
+
+    def __init__(self, opt, rng):
+        self.opt = opt
+        self.rng = rng
+
+    def setup(self):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+class EncoderBenchmark(Benchmark):
+    "Encoder.forward on a packed source batch."
+
+    name = 'encoder'
+    unit = 'tokens'
+
+    def setup(self):
+        dicts = makeDicts(self.opt)
+        model, _, _ = makeModel(self.opt, dicts)
+        src, lengths = makeSourceBatch(self.rng, self.opt)
+        batch = (Variable(src, volatile=True),
+                 Variable(lengths.view(1, -1), volatile=True))
+
+        def run():
+            model.encoder(batch)
+        return run, int(lengths.sum())
+
+
+class DecoderStepBenchmark(Benchmark):
+    "One step of Decoder.forward (input feeding and attention) for a beam."
+
+    name = 'decoder_step'
+    unit = 'sentences'
+
+    def setup(self):
+        opt = self.opt
+        dicts = makeDicts(opt)
+        model, _, _ = makeModel(opt, dicts)
+        src, lengths = makeSourceBatch(self.rng, opt)
+        states, context = model.encoder((Variable(src, volatile=True),
+                                         Variable(lengths.view(1, -1), volatile=True)))
+
+        rows = opt.batch_size * opt.beam_size
+        context = Variable(context.data.repeat(1, opt.beam_size, 1), volatile=True)
+        hidden = tuple(Variable(model._fix_enc_hidden(s).data.repeat(1, opt.beam_size, 1),
+                                volatile=True) for s in states)
+        initOutput = model.make_init_decoder_output(context)
+        input = Variable(torch.LongTensor(1, rows).fill_(onmt.Constants.BOS),
+                         volatile=True)
+
+        def run():
+            model.decoder(input, hidden, context, initOutput)
+        return run, rows
+
+
+class AttentionBenchmark(Benchmark):
+    "GlobalAttention.forward of a beam over the source context."
+
+    name = 'attention'
+    unit = 'sentences'
+
+    def setup(self):
+        opt = self.opt
+        rows = opt.batch_size * opt.beam_size
+        attn = onmt.modules.GlobalAttention(opt.rnn_size)
+        attn.eval()
+        input = Variable(torch.randn(rows, opt.rnn_size), volatile=True)
+        context = Variable(torch.randn(rows, opt.src_length, opt.rnn_size),
+                           volatile=True)
+
+        def run():
+            attn(input, context)
+        return run, rows
+
+
+class GeneratorBenchmark(Benchmark):
+    "Generator.forward (projection and log softmax) of a beam."
+
+    name = 'generator'
+    unit = 'sentences'
+
+    def setup(self):
+        opt = self.opt
+        dicts = makeDicts(opt)
+        _, generator, _ = makeModel(opt, dicts)
+        rows = opt.batch_size * opt.beam_size
+        input = Variable(torch.randn(rows, opt.rnn_size), volatile=True)
+
+        def run():
+            generator(input)
+        return run, rows
+
+
+class BeamBenchmark(Benchmark):
+    "max_sent_length calls of Beam.advance on random scores."
+
+    name = 'beam_advance'
+    unit = 'steps'
+
+    def setup(self):
+        opt = self.opt
+        steps = opt.max_sent_length
+        wordLks = [torch.randn(opt.beam_size, opt.vocab_size)
+                   for _ in range(steps)]
+        # </s> is never the best word, every beam runs all the steps
+        for wordLk in wordLks:
+            wordLk[:, onmt.Constants.EOS] = -float('inf')
+        attn = torch.rand(opt.beam_size, opt.src_length)
+
+        def run():
+            beam = onmt.Beam(opt.beam_size)
+            for wordLk in wordLks:
+                beam.advance(wordLk, attn)
+        return run, steps
+
+
+class TranslateBatchBenchmark(Benchmark):
+    "Translator.translateBatch of a batch, from a synthetic checkpoint."
+
+    name = 'translate_batch'
+    unit = 'sentences'
+
+    def setup(self):
+        opt = self.opt
+        dicts = makeDicts(opt)
+        model, generator, modelOpt = makeModel(opt, dicts)
+
+        self.tmpDir = tempfile.mkdtemp(prefix='onmt-benchmark-')
+        modelFile = os.path.join(self.tmpDir, 'model.pt')
+        torch.save({'model': model.state_dict(),
+                    'generator': generator.state_dict(),
+                    'dicts': dicts,
+                    'opt': modelOpt,
+                    'epoch': -1,
+                    'iteration': -1,
+                    'scheduler': None}, modelFile)
+
+        translateOpt = argparse.Namespace(
+            model=modelFile, src_lang='en', tgt_lang='de', ensemble_op='sum',
+            beam_size=opt.beam_size, batch_size=opt.batch_size,
+            max_sent_length=opt.max_sent_length, replace_unk=False,
+            verbose=False, n_best=1, cuda=False, use_ema=False)
+        translator = onmt.Translator(translateOpt)
+
+        srcDict = dicts['vocabs']['en']
+        srcBatch = [[srcDict.getLabel(i) for i in
+                     randomSentence(self.rng, opt, randomLength(self.rng, opt))]
+                    for _ in range(opt.batch_size)]
+        src, _, _ = translator.buildData(srcBatch, None)[0]
+
+        def run():
+            translator.translateBatch(src, None)
+        return run, opt.batch_size
+
+    def teardown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+
+class CollateBenchmark(Benchmark):
+    "Dataset.collate of all the batches of a length sorted corpus."
+
+    name = 'dataset_collate'
+    unit = 'tokens'
+
+    def setup(self):
+        opt = self.opt
+        pairs = []
+        for _ in range(opt.sentences):
+            src = randomSentence(self.rng, opt, randomLength(self.rng, opt))
+            tgt = [onmt.Constants.BOS] + \
+                randomSentence(self.rng, opt, randomLength(self.rng, opt)) + \
+                [onmt.Constants.EOS]
+            pairs.append((src, tgt))
+        # preprocess.py sorts the pairs by source length
+        pairs.sort(key=lambda pair: len(pair[0]))
+        srcData = [torch.LongTensor(src) for src, _ in pairs]
+        tgtData = [torch.LongTensor(tgt) for _, tgt in pairs]
+        dataset = onmt.Dataset(srcData, tgtData, opt.batch_size, False)
+        tokens = sum(len(src) + len(tgt) for src, tgt in pairs)
+
+        def run():
+            for i in range(len(dataset)):
+                dataset.collate(i)
+        return run, tokens
+
+
+class PreprocessBenchmark(Benchmark):
+    """
+    preprocess.py on a synthetic corpus (vocabularies, encoding and
+    saving), in a new process: the time includes the start of python.
+    """
+
+    name = 'preprocess'
+    unit = 'tokens'
+
+    def writeCorpus(self, prefix, sentences):
+        tokens = 0
+        for side in ['src', 'tgt']:
+            with open('%s.%s' % (prefix, side), 'w') as f:
+                for _ in range(sentences):
+                    words = randomSentence(self.rng, self.opt,
+                                           randomLength(self.rng, self.opt))
+                    tokens += len(words)
+                    f.write(' '.join('w%d' % w for w in words) + '\n')
+        return tokens
+
+    def setup(self):
+        opt = self.opt
+        self.tmpDir = tempfile.mkdtemp(prefix='onmt-benchmark-')
+        train = os.path.join(self.tmpDir, 'train')
+        valid = os.path.join(self.tmpDir, 'valid')
+        tokens = self.writeCorpus(train, opt.sentences)
+        tokens += self.writeCorpus(valid, max(1, opt.sentences // 10))
+
+        command = [sys.executable, os.path.join(ROOT, 'preprocess.py'),
+                   '-train_src', train + '.src', '-train_tgt', train + '.tgt',
+                   '-valid_src', valid + '.src', '-valid_tgt', valid + '.tgt',
+                   '-src_langs', 'en', '-tgt_langs', 'de',
+                   '-vocab_size', str(opt.vocab_size),
+                   '-src_seq_length', str(opt.src_length),
+                   '-tgt_seq_length', str(opt.src_length),
+                   '-save_data', os.path.join(self.tmpDir, 'data')]
+        log = os.path.join(self.tmpDir, 'preprocess.log')
+
+        def run():
+            with open(log, 'w') as out:
+                subprocess.check_call(command, cwd=ROOT, stdout=out,
+                                      stderr=subprocess.STDOUT)
+        return run, tokens
+
+    def teardown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+
+BENCHMARKS = [EncoderBenchmark, DecoderStepBenchmark, AttentionBenchmark,
+              GeneratorBenchmark, BeamBenchmark, TranslateBatchBenchmark,
+              CollateBenchmark, PreprocessBenchmark]
+
+
+def measure(run, opt):
+    """
+    Seconds per call of every timed run. One untimed call warms up (and
+    calibrates the number of calls per run to last -min_time).
+    """
+    start = timeit.default_timer()
+    run()
+    once = max(timeit.default_timer() - start, 1e-9)
+    number = max(1, int(math.ceil(opt.min_time / once)))
+
+    times = []
+    for _ in range(opt.repeat):
+        start = timeit.default_timer()
+        for _ in range(number):
+            run()
+        times.append((timeit.default_timer() - start) / number)
+    return times, number
+
+
+def summarize(times):
+    ordered = sorted(times)
+    n = len(ordered)
+    median = (ordered[(n - 1) // 2] + ordered[n // 2]) / 2
+    mean = sum(ordered) / n
+    stdev = math.sqrt(sum((t - mean) ** 2 for t in ordered) / max(1, n - 1))
+    return {'min': ordered[0], 'median': median, 'mean': mean,
+            'max': ordered[-1], 'stdev': stdev}
+
+
+def runBenchmark(cls, opt):
+    # every benchmark starts from the same random state
+    torch.manual_seed(opt.seed)
+    bench = cls(opt, random.Random(opt.seed))
+    try:
+        run, items = bench.setup()
+        times, number = measure(run, opt)
+    finally:
+        bench.teardown()
+
+    seconds = summarize(times)
+    return {'description': cls.__doc__.strip().split('\n')[0],
+            'seconds': seconds,
+            'times': times,
+            'number': number,
+            'repeat': opt.repeat,
+            'items': items,
+            'unit': cls.unit,
+            'items_per_second': items / seconds['median']}
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the ratio of the median times of the benchmarks of both runs.
+    Returns the names of the benchmarks slower than 1 + threshold.
+    """
+    for key in ['torch', 'torch_threads', 'cpu_count', 'processor']:
+        old = baseline['environment'].get(key)
+        new = results['environment'].get(key)
+        if old != new:
+            print('WARNING: %s differs from the baseline (%s vs %s)'
+                  % (key, new, old))
+
+    regressions = []
+    print('%-18s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            print('%-18s %12s %12.6f %8s' % (name, '-', result['seconds']['median'], 'new'))
+            continue
+        old = baseline['benchmarks'][name]['seconds']['median']
+        new = result['seconds']['median']
+        ratio = new / old
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        print('%-18s %12.6f %12.6f %8.3f %s' % (name, old, new, ratio, flag))
+    return regressions
+
+
+def main():
+    opt = parser.parse_args()
+
+    if opt.list:
+        for cls in BENCHMARKS:
+            print('%-18s %s' % (cls.name, cls.__doc__.strip().split('\n')[0]))
+        return
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    names = [cls.name for cls in BENCHMARKS]
+    selected = opt.only.split(',') if opt.only else names
+    for name in selected:
+        assert name in names, "Unknown benchmark %s, see -list" % name
+
+    results = {'environment': environment(opt), 'benchmarks': {}}
+    for cls in BENCHMARKS:
+        if cls.name not in selected:
+            continue
+        result = runBenchmark(cls, opt)
+        results['benchmarks'][cls.name] = result
+        print('%-18s %10.3f ms/call %14.1f %s/s (%d x %d calls)'
+              % (cls.name, 1000 * result['seconds']['median'],
+                 result['items_per_second'], cls.unit,
+                 opt.repeat, result['number']))
+        sys.stdout.flush()
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Results written to %s' % opt.output)
+
+    if opt.compare:
+        with open(opt.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, opt.threshold)
+        if regressions:
+            print('%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import re
+import codecs
+import heapq
+from collections import OrderedDict
+
+
+def desegment(text, separator='@@'):
+    """
+    Undo the BPE segmentation of a sentence: "un@@ related" -> "unrelated".
+    A separator at the end of the sentence is removed as well.
+    """
+    if isinstance(text, list):
+        text = " ".join(text)
+    return re.sub('(%s )|(%s ?$)' % (re.escape(separator), re.escape(separator)),
+                  '', text)
+
+
+class BPE(object):
+    """
+    Byte pair encoding with the merges file of subword-nmt (learn_bpe.py).
+
+    The merges of a word are applied with a priority queue of the adjacent
+    symbol pairs, ordered by merge rank, so a word of n characters takes
+    O(n log n) instead of one pass over the word per merge. The
+    segmentation of each word is memoized in a bounded LRU cache.
+    """
+
+    def __init__(self, codesFile, separator='@@', cacheSize=100000):
+        self.separator = separator
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+        self.version = (0, 1)
+        self.ranks = dict()
+
+        with codecs.open(codesFile, encoding='utf-8') as f:
+            for n, line in enumerate(f):
+                if n == 0 and line.startswith('#version:'):
+                    self.version = tuple(int(x) for x in
+                                         re.sub(r'(\.0+)*$', '',
+                                                line.split()[-1]).split('.'))
+                    continue
+                pair = tuple(line.rstrip('\r\n').split(' '))
+                if len(pair) != 2:
+                    continue
+                # keep the first (highest priority) occurrence of a pair
+                if pair not in self.ranks:
+                    self.ranks[pair] = len(self.ranks)
+
+    def _merge(self, word):
+        "Apply the merges to a single word, returns the list of subwords."
+        if self.version == (0, 1):
+            symbols = list(word) + ['</w>']
+        else:
+            symbols = list(word[:-1]) + [word[-1] + '</w>']
+
+        n = len(symbols)
+        # doubly linked list over the positions of the symbols
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n + 1))
+        nxt[-1] = -1
+        alive = [True] * n
+
+        heap = []
+
+        def push(i, j):
+            rank = self.ranks.get((symbols[i], symbols[j]))
+            if rank is not None:
+                heapq.heappush(heap, (rank, i, symbols[i], symbols[j]))
+
+        for i in range(n - 1):
+            push(i, i + 1)
+
+        while heap:
+            rank, i, left, right = heapq.heappop(heap)
+            j = nxt[i]
+            # outdated entry: one of the symbols has been merged since
+            if not alive[i] or j < 0 or symbols[i] != left or symbols[j] != right:
+                continue
+
+            symbols[i] = left + right
+            alive[j] = False
+            nxt[i] = nxt[j]
+            if nxt[j] >= 0:
+                prev[nxt[j]] = i
+
+            if prev[i] >= 0:
+                push(prev[i], i)
+            if nxt[i] >= 0:
+                push(i, nxt[i])
+
+        subwords = [symbols[i] for i in range(n) if alive[i]]
+
+        # remove the end of word marker
+        if subwords[-1] == '</w>':
+            subwords = subwords[:-1]
+        elif subwords[-1].endswith('</w>'):
+            subwords[-1] = subwords[-1][:-len('</w>')]
+        return subwords
+
+    def segmentWord(self, word):
+        "The subwords of `word`, memoized in the LRU cache."
+        try:
+            subwords = self.cache.pop(word)
+        except KeyError:
+            if isinstance(word, bytes):
+                # python 2 strings, the merges work on characters
+                subwords = [s.encode('utf-8')
+                            for s in self._merge(word.decode('utf-8'))]
+            else:
+                subwords = self._merge(word)
+            if len(self.cache) >= self.cacheSize:
+                self.cache.popitem(last=False)
+        # (re-)insert as the most recently used entry
+        self.cache[word] = subwords
+        return subwords
+
+    def segmentTokens(self, tokens):
+        "Segment a list of words into a list of subword tokens."
+        out = []
+        for word in tokens:
+            subwords = self.segmentWord(word)
+            out += [s + self.separator for s in subwords[:-1]]
+            out.append(subwords[-1])
+        return out
+
+    def segment(self, sentence):
+        "Raw (tokenized) sentence in, segmented sentence out."
+        return " ".join(self.segmentTokens(sentence.split()))
+
+    def desegment(self, text):
+        return desegment(text, self.separator)
@@ -0,0 +1,136 @@
+from __future__ import division
+
+import time
+import threading
+import torch
+import torch.multiprocessing as mp
+from six.moves import queue
+
+
+def _collateWorker(datasets, schedule, out, workerID, nWorkers, slots):
+    """
+    Collate every nWorkers-th batch of the schedule (starting at workerID)
+    and push it into this worker's own queue, so that the consumer can
+    restore the schedule order by reading the queues round-robin.
+    """
+    slot = 0
+    try:
+        for position in range(workerID, len(schedule), nWorkers):
+            setID, batchIdx = schedule[position]
+            buffers = slots[slot] if slots else None
+            collated = datasets[setID].collate(batchIdx, buffers=buffers)
+            out.put((position, collated))
+            if slots:
+                slot = (slot + 1) % len(slots)
+    except Exception as e:
+        out.put((-1, e))
+
+
+class BatchPrefetcher(object):
+    """
+    Iterate over a schedule of (setID, batchIdx) pairs while the next
+    batches are collated in the background.
+
+    Every worker owns a bounded queue, so at most `bufferSize` batches
+    (plus one in construction per worker) are alive at the same time.
+    In "thread" mode the batches are written into preallocated buffers
+    (pinned if requested); in "process" mode they travel through shared
+    memory. With bufferSize = 0 the batches are collated synchronously.
+
+    `waitTime` accumulates the seconds the consumer spent blocked on data.
+    """
+
+    def __init__(self, datasets, schedule, bufferSize=0, numWorkers=1,
+                 mode="thread", pinMemory=False):
+
+        self.datasets = datasets
+        self.schedule = list(schedule)
+        self.bufferSize = bufferSize
+        self.numWorkers = max(1, min(numWorkers, max(bufferSize, 1)))
+        self.mode = mode
+        self.pinMemory = pinMemory
+        self.waitTime = 0.0
+        self.workers = []
+        self.queues = []
+
+        if mode not in ["thread", "process"]:
+            raise ValueError('Prefetch mode needs to be "thread" or "process", '
+                             'the current value is %s' % mode)
+
+        if self.bufferSize > 0 and len(self.schedule) > 0:
+            self._start()
+
+    def _allocateSlots(self, nSlots):
+        srcSize, tgtSize = 0, 0
+        for setID in set(s for s, _ in self.schedule):
+            sizes = self.datasets[setID].bufferSizes()
+            srcSize = max(srcSize, sizes[0])
+            tgtSize = max(tgtSize, sizes[1])
+
+        if srcSize == 0:
+            return None
+
+        slots = []
+        for i in range(nSlots):
+            slot = {'src': torch.LongTensor(srcSize),
+                    'tgt': torch.LongTensor(max(tgtSize, 1))}
+            if self.pinMemory:
+                slot = {k: v.pin_memory() for k, v in slot.items()}
+            slots.append(slot)
+        return slots
+
+    def _start(self):
+        queueSize = max(1, self.bufferSize // self.numWorkers)
+
+        for w in range(self.numWorkers):
+            if self.mode == "thread":
+                # queued + being built + held by the consumer
+                slots = self._allocateSlots(queueSize + 2)
+                q = queue.Queue(maxsize=queueSize)
+                worker = threading.Thread(
+                    target=_collateWorker,
+                    args=(self.datasets, self.schedule, q, w,
+                          self.numWorkers, slots))
+            else:
+                q = mp.Queue(maxsize=queueSize)
+                worker = mp.Process(
+                    target=_collateWorker,
+                    args=(self.datasets, self.schedule, q, w,
+                          self.numWorkers, None))
+            worker.daemon = True
+            worker.start()
+            self.queues.append(q)
+            self.workers.append(worker)
+
+    def __len__(self):
+        return len(self.schedule)
+
+    def __iter__(self):
+        for position, (setID, batchIdx) in enumerate(self.schedule):
+            dataset = self.datasets[setID]
+
+            start = time.time()
+            if self.bufferSize > 0:
+                q = self.queues[position % self.numWorkers]
+                got, collated = q.get()
+                if got < 0:
+                    self.close()
+                    raise collated
+                assert got == position
+                if self.mode == "process" and self.pinMemory:
+                    collated = tuple(t.pin_memory() if torch.is_tensor(t)
+                                     else t for t in collated)
+            else:
+                collated = dataset.collate(batchIdx)
+            self.waitTime += time.time() - start
+
+            yield setID, batchIdx, dataset.wrap(collated)
+
+        self.close()
+
+    def close(self):
+        for worker in self.workers:
+            if self.mode == "process" and worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self.queues = []
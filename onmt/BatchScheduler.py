@@ -0,0 +1,119 @@
+from __future__ import division
+
+import random
+import torch
+import onmt
+
+
+class BatchScheduler(object):
+    """
+    The (setID, batchIdx) schedule of a whole epoch, drawn up front so
+    that the batches can be prepared in the background (BatchPrefetcher).
+
+    Every language pair i with n_i batches gets a number of steps
+    proportional to n_i ** (1 / temperature), rounded with the largest
+    remainder method so that the epoch keeps sum(n_i) steps. With
+    temperature 1 every batch is read exactly once; higher temperatures
+    up-sample the small pairs (their batch order is then repeated).
+    The steps of all pairs are interleaved by one shuffle.
+
+    The schedule only depends on (seed, epoch), and the scheduler state is
+    saved in the checkpoints to resume an epoch where it stopped.
+    """
+
+    def __init__(self, seed, temperature=1.0, adaptPair=None):
+        self.seed = seed
+        self.temperature = temperature
+        self.adaptPair = adaptPair
+        self.epoch = None
+        self.schedule = None
+
+    def _counts(self, sizes):
+        total = sum(sizes)
+        if total == 0:
+            # no batches at all: an empty schedule
+            return [0] * len(sizes)
+        weights = [n ** (1.0 / self.temperature) if n > 0 else 0.0
+                   for n in sizes]
+        quotas = [total * w / sum(weights) for w in weights]
+        counts = [int(q) for q in quotas]
+
+        # give the remaining steps to the largest remainders
+        remainders = sorted(range(len(sizes)),
+                            key=lambda i: counts[i] - quotas[i])
+        for i in remainders[:total - sum(counts)]:
+            counts[i] += 1
+        return counts
+
+    def _batchOrder(self, trainSets, rng, curriculum):
+        if isinstance(trainSets, onmt.ShardedDataset):
+            # sharded data: shard-major order
+            return trainSets.batchOrder(curriculum=curriculum, rng=rng)
+
+        batchOrder = dict()
+        for i in trainSets:
+            order = list(range(len(trainSets[i])))
+            if not curriculum:
+                rng.shuffle(order)
+            batchOrder[i] = order
+        return batchOrder
+
+    def build(self, trainSets, epoch, curriculum=False):
+        """
+        Draw the schedule of an epoch. In curriculum epochs the batches of
+        every pair are taken in order (by length).
+        """
+        rng = random.Random(self.seed * 1000003 + epoch)
+        batchOrder = self._batchOrder(trainSets, rng, curriculum)
+
+        setIDs = sorted(batchOrder)
+        sizes = [len(batchOrder[i]) for i in setIDs]
+        if self.adaptPair is not None:
+            # only the adapted pair is trained
+            counts = [n if i == self.adaptPair else 0
+                      for i, n in zip(setIDs, sizes)]
+        else:
+            counts = self._counts(sizes)
+
+        sets = []
+        for i, count in zip(setIDs, counts):
+            sets += [i] * count
+        rng.shuffle(sets)
+
+        positions = dict((i, 0) for i in setIDs)
+        schedule = []
+        for i in sets:
+            order = batchOrder[i]
+            schedule.append((i, int(order[positions[i] % len(order)])))
+            positions[i] += 1
+
+        self.epoch = epoch
+        self.schedule = schedule
+        return schedule
+
+    def get(self, trainSets, epoch, curriculum=False):
+        "The schedule of the epoch, the resumed one if it was loaded."
+        if self.epoch != epoch or self.schedule is None:
+            self.build(trainSets, epoch, curriculum)
+        elif isinstance(trainSets, onmt.ShardedDataset):
+            # the shard order of the resumed epoch, for the read-ahead
+            rng = random.Random(self.seed * 1000003 + epoch)
+            self._batchOrder(trainSets, rng, curriculum)
+        return self.schedule
+
+    def state_dict(self):
+        return {'seed': self.seed,
+                'temperature': self.temperature,
+                'adaptPair': self.adaptPair,
+                'epoch': self.epoch,
+                'schedule': (torch.LongTensor(self.schedule)
+                             if self.schedule else None)}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.temperature = state['temperature']
+        self.adaptPair = state['adaptPair']
+        self.epoch = state['epoch']
+        schedule = state['schedule']
+        self.schedule = ([tuple(step) for step in schedule.tolist()]
+                         if schedule is not None else None)
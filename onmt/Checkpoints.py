@@ -0,0 +1,141 @@
+from __future__ import division
+
+import os
+import copy
+import threading
+import torch
+from six.moves import queue
+
+
+def _snapshot(value):
+    "Copy the tensors of a (nested) state dict to host memory."
+    if torch.is_tensor(value):
+        return value.cpu() if value.is_cuda else value.clone()
+    if isinstance(value, dict):
+        return type(value)((k, _snapshot(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(_snapshot(v) for v in value)
+    return value
+
+
+def _atomicSave(obj, fileName):
+    tmpName = fileName + '.tmp'
+    torch.save(obj, tmpName)
+    os.rename(tmpName, fileName)
+
+
+def dictsFile(prefix):
+    return prefix + '.dicts.pt'
+
+
+def loadCheckpoint(fileName, map_location=None):
+    """
+    torch.load a checkpoint, the dicts of checkpoints written by
+    CheckpointWriter are read from their sidecar file.
+    """
+    if map_location is None:
+        checkpoint = torch.load(fileName)
+    else:
+        checkpoint = torch.load(fileName, map_location=map_location)
+
+    if 'dicts' not in checkpoint and 'dicts_file' in checkpoint:
+        sidecar = os.path.join(os.path.dirname(os.path.abspath(fileName)),
+                               checkpoint['dicts_file'])
+        checkpoint['dicts'] = torch.load(sidecar)
+    return checkpoint
+
+
+class CheckpointWriter(object):
+    """
+    Write checkpoints in the background: save() copies the state dicts to
+    host memory and returns, a thread serializes the copy to a temporary
+    file and renames it into place, so a checkpoint file is always
+    complete. At most one checkpoint waits to be written, a save() during a
+    write blocks until the previous one is queued.
+
+    The dicts are written once next to the checkpoints
+    (<prefix>.dicts.pt), the checkpoints only name that file.
+
+    Retention: the keepLast most recent and the keepBest best scoring
+    checkpoints are kept, the others are deleted (0 keeps all).
+    """
+
+    def __init__(self, prefix, dicts, keepLast=0, keepBest=0,
+                 higherIsBetter=False):
+        self.prefix = prefix
+        self.dicts = dicts
+        self.keepLast = keepLast
+        self.keepBest = keepBest
+        self.higherIsBetter = higherIsBetter
+        self.dictsWritten = False
+
+        # (fileName, score) of the kept checkpoints, oldest first
+        self.written = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _writer(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            checkpoint, fileName, score = job
+            try:
+                if not self.dictsWritten:
+                    _atomicSave(self.dicts, dictsFile(self.prefix))
+                    self.dictsWritten = True
+                _atomicSave(checkpoint, fileName)
+                self._retain(fileName, score)
+            except Exception as e:
+                self.error = e
+
+    def _retain(self, fileName, score):
+        self.written = [w for w in self.written if w[0] != fileName]
+        self.written.append((fileName, score))
+        if self.keepLast <= 0 and self.keepBest <= 0:
+            return
+
+        keep = set(w[0] for w in self.written[-self.keepLast:]) \
+            if self.keepLast > 0 else set()
+        if self.keepBest > 0:
+            scored = [w for w in self.written if w[1] is not None]
+            scored.sort(key=lambda w: w[1], reverse=self.higherIsBetter)
+            keep.update(w[0] for w in scored[:self.keepBest])
+
+        for name, _ in self.written:
+            if name not in keep and os.path.exists(name):
+                os.remove(name)
+        self.written = [w for w in self.written if w[0] in keep]
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, checkpoint, fileName, score=None):
+        """
+        Queue `checkpoint` (a dict as written by the trainers) for writing
+        to fileName; `score` is the validation score of the retention
+        policy. The dicts are replaced by the name of the sidecar file and
+        the optimizer is copied without its parameters.
+        """
+        self._check()
+        snapshot = dict()
+        for key, value in checkpoint.items():
+            if key == 'dicts':
+                continue
+            if key in ('optim', 'opt'):
+                value = copy.deepcopy(value)
+            snapshot[key] = _snapshot(value)
+        snapshot['dicts_file'] = os.path.basename(dictsFile(self.prefix))
+
+        self.queue.put((snapshot, fileName, score))
+
+    def close(self):
+        "Wait until all the checkpoints are written."
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
@@ -0,0 +1,186 @@
+from __future__ import division
+
+import re
+import struct
+import hashlib
+import zlib
+
+import numpy as np
+
+
+_MERSENNE = (1 << 61) - 1
+_NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+
+def hash64(text):
+    "A 64-bit hash of a string, stable across runs and python versions."
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(text).digest()[:8])[0]
+
+
+def normalize(line):
+    "Lower case, punctuation and spacing removed."
+    if isinstance(line, bytes):
+        # python 2 strings
+        line = line.decode('utf-8', 'ignore')
+    return _NON_WORD.sub(' ', line.lower()).strip()
+
+
+class HashSet64(object):
+    """
+    Set of 64-bit hashes in a fixed size open addressing table, so the memory
+    stays bounded (8 bytes per slot) however long the corpus is. Once the
+    table is 3/4 full, new hashes are not stored any more.
+    """
+
+    def __init__(self, capacity):
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.mask = self.size - 1
+        self.table = np.zeros(self.size, dtype=np.uint64)
+        self.count = 0
+        self.full = False
+
+    def add(self, h):
+        "Insert h, returns True if it was already in the set."
+        # 0 marks an empty slot
+        h = h or 1
+        slot = h & self.mask
+        table = self.table
+        while True:
+            value = int(table[slot])
+            if value == h:
+                return True
+            if value == 0:
+                break
+            slot = (slot + 1) & self.mask
+
+        if self.count * 4 >= self.size * 3:
+            self.full = True
+        else:
+            table[slot] = h
+            self.count += 1
+        return False
+
+    def __contains__(self, h):
+        h = h or 1
+        slot = h & self.mask
+        while True:
+            value = int(self.table[slot])
+            if value == h:
+                return True
+            if value == 0:
+                return False
+            slot = (slot + 1) & self.mask
+
+
+class CorpusFilter(object):
+    """
+    Streaming filter of a parallel corpus. A pair is removed if
+
+      - its source/target length ratio is above `maxLengthRatio`,
+      - the normalized pair was seen before (exact duplicate, 64-bit hash),
+      - its source shares an LSH band with a kept source (near duplicate).
+        The source is represented by the MinHash signature (bands x rows
+        values) of its word n-grams; two sources with Jaccard similarity s
+        collide with probability 1 - (1 - s^rows)^bands.
+
+    Only kept pairs are added to the indexes.
+    """
+
+    def __init__(self, exact=True, nearDup=False, maxLengthRatio=0,
+                 ngram=3, bands=10, rows=12, capacity=1 << 24, seed=3435):
+        self.exact = exact
+        self.nearDup = nearDup
+        self.maxLengthRatio = maxLengthRatio
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = rows
+
+        self.exactIndex = HashSet64(capacity) if exact else None
+        self.bandIndex = HashSet64(capacity) if nearDup else None
+
+        # random hash functions (a * x + b) mod p for the MinHash
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 1 << 30, size=bands * rows, dtype=np.int64).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 30, size=bands * rows, dtype=np.int64).astype(np.uint64)
+        # mixes the rows of a band into one 64-bit key
+        self.mix = rng.randint(1, 1 << 62, size=(bands, rows), dtype=np.int64).astype(np.uint64)
+
+        self.reset()
+
+    def reset(self):
+        self.stats = {'total': 0, 'kept': 0, 'length_ratio': 0,
+                      'exact_duplicate': 0, 'near_duplicate': 0}
+
+    def signature(self, words):
+        "MinHash signature of the word n-grams, None if the sentence is too short."
+        n = self.ngram
+        if len(words) < n:
+            return None
+        shingles = np.array([zlib.crc32(" ".join(words[i:i+n]).encode('utf-8'))
+                             & 0xffffffff for i in range(len(words) - n + 1)],
+                            dtype=np.uint64)
+        # (bands * rows) x nShingles, all products stay below 2^62
+        hashes = (np.outer(self.a, shingles) + self.b[:, None]) % np.uint64(_MERSENNE)
+        return hashes.min(1).reshape(self.bands, self.rows)
+
+    def bandKeys(self, signature):
+        with np.errstate(over='ignore'):
+            keys = (signature * self.mix).sum(1)
+        # the band number is part of the key
+        return [(int(k) ^ (band * 0x9E3779B97F4A7C15)) & 0xffffffffffffffff
+                for band, k in enumerate(keys)]
+
+    def check(self, srcLine, tgtLine):
+        """
+        Returns the reason to remove the pair, or None if the pair is kept
+        (and added to the indexes).
+        """
+        self.stats['total'] += 1
+        srcWords = normalize(srcLine).split()
+        tgtWords = normalize(tgtLine).split()
+
+        if self.maxLengthRatio > 0:
+            srcLen, tgtLen = max(len(srcWords), 1), max(len(tgtWords), 1)
+            if max(srcLen, tgtLen) > self.maxLengthRatio * min(srcLen, tgtLen):
+                self.stats['length_ratio'] += 1
+                return 'length_ratio'
+
+        if self.exact:
+            h = hash64(" ".join(srcWords) + "\t" + " ".join(tgtWords))
+            if h in self.exactIndex:
+                self.stats['exact_duplicate'] += 1
+                return 'exact_duplicate'
+
+        keys = None
+        if self.nearDup:
+            signature = self.signature(srcWords)
+            if signature is not None:
+                keys = self.bandKeys(signature)
+                if any(k in self.bandIndex for k in keys):
+                    self.stats['near_duplicate'] += 1
+                    return 'near_duplicate'
+
+        if self.exact:
+            self.exactIndex.add(h)
+        if keys is not None:
+            for k in keys:
+                self.bandIndex.add(k)
+        self.stats['kept'] += 1
+        return None
+
+    def report(self, name):
+        stats = self.stats
+        total = max(stats['total'], 1)
+        print('Filter report for %s:' % name)
+        print(' * %d pairs checked, %d kept' % (stats['total'], stats['kept']))
+        for reason in ['length_ratio', 'exact_duplicate', 'near_duplicate']:
+            print(' * %-16s %8d removed (%.2f%%)' %
+                  (reason, stats[reason], 100.0 * stats[reason] / total))
+        for kind, index in [('exact', self.exactIndex), ('near', self.bandIndex)]:
+            if index is not None and index.full:
+                print('WARNING: the %s duplicate index is full, '
+                      'increase -filter_capacity' % kind)
@@ -1,11 +1,30 @@
 from __future__ import division
 
 import math
+import random
 import torch
 from torch.autograd import Variable
 
 import onmt
 
+def wrapBatch(collated, cuda, volatile=False):
+    "Ship a collated batch to the device and wrap it in Variables."
+    srcBatch, lengths, tgtBatch, indices = collated
+
+    def wrap(b):
+        if b is None:
+            return b
+        if cuda:
+            b = b.cuda()
+        b = Variable(b, volatile=volatile)
+        return b
+
+    # wrap lengths in a Variable to properly split it in DataParallel
+    lengths = Variable(lengths.view(1, -1), volatile=volatile)
+
+    return (wrap(srcBatch), lengths), wrap(tgtBatch), indices
+
+
 class Dataset(object):
     def __init__(self, srcData, tgtData, batchSize, cuda,
                  volatile=False, data_type="text", balance=True):
@@ -19,16 +38,79 @@ class Dataset(object):
         self.cuda = cuda
         self.fullSize = len(self.src)
 
+        # text is only kept flattened, without one tensor per sentence:
+        # the callers can release the sentences once the Dataset is built
+        self.srcFlat, self.tgtFlat = None, None
+        self.srcLengths = None
+        if self._type == "text" and self.fullSize > 0:
+            self.srcFlat = self._flatten(self.src)
+            self.srcLengths = self.srcFlat['lengths'].tolist()
+            self.src = None
+            if self.tgt is not None:
+                self.tgtFlat = self._flatten(self.tgt)
+                self.tgt = None
+
         self.batchSize = batchSize
         #~ self.numBatches = math.ceil(len(self.src)/batchSize)
         self.volatile = volatile
         
         self.balance = balance
         
+        # the order in which the examples are read, shuffling only permutes it
+        self.order = list(range(self.fullSize))
+        self.buckets = None
+        
         if self.balance:
             self.allocateBatch()
         else:
-            self.numBatches = int(math.ceil(len(self.src)/batchSize))
+            self.numBatches = int(math.ceil(self.fullSize/batchSize))
+
+    @staticmethod
+    def _flatten(data):
+        """
+        Concatenate the sentences into one token buffer followed by a PAD
+        sentinel, so that a padded batch is a single index_select. The
+        sentences are found by their offsets and lengths in the buffer.
+        """
+        lengths, offsets = [], []
+        total = 0
+        for x in data:
+            offsets.append(total)
+            lengths.append(x.size(0))
+            total += x.size(0)
+
+        pad = data[0].new(1).fill_(onmt.Constants.PAD)
+        tokens = torch.cat([x for x in data if x.size(0) > 0] + [pad], 0)
+        sentinel = total
+        steps = torch.arange(0, max([1] + lengths)).long()
+        lengths = torch.LongTensor(lengths)
+        offsets = torch.LongTensor(offsets)
+        return {'tokens': tokens, 'offsets': offsets, 'lengths': lengths,
+                'sentinel': sentinel, 'steps': steps}
+
+    @staticmethod
+    def _gather(flat, indices, out=None):
+        """
+        Padded T x B batch of the sentences `indices` (LongTensor) of a
+        flattened side: positions past the end of a sentence point to the
+        PAD sentinel.
+        """
+        lengths = flat['lengths'].index_select(0, indices)
+        maxLength = int(lengths.max())
+        batchSize = indices.size(0)
+
+        steps = flat['steps'][:maxLength].view(-1, 1).expand(maxLength, batchSize)
+        positions = flat['offsets'].index_select(0, indices).view(1, -1) \
+                                   .expand(maxLength, batchSize) + steps
+        positions.masked_fill_(steps.ge(lengths.view(1, -1).expand(maxLength, batchSize)),
+                               flat['sentinel'])
+
+        if out is not None:
+            out = out.narrow(0, 0, maxLength * batchSize)
+            torch.index_select(flat['tokens'], 0, positions.view(-1), out=out)
+        else:
+            out = flat['tokens'].index_select(0, positions.view(-1))
+        return out.view(maxLength, batchSize)
 
     #~ # This function allocates the mini-batches (grouping sentences with the same size)
     def allocateBatch(self):
@@ -39,8 +121,8 @@ class Dataset(object):
         cur_batch = []
         cur_batch_length = -99
         
-        for i in xrange(self.fullSize):
-            cur_length = self.src[i].size(0)
+        for i in self.order:
+            cur_length = self._srcLength(i)
             # if the current batch's length is different
             # the we create 
             if cur_batch_length != cur_length:
@@ -62,20 +144,24 @@ class Dataset(object):
         self.numBatches = len(self.batches)
                 
     def _batchify(self, data, align_right=False,
-                  include_lengths=False, dtype="text"):
+                  include_lengths=False, dtype="text", out=None):
         if dtype == "text":
-            try:
-                lengths = [x.size(0) for x in data]
-            except:
-                print(data[1:10])
+            lengths = [x.size(0) for x in data]
             max_length = max(lengths)
-            out = data[0].new(len(data), max_length).fill_(onmt.Constants.PAD)
+            # the batch is written time-major (T x B) so that no
+            # transpose/stack is needed afterwards
+            if out is None:
+                out = data[0].new(max_length, len(data))
+            else:
+                out = out.narrow(0, 0, max_length * len(data)) \
+                         .view(max_length, len(data))
+            out.fill_(onmt.Constants.PAD)
             for i in range(len(data)):
                 data_length = data[i].size(0)
                 offset = max_length - data_length if align_right else 0
-                out[i].narrow(0, offset, data_length).copy_(data[i])
+                out[:, i].narrow(0, offset, data_length).copy_(data[i])
             if include_lengths:
-                return out, lengths 
+                return out, lengths
             else:
                 return out
         elif dtype == "img":
@@ -84,7 +170,9 @@ class Dataset(object):
             widths = [x.size(2) for x in data]
             max_width = max(widths)
 
-            out = data[0].new(len(data), 3, max_height, max_width).fill_(0)
+            # 3 channels for images, more for precomputed feature maps
+            out = data[0].new(len(data), data[0].size(0),
+                              max_height, max_width).fill_(0)
             for i in range(len(data)):
                 data_height = data[i].size(1)
                 data_width = data[i].size(2)
@@ -92,73 +180,119 @@ class Dataset(object):
                 width_offset = max_width - data_width if align_right else 0
                 out[i].narrow(1, height_offset, data_height) \
                       .narrow(2, width_offset, data_width).copy_(data[i])
-            return out, widths            
-                
-                
-    def __getitem__(self, index):
-        assert index < self.numBatches, "%d > %d" % (index, self.numBatches)
-        
+            return out, widths
+
+    def _srcLength(self, i):
+        if self._type == "text":
+            return self.srcLengths[i]
+        # images are batched by width, a FeatureSequence knows the widths
+        # without reading the feature maps
+        if hasattr(self.src, 'width'):
+            return self.src.width(i)
+        return self.src[i].size(2)
+
+    def _batchIndices(self, index):
         if self.balance:
-                    batch = self.batches[index]
-                    srcData = [self.src[i] for i in batch]
-                    srcBatch, lengths = self._batchify(
-                            srcData,
-                            align_right=False, include_lengths=True, dtype=self._type)
-            
-                    if self.tgt:
-                        tgtData = [self.tgt[i] for i in batch]
-                        tgtBatch = self._batchify(
-                                    tgtData,
-                                    dtype="text")
-                    else:
-                            tgtBatch = None
+            return self.batches[index]
         else:
-                    srcBatch, lengths = self._batchify(
-            self.src[index*self.batchSize:(index+1)*self.batchSize],
-            align_right=False, include_lengths=True, dtype=self._type)
+            return self.order[index*self.batchSize:(index+1)*self.batchSize]
 
-                    if self.tgt:
-                            tgtBatch = self._batchify(
-                                    self.tgt[index*self.batchSize:(index+1)*self.batchSize],
-                                    dtype="text")
-                    else:
-                            tgtBatch = None  
+    def bufferSizes(self):
+        """
+        Number of elements needed to hold the largest src and tgt batch
+        of this dataset, used to preallocate collation buffers.
+        """
+        if self._type != "text":
+            return 0, 0
+        if self.fullSize == 0:
+            return 0, 0
+        maxSrc = int(self.srcFlat['lengths'].max())
+        maxTgt = int(self.tgtFlat['lengths'].max()) if self.tgtFlat is not None else 0
+        return self.batchSize * maxSrc, self.batchSize * maxTgt
+
+    def collate(self, index, buffers=None):
+        """
+        Build the padded batch `index` on the CPU, without wrapping it.
+        `buffers` is an optional dict with preallocated 'src' and 'tgt'
+        tensors the batch is written into.
+
+        Returns: (src, lengths, tgt, indices)
+        """
+        assert index < self.numBatches, "%d > %d" % (index, self.numBatches)
+
+        batch = self._batchIndices(index)
+
+        if self._type == "text":
+            # lengths, sort permutation and padded batches in a few
+            # tensor ops, without touching single sentences
+            batchIndices = torch.LongTensor(batch)
+            lengths, indices = torch.sort(
+                self.srcFlat['lengths'].index_select(0, batchIndices), 0, True)
+            batchIndices = batchIndices.index_select(0, indices)
+
+            srcBatch = self._gather(self.srcFlat, batchIndices,
+                                    out=buffers['src'] if buffers else None)
+            tgtBatch = None
+            if self.tgtFlat is not None:
+                tgtBatch = self._gather(self.tgtFlat, batchIndices,
+                                        out=buffers['tgt'] if buffers else None)
+
+            return srcBatch, lengths, tgtBatch, tuple(indices.tolist())
+
+        srcData = [self.src[i] for i in batch]
+        tgtData = [self.tgt[i] for i in batch] if self.tgt else None
+        lengths = [x.size(2) for x in srcData]
 
         # within batch sorting by decreasing length for variable length rnns
-        indices = range(len(srcBatch))
-        batch = (zip(indices, srcBatch) if tgtBatch is None
-                 else zip(indices, srcBatch, tgtBatch))
-        batch, lengths = zip(*sorted(zip(batch, lengths), key=lambda x: -x[1]))
-        if tgtBatch is None:
-            indices, srcBatch = zip(*batch)
-        else:
-            indices, srcBatch, tgtBatch = zip(*batch)
-
-        def wrap(b, dtype="text"):
-            if b is None:
-                return b
-            b = torch.stack(b, 0)
-            if dtype == "text":
-                b = b.t().contiguous()
-            if self.cuda:
-                b = b.cuda()
-            b = Variable(b, volatile=self.volatile)
-            return b
+        indices = sorted(range(len(srcData)), key=lambda k: -lengths[k])
+        srcData = [srcData[k] for k in indices]
+        lengths = [lengths[k] for k in indices]
+        if tgtData is not None:
+            tgtData = [tgtData[k] for k in indices]
 
-        # wrap lengths in a Variable to properly split it in DataParallel
-        lengths = torch.LongTensor(lengths).view(1, -1)
-        lengths = Variable(lengths, volatile=self.volatile)
-        
-        srcTensor = wrap(srcBatch, self._type)
-        tgtTensor = wrap(tgtBatch, "text")
-        
-        
-        return (srcTensor, lengths), \
-            tgtTensor, indices
+        srcBatch, _ = self._batchify(srcData, dtype=self._type)
+
+        tgtBatch = None
+        if tgtData is not None:
+            tgtBatch = self._batchify(tgtData, dtype="text")
+
+        return srcBatch, torch.LongTensor(lengths), tgtBatch, tuple(indices)
+
+    def wrap(self, collated):
+        "Ship a collated batch to the device and wrap it in Variables."
+        return wrapBatch(collated, self.cuda, self.volatile)
+
+    def __getitem__(self, index):
+        return self.wrap(self.collate(index))
 
     def __len__(self):
         return self.numBatches
 
-    def shuffle(self):
-        data = list(zip(self.src, self.tgt))
-        self.src, self.tgt = zip(*[data[i] for i in torch.randperm(len(data))])
+    def _lengthBuckets(self):
+        # example indices grouped by source length, built once
+        if self.buckets is None:
+            self.buckets = dict()
+            for i in range(self.fullSize):
+                self.buckets.setdefault(self._srcLength(i), []).append(i)
+        return self.buckets
+
+    def shuffle(self, seed=None, epoch=0):
+        """
+        Shuffle the examples inside every source length bucket and re-assign
+        the mini-batches. Only the index arrays are permuted (the tensors are
+        left untouched) and the new order only depends on (seed, epoch).
+        """
+        if seed is None:
+            seed = torch.initial_seed()
+        rng = random.Random(seed * 1000003 + epoch)
+
+        buckets = self._lengthBuckets()
+        order = []
+        for length in sorted(buckets):
+            bucket = list(buckets[length])
+            rng.shuffle(bucket)
+            order.extend(bucket)
+        self.order = order
+
+        if self.balance:
+            self.allocateBatch()
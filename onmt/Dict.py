@@ -1,3 +1,4 @@
+import hashlib
 import torch
 
 
@@ -37,6 +38,17 @@ class Dict(object):
 
         file.close()
 
+    def checksum(self):
+        "A hash of the entries, changes whenever an index would change."
+        h = hashlib.md5()
+        h.update(('lower=%s\n' % self.lower).encode('utf-8'))
+        for i in range(self.size()):
+            label = self.idxToLabel[i]
+            if not isinstance(label, bytes):
+                label = label.encode('utf-8')
+            h.update(label + b'\n')
+        return h.hexdigest()
+
     def lookup(self, key, default=None):
         key = key.lower() if self.lower else key
         try:
@@ -60,8 +72,11 @@ class Dict(object):
         for label in labels:
             self.addSpecial(label)
 
-    def add(self, label, idx=None):
-        "Add `label` in the dictionary. Use `idx` as its index if given."
+    def add(self, label, idx=None, count=1):
+        """
+        Add `label` in the dictionary. Use `idx` as its index if given.
+        `count` is added to its frequency.
+        """
         label = label.lower() if self.lower else label
         if idx is not None:
             self.idxToLabel[idx] = label
@@ -75,9 +90,9 @@ class Dict(object):
                 self.labelToIdx[label] = idx
 
         if idx not in self.frequencies:
-            self.frequencies[idx] = 1
+            self.frequencies[idx] = count
         else:
-            self.frequencies[idx] += 1
+            self.frequencies[idx] += count
 
         return idx
 
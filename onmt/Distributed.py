@@ -0,0 +1,153 @@
+"""
+Multi-process data-parallel training with torch.distributed. Every process
+(rank) holds a full copy of the model and trains on its own slice of the
+batch schedule; the gradients are averaged over all ranks before every
+update, so the copies stay identical. The gloo backend runs on CPU, over
+localhost or TCP between several machines.
+"""
+from __future__ import division
+
+import os
+import sys
+import multiprocessing
+
+import torch
+import torch.distributed as dist
+from torch.autograd import Variable
+
+
+def isDistributed(opt):
+    return getattr(opt, 'world_size', 1) > 1
+
+
+def isMaster(opt):
+    "Only the first rank logs, evaluates and writes checkpoints."
+    return not isDistributed(opt) or opt.rank == 0
+
+
+def _run(main, opt, rank):
+    opt.rank = rank
+    main()
+
+
+def launch(main, opt):
+    """
+    Run main() in opt.world_size processes on this machine, one per rank,
+    and wait for all of them.
+    """
+    processes = []
+    for rank in range(opt.world_size):
+        process = multiprocessing.Process(target=_run, args=(main, opt, rank))
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+
+    failed = [rank for rank, process in enumerate(processes)
+              if process.exitcode != 0]
+    if failed:
+        raise RuntimeError('Training processes %s failed' %
+                           ', '.join(str(rank) for rank in failed))
+
+
+def initialize(opt):
+    """
+    Join the process group. With -gpus, every rank uses one of the listed
+    devices; the output of all ranks but the first is discarded.
+    """
+    if opt.gpus:
+        opt.gpus = [opt.gpus[opt.rank % len(opt.gpus)]]
+        torch.cuda.set_device(opt.gpus[0])
+
+    dist.init_process_group(backend=opt.dist_backend,
+                            init_method=opt.dist_init,
+                            world_size=opt.world_size,
+                            rank=opt.rank)
+
+    if opt.rank > 0:
+        sys.stdout = open(os.devnull, 'w')
+
+
+def scheduleSlice(schedule, opt):
+    """
+    The part of the (set, batch) schedule trained by this rank: every
+    world_size-th entry starting at the rank. The schedule is cut to a
+    multiple of world_size so that all ranks make the same number of
+    updates (and all-reduce calls).
+    """
+    if not isDistributed(opt):
+        return schedule
+    end = len(schedule) // opt.world_size * opt.world_size
+    return schedule[opt.rank:end:opt.world_size]
+
+
+def broadcastParameters(model):
+    "Start all ranks from the parameters of the first rank."
+    for p in model.parameters():
+        dist.broadcast(p.data, 0)
+
+
+def allReduceGradients(params, opt, sparseParams=()):
+    """
+    Average the gradients over all ranks with one all_reduce of a flat
+    buffer, after a small one of the parameters that have a gradient. A
+    parameter gets a gradient if one rank has one, counting as zero on the
+    ranks without; the parameters that no rank has a
+    gradient for (the modules of the languages that are in no batch) keep
+    none and are not updated, as in a single process.
+
+    The sparse gradients (sparseParams) are reduced dense, the ranks
+    touch different rows, and made sparse again on the rows of the sum.
+    """
+    if not isDistributed(opt):
+        return
+
+    params = list(params)
+    if not params:
+        return
+
+    # which parameters have a gradient on some rank, before the gradients
+    hasGrad = params[0].data.new(len(params)).zero_()
+    for i, p in enumerate(params):
+        if p.grad is not None:
+            hasGrad[i] = 1
+    dist.all_reduce(hasGrad)
+
+    grads = []
+    for p, flag in zip(params, hasGrad.tolist()):
+        if flag == 0:
+            p.grad = None
+            continue
+        if p.grad is None:
+            p.grad = Variable(p.data.new(p.size()).zero_())
+        elif p.grad.data.is_sparse:
+            p.grad = Variable(p.grad.data.to_dense())
+        grads.append(p.grad.data)
+    if not grads:
+        return
+
+    flat = torch.cat([g.contiguous().view(-1) for g in grads], 0)
+    dist.all_reduce(flat)
+    flat.div_(opt.world_size)
+
+    offset = 0
+    for g in grads:
+        n = g.numel()
+        g.copy_(flat[offset:offset + n].view_as(g))
+        offset += n
+
+    for p in sparseParams:
+        if p.grad is not None:
+            p.grad = _sparseRows(p.grad.data)
+
+
+def _sparseRows(dense):
+    "Sparse gradient of the non-zero rows of a dense one (None if all zero)."
+    rows = dense.abs().sum(1).view(-1).ne(0).nonzero().view(-1)
+    if rows.numel() == 0:
+        return None
+    sparseType = getattr(torch.cuda.sparse if dense.is_cuda else torch.sparse,
+                         type(dense).__name__)
+    return Variable(sparseType(rows.view(1, -1), dense.index_select(0, rows),
+                               dense.size()))
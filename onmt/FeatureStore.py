@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import torch
+
+
+class FeatureStore(object):
+    """
+    Read-only store of the CNN feature maps written by
+    tools/extract_img_features.py:
+
+      prefix.feats     all feature maps as one flat float32 array
+      prefix.index.pt  {'names', 'offsets', 'shapes'} of every image
+
+    The array is memory-mapped, so only the feature maps that are read are
+    loaded from disk.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = os.path.abspath(prefix)
+        index = torch.load(self.prefix + '.index.pt')
+        self.names = index['names']
+        self.offsets = index['offsets']
+        self.shapes = [tuple(s) for s in index['shapes']]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.data = np.memmap(self.prefix + '.feats', dtype=np.float32,
+                              mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, name):
+        return self.ids.get(name)
+
+    def width(self, i):
+        return self.shapes[i][2]
+
+    def __getitem__(self, i):
+        shape = self.shapes[i]
+        size = shape[0] * shape[1] * shape[2]
+        offset = self.offsets[i]
+        # copy out of the memory map
+        array = np.array(self.data[offset:offset + size]).reshape(shape)
+        return torch.from_numpy(array)
+
+
+class FeatureSequence(object):
+    """
+    The feature maps of a list of images of a FeatureStore, used in place of
+    the list of image tensors of a dataset. Only the store prefix and the
+    ids are pickled, the store is opened again on first use.
+    """
+
+    def __init__(self, prefix, ids):
+        self.prefix = os.path.abspath(prefix)
+        self.ids = list(ids)
+        self.store = None
+
+    def _open(self):
+        if self.store is None:
+            self.store = FeatureStore(self.prefix)
+        return self.store
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self._open()[self.ids[i]]
+
+    def width(self, i):
+        return self._open().width(self.ids[i])
+
+    def __getstate__(self):
+        return {'prefix': self.prefix, 'ids': self.ids}
+
+    def __setstate__(self, state):
+        self.prefix = state['prefix']
+        self.ids = state['ids']
+        self.store = None
@@ -0,0 +1,80 @@
+from __future__ import division
+
+import numpy as np
+
+# the machine precision cutoff of lstsq, rcond=None needs numpy >= 1.14
+_RCOND = None if np.lib.NumpyVersion(np.__version__) >= '1.14.0' else -1
+
+
+class MemoryBudget(object):
+    """
+    Split the batches into as few micro-batches as fit a memory budget.
+
+    The peak memory of a training step is modelled as
+
+        peak = a + b * B * Tsrc + c * B * Ttgt
+
+    (B sentences, padded to Tsrc source and Ttgt target tokens), the
+    coefficients being fitted by least squares to the peaks measured by a
+    short calibration run (add() then fit()). The memory allocated after
+    the calibration, like the optimizer state of the first update, is
+    added to a by fit(constant).
+
+    The sentences of a batch are sorted by decreasing source length, so
+    the micro-batches are runs of consecutive sentences: every one is
+    extended greedily while its predicted peak stays below the budget,
+    which gives the smallest number of micro-batches.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.samples = []
+        self.coefs = None
+
+    def add(self, batchSize, srcLength, tgtLength, peak):
+        "The peak memory (bytes) measured for one batch shape."
+        self.samples.append((batchSize, srcLength, tgtLength, peak))
+
+    def fit(self, constant=0):
+        samples = np.array(self.samples, dtype=np.float64)
+        B, Ts, Tt, peak = samples.T
+        design = np.stack([np.ones_like(B), B * Ts, B * Tt], 1)
+        coefs = np.linalg.lstsq(design, peak, rcond=_RCOND)[0]
+        # the memory cannot shrink with the batch, noise aside
+        self.coefs = ([float(coefs[0]) + constant] +
+                      [max(float(c), 0.0) for c in coefs[1:]])
+        return self.coefs
+
+    def predict(self, batchSize, srcLength, tgtLength):
+        a, b, c = self.coefs
+        return a + batchSize * (b * srcLength + c * tgtLength)
+
+    def split(self, srcLengths, tgtLengths):
+        """
+        (start, end) of the micro-batches of a batch with these sentence
+        lengths (lists). A sentence over the budget on its own is still a
+        micro-batch.
+        """
+        splits = []
+        start = 0
+        n = len(srcLengths)
+        while start < n:
+            srcLength, tgtLength = srcLengths[start], tgtLengths[start]
+            end = start + 1
+            while end < n:
+                nextSrc = max(srcLength, srcLengths[end])
+                nextTgt = max(tgtLength, tgtLengths[end])
+                if self.predict(end + 1 - start, nextSrc, nextTgt) > self.budget:
+                    break
+                srcLength, tgtLength = nextSrc, nextTgt
+                end += 1
+            splits.append((start, end))
+            start = end
+        return splits
+
+    def __repr__(self):
+        a, b, c = self.coefs
+        return ('peak = %.0f MB + %.2f KB x B x Tsrc + %.2f KB x B x Ttgt '
+                '(budget %.0f MB, %d samples)'
+                % (a / 2 ** 20, b / 2 ** 10, c / 2 ** 10,
+                   self.budget / 2 ** 20, len(self.samples)))
@@ -0,0 +1,103 @@
+from __future__ import division
+
+import torch.nn as nn
+
+
+def _unwrap(module):
+    return module.module if isinstance(module, nn.DataParallel) else module
+
+
+class ModelAverage(object):
+    """
+    An average of the weights kept during training, the online
+    counterpart of average_models.py.
+
+    Every `every` optimizer steps the average is moved towards the current
+    weights in place: avg = decay * avg + (1 - decay) * param.
+    With `window` > 0 the average is the plain mean of the first `window`
+    updates and then an exponential average with a memory of about
+    `window` updates (decay = 1 - 1/window). Otherwise `decay` is used,
+    shortened at the start of training as (1 + n) / (10 + n).
+
+    The averaged weights live on the device of the model. They are saved
+    in the checkpoints as 'model_ema' and 'generator_ema', in the format
+    of 'model' and 'generator'.
+    """
+
+    def __init__(self, model, generator, decay=0.9999, window=0, every=1):
+        self.modules = [_unwrap(model), _unwrap(generator)]
+        self.decay = decay
+        self.window = window
+        self.every = max(1, every)
+        self.steps = 0
+        self.updates = 0
+
+        # id(param) -> (param, averaged weights), shared weights only once
+        self.shadow = dict()
+        for module in self.modules:
+            for p in module.parameters():
+                if id(p) not in self.shadow:
+                    self.shadow[id(p)] = (p, p.data.clone())
+
+    def step(self):
+        "Called after every optimizer step."
+        self.steps += 1
+        if self.steps % self.every != 0:
+            return
+
+        self.updates += 1
+        if self.window > 0:
+            decay = 1.0 - 1.0 / min(self.updates, self.window)
+        else:
+            decay = min(self.decay, (1.0 + self.updates) / (10.0 + self.updates))
+
+        for p, avg in self.shadow.values():
+            avg.mul_(decay).add_(1.0 - decay, p.data)
+
+    def swap(self):
+        """
+        Exchange the trained and the averaged weights of the model.
+        Calling it again restores the trained weights.
+        """
+        for p, avg in self.shadow.values():
+            trained = p.data.clone()
+            p.data.copy_(avg)
+            avg.copy_(trained)
+
+    def _keys(self, module):
+        "(state dict key, averaged weights) of the parameters of module."
+        for name, sub in module.named_modules():
+            for pname, p in sub._parameters.items():
+                if p is not None and id(p) in self.shadow:
+                    key = name + '.' + pname if name else pname
+                    yield key, self.shadow[id(p)][1]
+
+    def state_dicts(self):
+        "The averaged model and generator state dicts, as in the checkpoints."
+        states = []
+        for module in self.modules:
+            state = module.state_dict()
+            for key, avg in self._keys(module):
+                if key in state:
+                    state[key] = avg
+            states.append(state)
+
+        model_state, generator_state = states
+        model_state = {k: v for k, v in model_state.items()
+                       if 'generator' not in k}
+        return model_state, generator_state
+
+    def saveTo(self, checkpoint):
+        model_state, generator_state = self.state_dicts()
+        checkpoint['model_ema'] = model_state
+        checkpoint['generator_ema'] = generator_state
+        checkpoint['ema_updates'] = self.updates
+
+    def loadFrom(self, checkpoint):
+        "Continue the average saved in a checkpoint."
+        for module, state in zip(self.modules, [checkpoint['model_ema'],
+                                                checkpoint['generator_ema']]):
+            for key, avg in self._keys(module):
+                if key in state:
+                    avg.copy_(state[key])
+        self.updates = checkpoint.get('ema_updates', 0)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import onmt.modules
+from onmt.Profiler import Profiler
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 from torch.nn.utils.rnn import pack_padded_sequence as pack
 
@@ -142,6 +143,9 @@ class NMTModel(nn.Module):
         super(NMTModel, self).__init__()
         self.encoder = encoder
         self.decoder = decoder
+        
+        # phase timing of the training steps, disabled by default
+        self.profiler = Profiler()
 
     def make_init_decoder_output(self, context):
         batch_size = context.size(1)
@@ -172,8 +176,11 @@ class NMTModel(nn.Module):
     # A function to sample from a pre-computed context 
     # We need the context, the initial hidden layer, the initial state (for input feed) and an initial input
     # Options are: using argmax or stochastic, and to save the stochastic actions for reinforcement learning
+    # With stochastic sampling, the last n_greedy sentences of the batch are decoded with argmax
+    # The finished sentences are removed from the decoder batch; the samples (PAD after <EOS>)
+    # and their log-probs (0 after <EOS>) are put back into T x B at the end
     def sample_from_context(self, context, init_state, init_hiddens, init_input, 
-                                max_length=50, save=False, argmax=True):
+                                max_length=50, save=False, argmax=True, n_greedy=0):
                         
         hidden = init_hiddens
         state = init_state
@@ -182,8 +189,6 @@ class NMTModel(nn.Module):
         # we start from the vector of <BOS>                                
         input_t = init_input
         
-        sampled = []
-        
         # if we don't save then create volatile variables
         # to save memory
         if not save:
@@ -198,15 +203,14 @@ class NMTModel(nn.Module):
             state = Variable(state.data, volatile=True)
             input_t = Variable(input_t.data, volatile=True)
         
-        eos_check = init_input[0].data.byte().new(batch_size, 1).zero_()
-                        
-        pad_mask = init_input[0].data.byte().new(batch_size, 1).zero_()
-        
-        accumulated_logprob = None
-        
-        log_probs = []
-        
+        # batch indices of the sentences still being decoded
+        # (the greedy ones stay at the end of the batch)
+        active = torch.arange(0, batch_size).type_as(init_input.data)
+        greedy_start = batch_size - n_greedy
+        n_greedy_active = n_greedy
         
+        # (active, samples, log-probs) of every time step
+        steps = []
         
         for t in xrange(max_length):
             # make a forward pass through the decoder
@@ -226,55 +230,110 @@ class NMTModel(nn.Module):
                 
                 sample = sample_.data
                 
+                if n_greedy_active > 0:
+                    n_active = sample.size(0)
+                    greedy_rows = sample.narrow(0, n_active - n_greedy_active, n_greedy_active)
+                    greedy_output = output.data.narrow(0, n_active - n_greedy_active, n_greedy_active)
+                    greedy_rows.copy_(torch.topk(greedy_output, 1, dim=1)[1])
+                
    
             # log_prob of action at time T
             
-            log_prob_t = output.gather(1, Variable(sample)).t() # 1 * batch_size
+            log_prob_t = output.gather(1, Variable(sample)).t() # 1 * n_active
                         
-            log_probs.append(log_prob_t) 
-            
-            # log prob of the samples
-            check = (sample == onmt.Constants.EOS)
+            steps.append((active, sample.t(), log_prob_t))
             
-            # update the <eos> check
-            eos_check |= check 
-            
-            # everything after <EOS> is masked as PAD
-            sample.masked_fill_(pad_mask, onmt.Constants.PAD)
+            if save:
+                assert argmax==False
             
-            # update the pad mask
-            pad_mask |= check
+            unfinished = sample.squeeze(1).ne(onmt.Constants.EOS)
+            n_unfinished = unfinished.sum()
+                            
+             # stop sampling when all sentences reach eos 
+            if n_unfinished == 0:
+                break
             
+            # the sentences that reached <EOS> are removed from the batch
+            if n_unfinished < sample.size(0):
+                keep = unfinished.nonzero().squeeze(1)
+                keep_var = Variable(keep)
+                active = active.index_select(0, keep)
+                if n_greedy > 0:
+                    n_greedy_active = active.ge(greedy_start).sum()
+                
+                hidden = tuple(h.index_select(1, keep_var) for h in hidden)
+                state = state.index_select(0, keep_var)
+                context = context.index_select(1, keep_var)
+                sample = sample.index_select(0, keep)
             
             # note: one of the important steps here
             # is to generate the data (tensor) 
             # before making the actual variable
             input_t = Variable(sample.t(), volatile=(not save))
-           
-            sampled.append(input_t)
-
-            if save:
-                assert argmax==False
-                            
-             # stop sampling when all sentences reach eos 
-            if eos_check.sum() == batch_size:
-                break
         
+        # scatter the steps back into one single T x B Tensor
+        sampled = init_input.data.new(len(steps), batch_size).fill_(onmt.Constants.PAD)
+        
+        log_probs = []
+        
+        for t, (idx, sample_t, log_prob_t) in enumerate(steps):
+            sampled[t].index_copy_(0, idx, sample_t[0])
+            
+            log_prob_full = Variable(log_prob_t.data.new(1, batch_size).zero_(), 
+                                     volatile=(not save))
+            log_probs.append(log_prob_full.index_add(1, Variable(idx), log_prob_t))
         
-        # we concatenate them into one single Tensor                                 
-        sampled = torch.cat(sampled, 0) # T x B
+        sampled = Variable(sampled, volatile=(not save))
         
         log_probs = torch.cat(log_probs, 0) # T x B
         
         
         return sampled, log_probs
 
+    # Generator, log-softmax and NLL of the targets, timestep_group steps at a
+    # time: only one chunk of log-probs (steps x B x V) exists at any time.
+    # With backward, the gradients of the chunks are accumulated on detached
+    # decoder states and sent through the decoder and encoder once at the end.
+    # Returns the summed loss and the number of target words.
+    def chunked_loss(self, hiddens, targets, criterion, normalizer=1,
+                     backward=False, timestep_group=8):
+        
+        hiddens_ = Variable(hiddens.data, requires_grad=backward,
+                            volatile=(not backward))
+        loss = 0
+        
+        for hidden_group, target_group in zip(torch.split(hiddens_, timestep_group),
+                                              torch.split(targets, timestep_group)):
+            output_group = self.generator(hidden_group.view(-1, hidden_group.size(2)))
+            loss_group = criterion(output_group, target_group.contiguous().view(-1))
+            loss += loss_group.data[0]
+            if backward:
+                loss_group.div(normalizer).backward()
+        
+        # (with backward, the generator backward is included)
+        self.profiler.mark('generator_loss')
+        
+        if backward:
+            hiddens.backward(hiddens_.grad.data)
+            self.profiler.mark('backward')
+        
+        num_words = targets.data.ne(onmt.Constants.PAD).sum()
+        
+        return loss, num_words
+
     # Forward pass :
     # Two (or more) modes: Cross Entropy or Reinforce
-    def forward(self, input, mode='xe', max_length=50, gen_greedy=True, timestep_group=8):
+    # mode='xe_loss' returns (loss, number of words), the log-probs of the
+    # whole batch are never built, see chunked_loss
+    # mode='rf' draws n_samples samples for every source (sample k of source b
+    # is column k * batch_size + b), decoded in one batch with the greedy
+    # baseline if gen_greedy
+    def forward(self, input, mode='xe_loss', max_length=50, gen_greedy=True, timestep_group=8,
+                criterion=None, normalizer=1, backward=False, n_samples=1):
         src = input[0]
         tgt = input[1][:-1]  # exclude last target from inputs
         enc_hidden, context = self.encoder(src)
+        self.profiler.mark('encoder')
         init_output = self.make_init_decoder_output(context)
 
         enc_hidden = (self._fix_enc_hidden(enc_hidden[0]),
@@ -291,48 +350,46 @@ class NMTModel(nn.Module):
         
         # Cross Entropy training:
         # Using teacher forcing and log-likelihood loss as normally
-        if mode == 'xe':
+        if mode == 'xe_loss':
             
-            # hiddens : final hidden states for decoder (before linear softmax)
-            # dec_hidden: lstm hidden states (c and h for each layer)
-            # _attn: attention weights 
-            #~ out, dec_hidden, _attn = self.decoder(tgt, enc_hidden,
-                                              #~ context, init_output)
             hiddens, dec_hidden, _attn = self.decoder(tgt, enc_hidden,
                   context, init_output)
+            self.profiler.mark('decoder')
             
-            # hiddens has size T * B * H
-            hiddens_split = torch.split(hiddens, timestep_group)
-            outputs = []
-            
-            # we group the computation for faster and more efficient GPU memory
-            for i, hidden_group in enumerate(hiddens_split):
-                    
-                n_steps = hidden_group.size(0)
-                hidden_group = hidden_group.view(-1, hidden_group.size(2))
-                output_group = self.generator(hidden_group)
-                output_group = output_group.view(n_steps, -1, output_group.size(1))
-                outputs.append(output_group)
-            
-            # concatenate into one single tensor
-            outputs = torch.cat(outputs, 0)
+            # exclude <s> from targets
+            targets = input[1][1:]
             
-            states = hiddens            
-         
-            return outputs, states
+            return self.chunked_loss(hiddens, targets, criterion, normalizer=normalizer,
+                                     backward=backward, timestep_group=timestep_group)
         elif mode == 'rf':
             
             # initial token (BOS)
             init_input = self.make_init_input(src)
             
+            # the encoder states are repeated for the samples 
+            # and the greedy baseline (the last batch_size sentences)
+            n_greedy = batch_size if gen_greedy else 0
+            n_copies = n_samples + (1 if gen_greedy else 0)
+            if n_copies > 1:
+                context = context.repeat(1, n_copies, 1)
+                enc_hidden = tuple(h.repeat(1, n_copies, 1) for h in enc_hidden)
+                init_output = init_output.repeat(n_copies, 1)
+                init_input = init_input.repeat(1, n_copies)
+            
             # save=True so that the stochastic actions will be saved for the backward pass
-            rl_samples, logprobs = self.sample_from_context(context, init_output, enc_hidden, 
-                                            init_input, argmax=False, max_length=min(length + 5, 51), save=True)
-            # By default: the baseline is the samples from greedy search
+            samples, logprobs = self.sample_from_context(context, init_output, enc_hidden, 
+                                            init_input, argmax=False, max_length=min(length + 5, 51), save=True,
+                                            n_greedy=n_greedy)
+            
+            self.profiler.mark('sampling')
             
+            n_sampled = n_samples * batch_size
+            rl_samples = samples[:, :n_sampled]
+            logprobs = logprobs[:, :n_sampled]
+            
+            # By default: the baseline is the samples from greedy search
             if gen_greedy:
-                greedy_samples,  _ = self.sample_from_context(context, init_output, enc_hidden, 
-                                                    init_input, argmax=True, max_length=min(length + 5, 51))                                                                                                                                                                 
+                greedy_samples = samples[:, n_sampled:]
                 return rl_samples, greedy_samples, logprobs
             else:
                 return rl_samples, logprobs
@@ -23,6 +23,7 @@ class TranslatorParameter(object):
         self.src_lang = ""
         self.tgt_lang = ""
         self.ensemble_op = "sum"
+        self.bpe_codes = ""
         
         self.readFile(filename)
 
@@ -44,6 +45,8 @@ class TranslatorParameter(object):
                 self.src_lang = w[1]
             elif(w[0] == "tgt_lang"):
                 self.tgt_lang = w[1]
+            elif(w[0] == "bpe_codes"):
+                self.bpe_codes = w[1]
 
             line = f.readline()
 
@@ -52,10 +55,17 @@ class OnlineTranslator(object):
     def __init__(self,model):
         opt = TranslatorParameter(model)
         self.translator = onmt.Translator(opt)
+        self.bpe = onmt.BPE(opt.bpe_codes) if opt.bpe_codes else None
     
 
     def translate(self,input):
-        predBatch, predScore, goldScore = self.translator.translate([input.split()],[])
-        return " ".join(predBatch[0][0])
+        srcTokens = input.split()
+        if self.bpe is not None:
+            srcTokens = self.bpe.segmentTokens(srcTokens)
+        predBatch, predScore, goldScore = self.translator.translate([srcTokens],[])
+        output = " ".join(predBatch[0][0])
+        if self.bpe is not None:
+            output = self.bpe.desegment(output)
+        return output
   
 
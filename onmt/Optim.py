@@ -1,22 +1,47 @@
 import torch.optim as optim
-from torch.nn.utils import clip_grad_norm
+from onmt.gradient_utils import clipGradNorm
 
 
 class Optim(object):
 
-    def set_parameters(self, params):
-        self.params = list(params)  # careful: params may be a generator
+    def _makeOptimizer(self, params, sparse=False):
         if self.method == 'sgd':
-            self.optimizer = optim.SGD(self.params, lr=self.lr)
+            return optim.SGD(params, lr=self.lr)
         elif self.method == 'adagrad':
-            self.optimizer = optim.Adagrad(self.params, lr=self.lr)
-        elif self.method == 'adadelta':
-            self.optimizer = optim.Adadelta(self.params, lr=self.lr)
+            return optim.Adagrad(params, lr=self.lr)
+        elif self.method == 'adadelta' and not sparse:
+            return optim.Adadelta(params, lr=self.lr)
+        elif self.method == 'adam' and sparse:
+            # lazy Adam: only the moments of the rows in the batch are updated
+            return optim.SparseAdam(params, lr=self.lr)
         elif self.method == 'adam':
-            self.optimizer = optim.Adam(self.params, lr=self.lr)
+            return optim.Adam(params, lr=self.lr)
+        elif sparse:
+            raise RuntimeError("Optim method %s does not support sparse "
+                               "embeddings [sgd|adagrad|adam]" % self.method)
         else:
             raise RuntimeError("Invalid optim method: " + self.method)
 
+    def set_parameters(self, params, sparseParams=()):
+        """
+        sparseParams are the parameters with sparse gradients (the
+        embeddings of -sparse_embeddings), updated by their own optimizer
+        in time proportional to the rows of the batch.
+        """
+        self.params = list(params)  # careful: params may be a generator
+        sparseIDs = set(id(p) for p in sparseParams)
+        self.sparseParams = [p for p in self.params if id(p) in sparseIDs]
+        self.optimizer = self._makeOptimizer(
+            [p for p in self.params if id(p) not in sparseIDs])
+        self.sparseOptimizer = None
+        if self.sparseParams:
+            self.sparseOptimizer = self._makeOptimizer(self.sparseParams, sparse=True)
+
+    def _optimizers(self):
+        if self.sparseOptimizer is None:
+            return [self.optimizer]
+        return [self.optimizer, self.sparseOptimizer]
+
     def __init__(self, method, lr, max_grad_norm,
                  lr_decay=1, start_decay_at=None):
         self.last_ppl = None
@@ -27,11 +52,26 @@ class Optim(object):
         self.start_decay_at = start_decay_at
         self.start_decay = False
 
-    def step(self):
+    def __getstate__(self):
+        # the parameters and the optimizer are rebuilt by set_parameters,
+        # they are not saved with the checkpoints
+        state = self.__dict__.copy()
+        state.pop('params', None)
+        state.pop('sparseParams', None)
+        state.pop('optimizer', None)
+        state.pop('sparseOptimizer', None)
+        return state
+
+    def step(self, profiler=None):
         "Compute gradients norm."
         if self.max_grad_norm:
-            total_norm = clip_grad_norm(self.params, self.max_grad_norm)
-        self.optimizer.step()
+            total_norm = clipGradNorm(self.params, self.max_grad_norm)
+        if profiler is not None:
+            profiler.mark('clip_grad_norm')
+        for optimizer in self._optimizers():
+            optimizer.step()
+        if profiler is not None:
+            profiler.mark('optimizer')
         return total_norm
 
     def updateLearningRate(self, ppl, epoch):
@@ -50,14 +90,15 @@ class Optim(object):
             print("Decaying learning rate to %g" % self.lr)
 
         self.last_ppl = ppl
-        self.optimizer.param_groups[0]['lr'] = self.lr
-		
+        for optimizer in self._optimizers():
+            optimizer.param_groups[0]['lr'] = self.lr
+
     def get_learning_rate(self):
-				
-				return self.optimizer.param_groups[0]['lr']
-				
+
+        return self.optimizer.param_groups[0]['lr']
+
     def set_learning_rate(self, lr):
-				
-				self.lr = lr
-				self.optimizer.param_groups[0]['lr'] = lr
-				
+
+        self.lr = lr
+        for optimizer in self._optimizers():
+            optimizer.param_groups[0]['lr'] = lr
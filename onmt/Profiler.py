@@ -0,0 +1,130 @@
+from __future__ import division
+
+import os
+import json
+import time
+from collections import OrderedDict
+
+import torch
+
+
+class Profiler(object):
+    """
+    Opt-in timing of the phases of the training steps.
+
+    The phases are laps: mark(name) adds the time since the previous mark
+    to `name`, so every step needs one call per phase. With a device the
+    queued kernels are waited for (torch.cuda.synchronize) before reading
+    the clock, which serializes the GPU; the profiler is meant for
+    diagnosis runs. Disabled (no output file), every call returns at once.
+
+    Every `interval` steps the mean time per step of every phase, the
+    tokens per step, the padding ratios and the throughput are written to
+    `output`: a JSON line appended per interval ('json'), or a text file
+    in the Prometheus exposition format replaced per interval
+    ('prometheus', for the node exporter textfile collector).
+    """
+
+    def __init__(self, output=None, format='json', interval=100, cuda=False):
+        self.enabled = bool(output)
+        self.output = output
+        self.format = format
+        self.interval = max(1, interval)
+        self.cuda = cuda
+        self.totalSteps = 0
+        self.last = None
+
+        if format not in ('json', 'prometheus'):
+            raise ValueError('Profile format needs to be "json" or "prometheus", '
+                             'the current value is %s' % format)
+        self.reset()
+
+    def reset(self):
+        self.phases = OrderedDict()
+        self.steps = 0
+        self.tokens = [0, 0]
+        self.padded = [0, 0]
+        self.intervalStart = time.time()
+
+    def _now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.time()
+
+    def start(self):
+        "Start the clock, before the first step."
+        if not self.enabled:
+            return
+        self.last = self._now()
+        self.intervalStart = self.last
+
+    def mark(self, name):
+        "Add the time since the previous mark to phase `name`."
+        if not self.enabled:
+            return
+        now = self._now()
+        if self.last is not None:
+            self.phases[name] = self.phases.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, srcTokens, srcPadded, tgtTokens, tgtPadded):
+        "Real and padded (batch x length) token counts of a batch."
+        if not self.enabled:
+            return
+        self.tokens[0] += srcTokens
+        self.tokens[1] += tgtTokens
+        self.padded[0] += srcPadded
+        self.padded[1] += tgtPadded
+
+    def endStep(self):
+        if not self.enabled:
+            return
+        self.mark('other')
+        self.steps += 1
+        self.totalSteps += 1
+        if self.steps >= self.interval:
+            self.write()
+            self.reset()
+
+    def report(self):
+        elapsed = max(time.time() - self.intervalStart, 1e-9)
+        steps = max(self.steps, 1)
+        report = OrderedDict()
+        report['time'] = time.time()
+        report['step'] = self.totalSteps
+        report['steps'] = self.steps
+        report['step_seconds'] = elapsed / steps
+        report['phase_seconds'] = OrderedDict((name, t / steps)
+                                              for name, t in self.phases.items())
+        for i, side in enumerate(['src', 'tgt']):
+            report[side + '_tokens_per_step'] = self.tokens[i] / steps
+            report[side + '_tokens_per_second'] = self.tokens[i] / elapsed
+            report[side + '_padding_ratio'] = (1.0 - self.tokens[i] / self.padded[i]
+                                               if self.padded[i] > 0 else 0.0)
+        return report
+
+    def write(self):
+        report = self.report()
+        if self.format == 'json':
+            with open(self.output, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+            return
+
+        lines = ['# TYPE onmt_steps_total counter',
+                 'onmt_steps_total %d' % report['step'],
+                 '# TYPE onmt_step_seconds gauge',
+                 'onmt_step_seconds %g' % report['step_seconds'],
+                 '# TYPE onmt_phase_seconds gauge']
+        for name, t in report['phase_seconds'].items():
+            lines.append('onmt_phase_seconds{phase="%s"} %g' % (name, t))
+        for metric in ['tokens_per_step', 'tokens_per_second', 'padding_ratio']:
+            lines.append('# TYPE onmt_%s gauge' % metric)
+            for side in ['src', 'tgt']:
+                lines.append('onmt_%s{side="%s"} %g' % (metric, side,
+                                                        report[side + '_' + metric]))
+
+        # replaced atomically, the collector never reads half a file
+        tmpName = self.output + '.tmp'
+        with open(tmpName, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmpName, self.output)
@@ -1,5 +1,6 @@
 import onmt
 import onmt.modules
+from onmt.Checkpoints import loadCheckpoint
 import torch.nn as nn
 import torch
 from torch.autograd import Variable
@@ -33,7 +34,7 @@ class Rescorer(object):
         nSets = 0
         
         for i, model in enumerate(models):
-            checkpoint = torch.load(model)
+            checkpoint = loadCheckpoint(model)
 
             model_opt = checkpoint['opt']
             
@@ -0,0 +1,229 @@
+from __future__ import division
+
+import os
+import bisect
+import threading
+from collections import OrderedDict
+
+import torch
+
+import onmt
+from onmt.Dataset import wrapBatch
+
+
+def countBatches(lengthCounts, batchSize):
+    """
+    Number of mini-batches Dataset.allocateBatch builds for a length sorted
+    shard, given the number of examples of each source length.
+    """
+    return sum((count + batchSize - 1) // batchSize
+               for count in lengthCounts.values())
+
+
+class ShardedPairDataset(object):
+    """
+    The training data of one language pair spread over all shards.
+    Batch indices are global: the batches of shard 0 come first, then the
+    batches of shard 1, and so on. The shard holding a batch is loaded
+    on demand by the parent ShardedDataset.
+    """
+
+    def __init__(self, parent, setID, batchCounts, maxLengths):
+        self.parent = parent
+        self.setID = setID
+        self.offsets = [0]
+        for count in batchCounts:
+            self.offsets.append(self.offsets[-1] + count)
+        self.numBatches = self.offsets[-1]
+        self.maxLengths = maxLengths
+        self.shuffleState = None
+
+    def __len__(self):
+        return self.numBatches
+
+    def locate(self, index):
+        "Map a global batch index to (shard, local batch index)."
+        shard = bisect.bisect_right(self.offsets, index) - 1
+        return shard, index - self.offsets[shard]
+
+    def shardBatches(self, shard):
+        return range(self.offsets[shard], self.offsets[shard + 1])
+
+    def bufferSizes(self):
+        batchSize = self.parent.batchSize
+        maxSrc = max(l[0] for l in self.maxLengths)
+        maxTgt = max(l[1] for l in self.maxLengths)
+        return batchSize * maxSrc, batchSize * maxTgt
+
+    def shuffle(self, seed=None, epoch=0):
+        # applied to the shards when they are (or have been) loaded
+        self.shuffleState = (seed, epoch)
+        for shardSets in self.parent.residentShards():
+            shardSets[self.setID].shuffle(seed, epoch)
+
+    def collate(self, index, buffers=None):
+        shard, local = self.locate(index)
+        dataset = self.parent.shard(shard)[self.setID]
+        return dataset.collate(local, buffers=buffers)
+
+    def wrap(self, collated):
+        return wrapBatch(collated, self.parent.cuda)
+
+    def __getitem__(self, index):
+        return self.wrap(self.collate(index))
+
+
+class ShardedDataset(object):
+    """
+    Training data written by preprocess.py with -num_shards.
+
+    Behaves like the dictionary {setID: Dataset} used by the trainers, but
+    only keeps `maxResident` shards in memory. Every shard holds the same
+    fraction of every language pair, so the per-pair sampling proportions
+    are the same inside each shard as over the whole corpus. When a shard
+    is first read, the next shard of the epoch is loaded in the background.
+    """
+
+    def __init__(self, index, dataDir, batchSize, cuda, maxResident=3):
+        self.files = index['shards']
+        self.dataDir = dataDir
+        self.batchSize = batchSize
+        self.cuda = cuda
+        self.maxResident = max(2, maxResident)
+        self.numShards = len(self.files)
+        self.nSets = len(self.files[0])
+        self.sizes = index['sizes']
+
+        self.cache = OrderedDict()
+        self.loading = dict()
+        self.errors = dict()
+        self.lock = threading.Lock()
+        self.shardOrder = list(range(self.numShards))
+
+        self.sets = dict()
+        for i in range(self.nSets):
+            batchCounts = [countBatches(index['lengthCounts'][k][i], batchSize)
+                           for k in range(self.numShards)]
+            maxLengths = [index['maxLengths'][k][i]
+                          for k in range(self.numShards)]
+            self.sets[i] = ShardedPairDataset(self, i, batchCounts, maxLengths)
+
+    # dictionary interface used by the trainers
+    def __getitem__(self, setID):
+        return self.sets[setID]
+
+    def __iter__(self):
+        return iter(self.sets)
+
+    def __len__(self):
+        return len(self.sets)
+
+    def residentShards(self):
+        with self.lock:
+            return list(self.cache.values())
+
+    def _load(self, shard):
+        shardSets = dict()
+        for i in range(self.nSets):
+            data = torch.load(os.path.join(self.dataDir, self.files[shard][i]))
+            dataset = onmt.Dataset(data['src'], data['tgt'],
+                                   self.batchSize, self.cuda)
+            if self.sets[i].shuffleState is not None:
+                dataset.shuffle(*self.sets[i].shuffleState)
+            shardSets[i] = dataset
+        return shardSets
+
+    def _loadInto(self, shard, event):
+        try:
+            shardSets, error = self._load(shard), None
+        except Exception as e:
+            shardSets, error = None, e
+        with self.lock:
+            del self.loading[shard]
+            if error is None:
+                self.cache[shard] = shardSets
+                while len(self.cache) > self.maxResident:
+                    self.cache.popitem(last=False)
+            else:
+                self.errors[shard] = error
+        event.set()
+
+    def _request(self, shard, background):
+        """
+        Start loading `shard` unless it is resident or already loading.
+        Returns the event to wait for, or None if it is resident.
+        """
+        with self.lock:
+            if shard in self.cache:
+                # mark as most recently used
+                self.cache[shard] = self.cache.pop(shard)
+                return None
+            if shard in self.loading:
+                return self.loading[shard]
+            event = threading.Event()
+            self.loading[shard] = event
+
+        if background:
+            thread = threading.Thread(target=self._loadInto,
+                                      args=(shard, event))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._loadInto(shard, event)
+        return event
+
+    def shard(self, shard):
+        "The {setID: Dataset} of `shard`, loaded if necessary."
+        shardSets = None
+        while shardSets is None:
+            event = self._request(shard, background=False)
+            if event is not None:
+                event.wait()
+            with self.lock:
+                if shard in self.errors:
+                    raise self.errors.pop(shard)
+                # None if it was evicted right away, then it is read again
+                shardSets = self.cache.get(shard)
+
+        # read ahead the shard that comes next in this epoch
+        position = self.shardOrder.index(shard)
+        if position + 1 < self.numShards:
+            self._request(self.shardOrder[position + 1], background=True)
+            self._request(shard, background=False)
+
+        return shardSets
+
+    def batchOrder(self, curriculum=False, rng=None):
+        """
+        Shard-major batch order for each pair: the shards are visited in the
+        same (random) order by every pair and the batches are shuffled inside
+        each shard, so that only a few shards are needed at any time.
+        The shuffles use `rng` (a random.Random) if given, else torch.
+        """
+        def permutation(n):
+            if rng is None:
+                return torch.randperm(n)
+            order = list(range(n))
+            rng.shuffle(order)
+            return torch.LongTensor(order)
+
+        if curriculum:
+            self.shardOrder = list(range(self.numShards))
+        else:
+            self.shardOrder = permutation(self.numShards).tolist()
+
+        batchOrder = dict()
+        for i in self.sets:
+            order = []
+            for shard in self.shardOrder:
+                batches = torch.LongTensor(list(self.sets[i].shardBatches(shard)))
+                if len(batches) == 0:
+                    continue
+                if not curriculum:
+                    batches = batches[permutation(len(batches))]
+                order.append(batches)
+            batchOrder[i] = torch.cat(order, 0) if order else torch.LongTensor()
+
+        # warm up the first shard
+        self._request(self.shardOrder[0], background=True)
+        return batchOrder
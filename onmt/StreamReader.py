@@ -0,0 +1,108 @@
+"""
+Streaming input for translate.py and rescore.py: the files are read line by
+line, so the memory does not depend on the size of the input.
+"""
+
+
+def _split(line):
+    return line.split()
+
+
+def readRecords(srcFile, tgtFile=None, tokenize=None):
+    """
+    Yield (index, srcTokens, tgtTokens) for every line of srcFile, tgtTokens
+    is None without tgtFile.
+    """
+    tokenize = tokenize or _split
+    tgtF = open(tgtFile) if tgtFile else None
+    try:
+        with open(srcFile) as srcF:
+            for index, line in enumerate(srcF):
+                tgtTokens = tokenize(tgtF.readline()) if tgtF else None
+                yield index, tokenize(line), tgtTokens
+    finally:
+        if tgtF:
+            tgtF.close()
+
+
+def readBatches(records, batchSize, readAhead=1):
+    """
+    Group the records into batches of batchSize. With readAhead > 1,
+    readAhead batches worth of records are read at a time and sorted by
+    source length first, so the batches need less padding; the records then
+    come out of order (see ReorderBuffer).
+    """
+    window = []
+
+    def flush():
+        if readAhead > 1:
+            window.sort(key=lambda record: len(record[1]))
+        return [window[i:i + batchSize]
+                for i in range(0, len(window), batchSize)]
+
+    for record in records:
+        window.append(record)
+        if len(window) == batchSize * readAhead:
+            for batch in flush():
+                yield batch
+            window = []
+
+    for batch in flush():
+        yield batch
+
+
+def readNBest(srcFile, nbestFile, tokenize=None):
+    """
+    Yield (id, srcTokens, hypotheses) for every source sentence having
+    entries in a Moses n-best list ("id ||| hypothesis ||| scores ..."),
+    hypotheses being a list of (hypothesis, scores). Only the next line of
+    the n-best list is read ahead.
+    """
+    tokenize = tokenize or _split
+    with open(srcFile) as srcF, open(nbestFile) as nbestF:
+        nextLine = nbestF.readline()
+        for sentID, srcLine in enumerate(srcF):
+            hypotheses = []
+            while nextLine:
+                parts = nextLine.strip().split(" ||| ")
+                hypID = int(parts[0].strip())
+                if hypID != sentID:
+                    assert hypID > sentID, \
+                        "The n-best list is not sorted by sentence id"
+                    break
+                hypotheses.append((parts[1].strip(),
+                                   parts[2] if len(parts) > 2 else ""))
+                nextLine = nbestF.readline()
+
+            if len(hypotheses) > 0:
+                yield sentID, tokenize(srcLine), hypotheses
+
+            if not nextLine:
+                break
+
+
+class ReorderBuffer(object):
+    """
+    Restore the input order of results computed out of order: `write` is
+    called with (index, item) in index order as soon as all the previous
+    indices are done. At most `capacity` items wait in the buffer.
+    """
+
+    def __init__(self, write, capacity=None, start=0):
+        self.write = write
+        self.capacity = capacity
+        self.next = start
+        self.pending = dict()
+
+    def put(self, index, item):
+        self.pending[index] = item
+        while self.next in self.pending:
+            self.write(self.next, self.pending.pop(self.next))
+            self.next += 1
+        if self.capacity is not None and len(self.pending) > self.capacity:
+            raise RuntimeError('%d results are waiting for result %d' %
+                               (len(self.pending), self.next))
+
+    def close(self):
+        assert len(self.pending) == 0, \
+            'Result %d was never computed' % self.next
@@ -1,5 +1,6 @@
 import onmt
 import onmt.modules
+from onmt.Checkpoints import loadCheckpoint
 import torch.nn as nn
 import torch
 from torch.autograd import Variable
@@ -37,8 +38,8 @@ class Translator(object):
         for i, model in enumerate(models):
             if opt.verbose:
                 print('Loading model from %s' % opt.model)
-            checkpoint = torch.load(opt.model,
-                               map_location=lambda storage, loc: storage)
+            checkpoint = loadCheckpoint(opt.model,
+                                        map_location=lambda storage, loc: storage)
         
             if opt.verbose:
                 print('Done')
@@ -65,8 +66,15 @@ class Translator(object):
 
             generator = onmt.Models.Generator(model_opt, self.dicts['tgt'])
 
-            this_model.load_state_dict(checkpoint['model'])
-            generator.load_state_dict(checkpoint['generator'])
+            # the weight average kept during training (-ema_decay)
+            if getattr(opt, 'use_ema', False):
+                assert 'model_ema' in checkpoint, \
+                    "The checkpoint has no averaged weights, train with -ema_decay or -average_window"
+                this_model.load_state_dict(checkpoint['model_ema'])
+                generator.load_state_dict(checkpoint['generator_ema'])
+            else:
+                this_model.load_state_dict(checkpoint['model'])
+                generator.load_state_dict(checkpoint['generator'])
 
             if opt.cuda:
                 this_model.cuda()
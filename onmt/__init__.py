@@ -1,14 +1,26 @@
 import onmt.Constants
 import onmt.Models
+import onmt.gradient_utils
 from onmt.Translator import Translator
 from onmt.OnlineTranslator import OnlineTranslator
 from onmt.InplaceTranslator import InplaceTranslator
 from onmt.Dataset import Dataset
+from onmt.BatchPrefetcher import BatchPrefetcher
+from onmt.BatchScheduler import BatchScheduler
+from onmt.ShardedDataset import ShardedDataset
+from onmt.FeatureStore import FeatureStore, FeatureSequence
+from onmt.StreamReader import ReorderBuffer
+from onmt.Checkpoints import CheckpointWriter
+from onmt.ModelAverage import ModelAverage
+from onmt.Profiler import Profiler
+from onmt.MemoryBudget import MemoryBudget
 from onmt.Optim import Optim
 from onmt.Dict import Dict
+from onmt.BPE import BPE
+from onmt.CorpusFilter import CorpusFilter
 from onmt.Beam import Beam
 from onmt.Rescorer import Rescorer
 from onmt.trainer import Evaluator
 
 # For flake8 compatibility.
-__all__ = [onmt.Constants, onmt.Models, Translator, OnlineTranslator, InplaceTranslator, Rescorer, Dataset, Optim, Dict, Beam]
+__all__ = [onmt.Constants, onmt.Models, onmt.gradient_utils, Translator, OnlineTranslator, InplaceTranslator, Rescorer, Dataset, BatchPrefetcher, BatchScheduler, ShardedDataset, FeatureStore, FeatureSequence, ReorderBuffer, CheckpointWriter, ModelAverage, Profiler, MemoryBudget, Optim, Dict, BPE, CorpusFilter, Beam]
@@ -0,0 +1,48 @@
+from __future__ import division
+
+import math
+
+import torch.nn as nn
+from torch.autograd import Variable
+
+
+def sparseParameters(module):
+    "The parameters of the embeddings of module with sparse gradients."
+    params, seen = [], set()
+    for m in module.modules():
+        if isinstance(m, nn.Embedding) and m.sparse:
+            # shared embeddings (-share_embedding) only once
+            for p in m.parameters():
+                if id(p) not in seen:
+                    seen.add(id(p))
+                    params.append(p)
+    return params
+
+
+def clipGradNorm(params, maxNorm):
+    """
+    clip_grad_norm for dense and sparse gradients: scale the gradients
+    so that their total (2-)norm is at most maxNorm. The sparse gradients
+    are coalesced first, a row looked up several times is summed once.
+
+    Returns the total norm before clipping.
+    """
+    grads = []
+    for p in params:
+        if p.grad is None:
+            continue
+        if p.grad.data.is_sparse:
+            p.grad = Variable(p.grad.data.coalesce())
+            values = p.grad.data._values()
+        else:
+            values = p.grad.data
+        if values.numel() > 0:
+            grads.append(values)
+
+    totalNorm = math.sqrt(sum(float(g.norm()) ** 2 for g in grads))
+    clipCoef = maxNorm / (totalNorm + 1e-6)
+    if clipCoef < 1:
+        # the values of a coalesced sparse tensor are scaled in place
+        for g in grads:
+            g.mul_(clipCoef)
+    return totalNorm
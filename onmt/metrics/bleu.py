@@ -79,3 +79,99 @@ def moses_multi_bleu(hypFileName, refFileName, lowercase=False):
 
 
   return np.float32(bleu_score)
+
+
+def _ngramKeys(sents, n):
+  """64-bit hashes of the (sentence, n-gram) pairs of a list of id sequences.
+
+  Args:
+    sents: A list of sequences of non-negative integer ids.
+    n: The n-gram order.
+
+  Returns:
+    A uint64 numpy array with one key for every n-gram of every sentence.
+  """
+  lengths = np.array([len(s) for s in sents], dtype=np.int64)
+  width = int(lengths.max()) if len(sents) > 0 else 0
+  if width < n:
+    return np.zeros(0, dtype=np.uint64)
+
+  ids = np.zeros((len(sents), width), dtype=np.uint64)
+  for b, s in enumerate(sents):
+    ids[b, :len(s)] = s
+
+  # FNV-1a style mixing, the sentence index first so that n-grams are
+  # only matched inside the same sentence
+  prime = np.uint64(1099511628211)
+  keys = np.arange(len(sents), dtype=np.uint64)[:, None] * prime
+  keys = np.repeat(keys, width - n + 1, axis=1)
+  for k in range(n):
+    keys = (keys ^ (ids[:, k:width - n + 1 + k] + np.uint64(1))) * prime
+
+  valid = np.arange(width - n + 1)[None, :] <= (lengths - n)[:, None]
+  return keys[valid]
+
+
+class CorpusBleu(object):
+  """Corpus BLEU computed in-process, as multi-bleu.perl computes it.
+
+  The sentences are sequences of integer ids (the target ids of the
+  batches, or words mapped to ids with `intern`). The clipped n-gram
+  matches are counted per batch with hashed n-grams and np.unique, and
+  only the sufficient statistics are kept across batches.
+  """
+
+  def __init__(self, order=4):
+    self.order = order
+    self.correct = np.zeros(order, dtype=np.int64)
+    self.total = np.zeros(order, dtype=np.int64)
+    self.hypLength = 0
+    self.refLength = 0
+    self.vocab = dict()
+
+  def intern(self, words):
+    """Map words (e.g. desegmented BPE output) to ids."""
+    vocab = self.vocab
+    return [vocab.setdefault(w, len(vocab)) for w in words]
+
+  def addBatch(self, hyps, refs):
+    """Add the statistics of hypotheses and their single references.
+
+    Args:
+      hyps: A list of id sequences.
+      refs: A list of id sequences, one for each hypothesis.
+    """
+    self.hypLength += sum(len(h) for h in hyps)
+    self.refLength += sum(len(r) for r in refs)
+
+    for n in range(1, self.order + 1):
+      hypKeys = _ngramKeys(hyps, n)
+      refKeys = _ngramKeys(refs, n)
+      self.total[n - 1] += len(hypKeys)
+      if len(hypKeys) == 0 or len(refKeys) == 0:
+        continue
+
+      hypNgrams, hypCounts = np.unique(hypKeys, return_counts=True)
+      refNgrams, refCounts = np.unique(refKeys, return_counts=True)
+
+      # clip the counts by the reference counts
+      pos = np.minimum(np.searchsorted(refNgrams, hypNgrams), len(refNgrams) - 1)
+      found = refNgrams[pos] == hypNgrams
+      self.correct[n - 1] += np.minimum(hypCounts[found], refCounts[pos[found]]).sum()
+
+  def score(self):
+    """The BLEU score scaled by 100, rounded as multi-bleu.perl prints it."""
+    if self.hypLength == 0 or self.refLength == 0:
+      return 0.0
+
+    logPrecision = 0.0
+    for n in range(self.order):
+      if self.correct[n] == 0:
+        return 0.0
+      logPrecision += np.log(self.correct[n] / self.total[n])
+
+    brevityPenalty = 1.0
+    if self.hypLength < self.refLength:
+      brevityPenalty = np.exp(1.0 - self.refLength / self.hypLength)
+
+    return round(float(100 * brevityPenalty * np.exp(logPrecision / self.order)), 2)
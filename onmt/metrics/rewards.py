@@ -0,0 +1,194 @@
+from __future__ import division
+
+import torch
+import onmt
+from onmt.metrics.sbleu import ngramLength, smoothingConstant, bpSmoothingConstant
+
+
+class BatchRewards(object):
+    """
+    Sentence level rewards of a whole batch, computed on the device of the
+    ids: GLEU (as sentence_gleu), the smoothed sentence BLEU (as
+    sentence_bleu) and HIT (as HitMetrics.hit).
+
+    The sentences are T x B id tensors, read up to and including the first
+    </s> (the words Dict.convertToLabels gives). The n-grams are packed in
+    int64 keys ((id_0 * V + id_1) * V + ...), exact while V ** n < 2 ** 63
+    and a hash above. They are counted by pairwise equality inside each
+    sentence, as torch has no unique.
+    """
+
+    def __init__(self, dict, metric='gleu', hit_alpha=0.5):
+        if metric not in ('gleu', 'sbleu', 'hit'):
+            raise NotImplementedError
+        self.metric = metric
+        self.alpha = hit_alpha
+        self.order = ngramLength
+        self.vocabSize = dict.size()
+        self.dot = dict.lookup('.', -1)
+        self.semicolon = dict.lookup(';', -1)
+
+        # HIT splits the references at every ';' character, also inside a
+        # word: the parts of these words, as ids (None if empty)
+        self.pieces = {}
+        for idx, label in dict.idxToLabel.items():
+            if ';' in label:
+                self.pieces[idx] = [dict.lookup(part, -1) if part else None
+                                    for part in label.split(';')]
+
+    def lengths(self, seqs):
+        "Lengths up to and including the first </s> (T without one)."
+        T = seqs.size(0)
+        positions = torch.arange(0, T).type_as(seqs).unsqueeze(1).expand_as(seqs)
+        eos = positions.clone().masked_fill_(seqs.ne(onmt.Constants.EOS), T)
+        return (eos.min(0)[0] + 1).clamp_(max=T)
+
+    def _keys(self, seqs, lengths, n):
+        """
+        The keys of the n-grams of T x B seqs (B x T-n+1) and the mask of
+        the n-grams inside the sentences. None if T < n.
+        """
+        seqs = seqs.t()
+        width = seqs.size(1) - n + 1
+        if width <= 0:
+            return None, None
+
+        keys = seqs[:, :width].clone()
+        for k in range(1, n):
+            keys = keys * self.vocabSize + seqs[:, k:k + width]
+
+        positions = torch.arange(0, width).type_as(lengths).unsqueeze(0).expand_as(keys)
+        valid = positions.le((lengths - n).unsqueeze(1).expand_as(keys))
+        return keys, valid
+
+    def _matches(self, hyp, hypLengths, ref, refLengths, n):
+        "Number of n-grams of every hypothesis clipped by the reference counts."
+        hypKeys, hypValid = self._keys(hyp, hypLengths, n)
+        refKeys, refValid = self._keys(ref, refLengths, n)
+        if hypKeys is None or refKeys is None:
+            return hypLengths.new(hypLengths.size(0)).zero_()
+
+        B, width = hypKeys.size()
+        rows = hypKeys.unsqueeze(2)
+
+        # occurrence rank of every n-gram: the same n-grams before it
+        same = rows.expand(B, width, width).eq(hypKeys.unsqueeze(1).expand(B, width, width))
+        before = torch.ones(width, width).tril(-1).type_as(same)
+        rank = (same * before.unsqueeze(0).expand_as(same)).long().sum(2)
+
+        # the k-th occurrence matches if the reference has k of them
+        refWidth = refKeys.size(1)
+        inRef = rows.expand(B, width, refWidth).eq(refKeys.unsqueeze(1).expand(B, width, refWidth))
+        refCounts = (inRef * refValid.unsqueeze(1).expand_as(inRef)).long().sum(2)
+
+        return (rank.lt(refCounts) * hypValid).long().sum(1)
+
+    def gleu(self, hyp, hypLengths, ref, refLengths):
+        tp = 0
+        tpfp = 0
+        tpfn = 0
+        for n in range(1, self.order + 1):
+            tp = tp + self._matches(hyp, hypLengths, ref, refLengths, n)
+            tpfp = tpfp + (hypLengths - n + 1).clamp(min=0)
+            tpfn = tpfn + (refLengths - n + 1).clamp(min=0)
+        return tp.float() / torch.max(tpfp, tpfn).clamp(min=1).float()
+
+    def sbleu(self, hyp, hypLengths, ref, refLengths):
+        result = 1
+        for n in range(self.order):
+            counts = self._matches(hyp, hypLengths, ref, refLengths, n + 1).float()
+            total = (hypLengths - n).float()
+            factor = (counts + smoothingConstant) / (total + smoothingConstant)
+            # no n-gram precision above the sentence length
+            result = result * factor.masked_fill_(total.le(0), 1)
+        result = result.pow(1.0 / self.order)
+
+        hypLengths, refLengths = hypLengths.float(), refLengths.float()
+        penalty = (1.0 - (refLengths + bpSmoothingConstant) / hypLengths.clamp(min=1)).exp()
+        return result * penalty.masked_fill_(hypLengths.gt(refLengths), 1)
+
+    def _phrases(self, words):
+        "The phrases of ids between the ';' of the HIT references."
+        phrases, current = [], []
+        for w in words:
+            parts = self.pieces.get(w)
+            if parts is None:
+                current.append(w)
+                continue
+            if parts[0] is not None:
+                current.append(parts[0])
+            for part in parts[1:]:
+                phrases.append(current)
+                current = [part] if part is not None else []
+        phrases.append(current)
+        return [p for p in phrases if len(p) > 0]
+
+    def hit(self, hyp, hypLengths, ref, refLengths):
+        """
+        As HitMetrics.hit: the reference is 'sentence . ; . phrase ; phrase'
+        and the score mixes the GLEU on the sentence and the ratio of the
+        phrases found in the hypothesis (-1 without phrases).
+        Returns (score, gleu, hit).
+        """
+        pureRefs, phrases = [], []
+        lengths = refLengths.tolist()
+        for b, words in enumerate(ref.t().tolist()):
+            words = words[:lengths[b]]
+            index = -1
+            for i in range(len(words) - 3):
+                if words[i:i + 3] == [self.dot, self.semicolon, self.dot]:
+                    index = i
+                    break
+            # (the slicing quirks of HitMetrics are kept)
+            pureRefs.append(words[:index] + words[-1:])
+            phrases.append(self._phrases(words[index + 3:-1]))
+
+        width = max(len(r) for r in pureRefs)
+        pureRef = torch.LongTensor([r + [onmt.Constants.PAD] * (width - len(r))
+                                    for r in pureRefs]).t().contiguous().type_as(ref)
+        pureLengths = torch.LongTensor([len(r) for r in pureRefs]).type_as(hypLengths)
+        gleu = self.gleu(hyp, hypLengths, pureRef, pureLengths)
+
+        # the phrases are matched by length, those with words out of the
+        # vocabulary cannot be found
+        byLength = {}
+        for b, sentPhrases in enumerate(phrases):
+            for p in sentPhrases:
+                if -1 not in p:
+                    byLength.setdefault(len(p), []).append((b, p))
+
+        found = hypLengths.new(hypLengths.size(0)).zero_()
+        for n, items in byLength.items():
+            keys, valid = self._keys(hyp, hypLengths, n)
+            if keys is None:
+                continue
+            sents = torch.LongTensor([b for b, _ in items]).type_as(hyp)
+            patterns = torch.LongTensor([p for _, p in items]).t().contiguous().type_as(hyp)
+            patternKeys, _ = self._keys(patterns, sents.new(len(items)).fill_(n), n)
+
+            keys, valid = keys.index_select(0, sents), valid.index_select(0, sents)
+            hits = (keys.eq(patternKeys.expand_as(keys)) * valid).long().sum(1).gt(0)
+            found.index_add_(0, sents, hits.long())
+
+        counts = torch.LongTensor([len(p) for p in phrases]).type_as(found)
+        hit = found.float() / counts.clamp(min=1).float()
+        hit.masked_fill_(counts.eq(0), -1)
+
+        score = self.alpha * hit.clamp(min=0) + (1.0 - self.alpha) * gleu
+        return score, gleu, hit
+
+    def score(self, hyp, ref):
+        """
+        The metric of every sentence of T x B sampled ids against T' x B
+        reference ids, as a tuple like the metrics of onmt.metrics.
+        """
+        hypLengths, refLengths = self.lengths(hyp), self.lengths(ref)
+        if self.metric == 'gleu':
+            return (self.gleu(hyp, hypLengths, ref, refLengths),)
+        elif self.metric == 'sbleu':
+            return (self.sbleu(hyp, hypLengths, ref, refLengths),)
+        return self.hit(hyp, hypLengths, ref, refLengths)
+
+    def __call__(self, hyp, ref):
+        "The rewards: B floats on the device of the ids."
+        return self.score(hyp, ref)[0]
@@ -1,17 +1,41 @@
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
-import torch.cuda
 from torch.autograd import Variable
 
 
 class ImageEncoder(nn.Module):
+    """
+    Conv stack over the image followed by an LSTM over every row of the
+    feature map. With opt.img_features the input is the feature map saved by
+    tools/extract_img_features.py and only the row LSTM is run.
+
+    With opt.brnn the directions of the LSTM have opt.rnn_size units, or
+    opt.rnn_size / 2 with opt.img_brnn_split (absent from the options of
+    the older checkpoints).
+    """
+
     def __init__(self, opt):
         super(ImageEncoder, self).__init__()
         self.layers = opt.layers
         self.num_directions = 2 if opt.brnn else 1
         self.hidden_size = opt.rnn_size
+        if getattr(opt, 'img_brnn_split', False):
+            assert opt.rnn_size % self.num_directions == 0
+            self.hidden_size = opt.rnn_size // self.num_directions
+        self.precomputed = getattr(opt, 'img_features', False)
 
+        if not self.precomputed:
+            self.buildCNN()
+
+        input_size = 512
+        self.rnn = nn.LSTM(input_size, self.hidden_size,
+                           num_layers=opt.layers,
+                           dropout=opt.dropout,
+                           bidirectional=opt.brnn)
+        self.pos_lut = nn.Embedding(1000, input_size)
+
+    def buildCNN(self):
         self.layer1 = nn.Conv2d(3,   64, kernel_size=(3, 3),
                                 padding=(1, 1), stride=(1, 1))
         self.layer2 = nn.Conv2d(64,  128, kernel_size=(3, 3),
@@ -29,19 +53,17 @@ class ImageEncoder(nn.Module):
         self.batch_norm2 = nn.BatchNorm2d(512)
         self.batch_norm3 = nn.BatchNorm2d(512)
 
-        input_size = 512
-        self.rnn = nn.LSTM(input_size, opt.rnn_size,
-                           num_layers=opt.layers,
-                           dropout=opt.dropout,
-                           bidirectional=opt.brnn)
-        self.pos_lut = nn.Embedding(1000, input_size)
-
     def load_pretrained_vectors(self, opt):
         pass
 
-    def forward(self, input):
-        input = input[0]
-        batchSize = input.size(0)
+    def switchID(self, srcID):
+        return
+
+    def switchPairID(self, pairID):
+        return
+
+    def extractFeatures(self, input):
+        "Run the conv stack: (batch_size, 3, imgH, imgW) -> (batch_size, 512, H, W)"
         # (batch_size, 64, imgH, imgW)
         # layer 1
         input = F.relu(self.layer1(input[:, :, :, :]-0.5), True)
@@ -79,14 +101,20 @@ class ImageEncoder(nn.Module):
         # (batch_size, 512, imgH/2/2/2, imgW/2/2/2)
         input = F.relu(self.batch_norm3(self.layer6(input)), True)
 
+        return input
+
+    def encodeRows(self, input):
+        "Run the row LSTM over a (batch_size, 512, H, W) feature map."
+        batchSize = input.size(0)
         # # (batch_size, 512, H, W)
         # # (batch_size, H, W, 512)
         all_outputs = []
         for row in range(input.size(2)):
             inp = input[:, :, row, :].transpose(0, 2)\
                                      .transpose(1, 2)
-            pos_emb = self.pos_lut(
-                Variable(torch.cuda.LongTensor(batchSize).fill_(row)))
+            # the row index on the same device as the input
+            rowIndex = input.data.new(batchSize).fill_(row).long()
+            pos_emb = self.pos_lut(Variable(rowIndex))
             with_pos = torch.cat(
                 (pos_emb.view(1, pos_emb.size(0), pos_emb.size(1)), inp), 0)
             outputs, hidden_t = self.rnn(with_pos)
@@ -94,3 +122,9 @@ class ImageEncoder(nn.Module):
         out = torch.cat(all_outputs, 0)
 
         return hidden_t, out
+
+    def forward(self, input):
+        input = input[0]
+        if not self.precomputed:
+            input = self.extractFeatures(input)
+        return self.encodeRows(input)
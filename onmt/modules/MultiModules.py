@@ -14,12 +14,16 @@ class MultiWordEmbedding(nn.Module):
         self.inputSize = opt.word_vec_size
         self.moduleList = nn.ModuleList()
         
+        # sparse gradients, only the rows of the batch (-sparse_embeddings)
+        sparse = getattr(opt, 'sparse_embeddings', False)
+        
         for i in dicts:
             vocabSize = dicts[i].size()
             
             embedding = nn.Embedding(vocabSize,
                                      self.inputSize,
-                                     padding_idx=onmt.Constants.PAD)
+                                     padding_idx=onmt.Constants.PAD,
+                                     sparse=sparse)
             self.moduleList.append(embedding)
         
         
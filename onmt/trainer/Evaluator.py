@@ -1,11 +1,12 @@
 from __future__ import division
 
-import sys, tempfile
+import sys
 import onmt
 import onmt.modules
 #~ from onmt.metrics.gleu import sentence_gleu
 #~ from onmt.metrics.sbleu import sentence_bleu
-from onmt.metrics.bleu import moses_multi_bleu
+from onmt.metrics.bleu import CorpusBleu
+from onmt.BPE import desegment
 #~ from onmt.utils import compute_score
 import torch
 import torch.nn as nn
@@ -15,6 +16,16 @@ import math
 
 from onmt.metrics.gleu import sentence_gleu
 from onmt.metrics.hit import HitMetrics
+from onmt.metrics.sbleu import sentence_bleu
+
+
+def cutAt(ids, pattern):
+    "The ids before the first occurrence of the id sequence pattern."
+    n = len(pattern)
+    for i in range(len(ids) - n + 1):
+        if ids[i:i + n] == pattern:
+            return ids[:i]
+    return ids
 
 class Evaluator(object):
     
@@ -33,6 +44,11 @@ class Evaluator(object):
         self.translator = onmt.InplaceTranslator(self.model, self.dicts, 
                                             beam_size=1, 
                                             cuda=self.cuda)
+        self.max_generator_batches = getattr(opt, 'max_generator_batches', 32)
+        
+        # evaluate the averaged weights if the trainer keeps them
+        self.average = None
+        
         self.adapt = False
         
         if opt.adapt_src is not None and opt.adapt_tgt is not None and opt.pairID is not None:
@@ -46,6 +62,8 @@ class Evaluator(object):
         elif opt.reinforce_metrics == 'hit':
             hit_scorer = HitMetrics(opt.hit_alpha)
             self.score = hit_scorer.hit
+        elif opt.reinforce_metrics == 'sbleu':
+            self.score = sentence_bleu
         else:
             raise NotImplementedError
             
@@ -56,17 +74,34 @@ class Evaluator(object):
     def setCriterion(self, criterion):
         self.criterion = criterion
     
+    def setAverage(self, average):
+        self.average = average
+    
+    def _swapAverage(self):
+        if self.average is not None:
+            self.average.swap()
+    
     
     # Compute perplexity of a data given the model
     # For a multilingual dataset, we may need the setIDs of the desired languages
     # data is a dictionary with key = setid and value = DataSet object
     def eval_perplexity(self, data, criterions, setIDs=None):
         
+        self.model.eval()
+        self._swapAverage()
+        try:
+            return self._perplexity(data, criterions, setIDs)
+        finally:
+            # the trained weights are restored even on errors
+            self._swapAverage()
+            self.model.train()
+    
+    def _perplexity(self, data, criterions, setIDs=None):
+        
         if setIDs is None:
             setIDs = self.setIDs
             
         model = self.model
-        model.eval()
         
         # return a list of losses for each language
         losses = dict()
@@ -90,19 +125,14 @@ class Evaluator(object):
             for i in range(len(dset)):
                 # exclude original indices
                 batch = dset[i][:-1]
-                outputs, hiddens = model(batch)
-                # exclude <s> from targets
-                targets = batch[1][1:]
-                outputs_flat = outputs.view(-1, outputs.size(-1))
-                targets_flat = targets.view(-1)
-                loss = criterion(outputs_flat, targets_flat)
-                total_loss += loss.data[0]
-                total_words += targets.data.ne(onmt.Constants.PAD).sum()
+                loss, num_words = model(batch, mode='xe_loss', criterion=criterion,
+                                        timestep_group=self.max_generator_batches)
+                total_loss += loss
+                total_words += num_words
             
             normalized_loss = total_loss / total_words
             losses[sid] = math.exp(min(normalized_loss, 100))
         
-        model.train()
         return losses
     
     
@@ -240,8 +270,18 @@ class Evaluator(object):
     # and the custom metrics (gleu, hit ... )
     def eval_translate(self, data, beam_size=1, batch_size=16, bpe=True, bpe_token="@"):
         
+        self.model.eval()
+        self._swapAverage()
+        try:
+            return self._translate(data, batch_size, bpe, bpe_token)
+        finally:
+            # after decoding, switch model back to training mode
+            self._swapAverage()
+            self.model.train()
+    
+    def _translate(self, data, batch_size=16, bpe=True, bpe_token="@"):
+        
         model = self.model
-        model.eval()
         setIDs = self.setIDs
         
         count = 0
@@ -275,9 +315,11 @@ class Evaluator(object):
             tgt_dict = self.dicts['vocabs'][tgt_lang]
             src_dict = self.dicts['vocabs'][src_lang]
             
-            # we print translations into temp files
-            outF = tempfile.NamedTemporaryFile()
-            outRef = tempfile.NamedTemporaryFile()
+            # corpus BLEU on the ids, accumulated over the batches
+            bleuScorer = CorpusBleu()
+            
+            # the references are cut at '. ; .'
+            cutPattern = [tgt_dict.lookup('.'), tgt_dict.lookup(';'), tgt_dict.lookup('.')]
                 
             for i in range(len(dset)):
                 # exclude original indices
@@ -292,29 +334,28 @@ class Evaluator(object):
                 
                 pred = self.translator.translate(src)
                 
-                bpe_string = bpe_token + bpe_token + " "
+                bpe_separator = bpe_token + bpe_token
+                hyps, refs = [], []
                 
                 for b in range(len(pred)):
                     
                     ref_tensor = transposed_targets[b].tolist()
                     
                     predWordList = tgt_dict.convertToLabels(pred[b], onmt.Constants.EOS)
-                    decodedSent = " ".join(predWordList)
-                    decodedSent = decodedSent.replace(bpe_string, '')
-                    
                     refWordList = tgt_dict.convertToLabels(ref_tensor, onmt.Constants.EOS)
-                    refSent = " ".join(refWordList)
-                    
-                    refSent = refSent.split('. ; .')[0]
-                    
-                    refSent = refSent.replace(bpe_string, '')
                     
-                    
-                    # Flush the pred and reference sentences to temp files 
-                    outF.write(decodedSent + "\n")
-                    outF.flush()
-                    outRef.write(refSent + "\n")
-                    outRef.flush()
+                    if bpe:
+                        # BLEU is computed on words: the desegmented words
+                        # are mapped to ids
+                        decodedSent = desegment(" ".join(predWordList), bpe_separator)
+                        refSent = " ".join(refWordList).split('. ; .')[0]
+                        refSent = desegment(refSent, bpe_separator)
+                        hyps.append(bleuScorer.intern(decodedSent.split()))
+                        refs.append(bleuScorer.intern(refSent.split()))
+                    else:
+                        # the ids of the labels, up to and including </s>
+                        hyps.append([int(w) for w in pred[b][:len(predWordList)]])
+                        refs.append(cutAt(ref_tensor[:len(refWordList)], cutPattern))
                     
                     s = self.score(refWordList, predWordList)
                     
@@ -327,6 +368,8 @@ class Evaluator(object):
                             total_hits[sid] += hit
                             
                     total_scores[sid] += s[0] * 100 
+                
+                bleuScorer.addBatch(hyps, refs)
                 #~ 
                 #~ if len(s) > 2:
                     #~ gleu = s[1]
@@ -350,20 +393,12 @@ class Evaluator(object):
             
             total_sentences[sid] += batch_size
                     
-            # compute bleu using external script
-            bleu = moses_multi_bleu(outF.name, outRef.name)
-            outF.close()
-            outRef.close()    
-            
-            bleu_scores[sid] = bleu
+            bleu_scores[sid] = bleuScorer.score()
             
             #~ if total_hit_sentences > 0:
             #~ average_hit = total_hit / total_hit_sentences
             #~ print("Average HIT : %.2f" % (average_hit * 100))
 
             #~ average_score = total_score / total_sentences
-
-            # after decoding, switch model back to training mode
-            self.model.train()
             
-            return bleu_scores
+        return bleu_scores
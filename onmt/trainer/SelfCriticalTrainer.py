@@ -4,6 +4,7 @@ import sys, tempfile
 import onmt
 import onmt.Markdown
 import onmt.modules
+import onmt.Distributed
 import argparse
 import torch
 import torch.nn as nn
@@ -13,8 +14,7 @@ import math
 import time
 import random 
 import numpy as np
-from onmt.metrics.gleu import sentence_gleu
-from onmt.metrics.hit import HitMetrics
+from onmt.metrics.rewards import BatchRewards
 
 
 
@@ -26,31 +26,6 @@ def averagePPL(losses, counts):
         ppl = math.exp(losses[i] / (counts[i] + 1e-6))
         ppls.append(ppl)
     return sum(ppls) / len(ppls)
-    
-def compute_score(score, samples, ref, tgtDict, batch_size, average=True):
-        
-    # probably faster than gpu ?
-    sdata = samples.data.cpu().t().tolist()
-    rdata = ref.data.cpu().t().tolist()
-    
-    #~ tgtDict = dicts['tgt']
-    
-    s = torch.Tensor(batch_size)
-    
-    for i in xrange(batch_size):
-        
-        sampledIDs = sdata[i]
-        refIDs = rdata[i]
-        
-        sampledWords = tgtDict.convertToLabels(sampledIDs, onmt.Constants.EOS)
-        refWords = tgtDict.convertToLabels(refIDs, onmt.Constants.EOS)
-        
-        # note: the score function returns a tuple 
-        s[i] = score(refWords, sampledWords)[0]
-        
-    s = s.cuda()
-        
-    return s
 
 
 class SCSTTrainer(object):
@@ -69,11 +44,13 @@ class SCSTTrainer(object):
         
         self.criterions = onmt.Models.NMTCriterion(self.dicts['tgt'], cuda=(len(self.opt.gpus) >= 1))
         
-        if opt.reinforce_metrics == 'gleu':
-            self.score = sentence_gleu
-        elif opt.reinforce_metrics == 'hit':
-            hit_scorer = HitMetrics(opt.hit_alpha)
-            self.score = hit_scorer.hit
+        # batched rewards on the ids, one scorer for each target language
+        self.rewards = dict()
+        
+        if opt.rf_baseline not in ('greedy', 'mean'):
+            raise NotImplementedError
+        assert opt.rf_baseline == 'greedy' or opt.rf_samples > 1, \
+            "The mean baseline needs -rf_samples > 1"
         
         # A flag for language - specific adapting
         self.adapt = False
@@ -84,6 +61,33 @@ class SCSTTrainer(object):
         self.adapt_tgt = opt.adapt_tgt
         self.adapt_pair = opt.pairID
         
+        # The (set, batch) schedule of every epoch
+        seed = opt.seed[0] if isinstance(opt.seed, list) else opt.seed
+        self.scheduler = onmt.BatchScheduler(seed, opt.sampling_temperature,
+                                             adaptPair=(self.adapt_pair if self.adapt else None))
+        self.startIteration = 0
+        
+        # checkpoints are written in the background
+        self.checkpoints = onmt.CheckpointWriter(opt.save_model, self.dicts,
+                                                 keepLast=opt.keep_last,
+                                                 keepBest=opt.keep_best,
+                                                 higherIsBetter=True)
+        
+        # online average of the weights, also used by the evaluator
+        self.average = None
+        if opt.ema_decay > 0 or opt.average_window > 0:
+            self.average = onmt.ModelAverage(model, model.generator,
+                                             decay=opt.ema_decay,
+                                             window=opt.average_window,
+                                             every=opt.average_every)
+        evaluator.setAverage(self.average)
+
+        # phase timing (-profile), the model marks its own phases
+        self.profiler = onmt.Profiler(opt.profile if onmt.Distributed.isMaster(opt) else None,
+                                      format=opt.profile_format, interval=opt.log_interval,
+                                      cuda=(len(opt.gpus) >= 1))
+        (model.module if len(opt.gpus) > 1 else model).profiler = self.profiler
+        
         self.best_bleu = 0.00
         
     
@@ -106,13 +110,13 @@ class SCSTTrainer(object):
         
         start_time = time.time()
         
-        def trainEpoch(epoch, batchOrder=None):
+        def trainEpoch(epoch):
 
-            # Shuffle mini batch order.
-            if not batchOrder:
-                batchOrder = dict()
+            # Re-assign the mini-batches inside each length bucket
+            if opt.extra_shuffle and epoch > opt.curriculum:
+                seed = opt.seed[0] if isinstance(opt.seed, list) else opt.seed
                 for i in trainSets:
-                    batchOrder[i] = torch.randperm(len(trainSets[i]))
+                    trainSets[i].shuffle(seed, epoch)
 
             total_rewards, total_sents = dict(), dict()
             report_rewards, report_tgt_words = dict(), []
@@ -128,52 +132,38 @@ class SCSTTrainer(object):
                 report_tgt_words.append(0)
                 report_src_words.append(0)
             
-            dataSizes = [len(trainSets[i]) for i in trainSets]
-            
-            if self.adapt:
-                nSamples = dataSizes[self.adapt_pair]
-            else:
-                nSamples = sum(dataSizes)
-            
-            # In order to make sets sample randomly,
-            # We create a distribution over the data size
-            # In the future we can manipulate this distribution 
-            # to create biased sampling when training
-            sampleDist = torch.Tensor(len(setIDs))
-            iterators = dict()
-            for i in xrange(len(setIDs)):
-                sampleDist[i] = len(trainSets[i])
-                iterators[i] = -1
-            sampleDist = sampleDist / torch.sum(sampleDist)
+            schedule = self.scheduler.get(trainSets, epoch, curriculum=(epoch <= opt.curriculum))
 
-            for i in range(nSamples):
-                            
-                sampledSet = -1
+            # Every rank trains on its own part of the schedule
+            schedule = onmt.Distributed.scheduleSlice(schedule, opt)
+            nSamples = len(schedule)
 
-                if self.adapt:
-                    sampledSet = self.adapt_pair
-                else:
-                    # this loop is very dangerous 
-                    # because if the dataset is full then it will loop forever
-                    # need a mechanism to halt it
-                    while True:
-                        # if the sampled set is full then we re-sample 
-                        # to ensure that in one epoch we read each example once
-                        sampledSet = int(torch.multinomial(sampleDist, 1)[0])
-                        if iterators[sampledSet] + 1 < dataSizes[sampledSet]:
-                            break
-                
+            # a resumed epoch continues after the saved iteration
+            startIteration = self.startIteration
+            self.startIteration = 0
+
+            prefetcher = onmt.BatchPrefetcher(trainSets, schedule[startIteration:],
+                                              bufferSize=opt.prefetch,
+                                              numWorkers=opt.prefetch_workers,
+                                              mode=opt.prefetch_mode,
+                                              pinMemory=opt.pin_memory)
+            report_wait = 0.0
+            profiler = self.profiler
+            profiler.start()
+            
+            for i, (sampledSet, batchIdx, batch) in enumerate(prefetcher, startIteration):
                 
-                iterators[sampledSet] += 1 
+                profiler.mark('data')
                 
                 tgt_lang = dicts['tgtLangs'][setIDs[sampledSet][1]]
                 tgt_dict = self.dicts['vocabs'][tgt_lang]
-                
-                # Get the batch index from batch order
-                batchIdx = batchOrder[sampledSet][iterators[sampledSet]] if epoch > opt.curriculum else iterators[sampledSet]
+                if tgt_lang not in self.rewards:
+                    self.rewards[tgt_lang] = BatchRewards(tgt_dict, opt.reinforce_metrics,
+                                                          hit_alpha=opt.hit_alpha)
+                rewards = self.rewards[tgt_lang]
                 
                 # Get the batch
-                batch = trainSets[sampledSet][batchIdx][:-1]
+                batch = batch[:-1]
                 batch_size = batch[1].size(1)
                 
                 # And switch the model to the desired language mode
@@ -185,19 +175,32 @@ class SCSTTrainer(object):
                 
                 ref = batch[1][1:]
                 batch_size = ref.size(1)
-                # Monte-Carlo actions and greedy actions to be sampled
-                rl_actions, greedy_actions, logprobs = model(batch, mode='rf')
+                n_samples = opt.rf_samples
+                
+                # Monte-Carlo actions (n_samples for every source) and 
+                # greedy actions, sampled in one batch
+                if opt.rf_baseline == 'greedy':
+                    rl_actions, greedy_actions, logprobs = model(batch, mode='rf', n_samples=n_samples)
+                else:
+                    rl_actions, logprobs = model(batch, mode='rf', n_samples=n_samples, gen_greedy=False)
                 
                 # reward for samples from stochastic function
-                sampled_reward = compute_score(self.score, rl_actions, ref, tgt_dict, batch_size) 
+                sampled_reward = rewards(rl_actions.data, ref.data.repeat(1, n_samples))
                 
-                # samples from greedy search
-                greedy_reward = compute_score(self.score, greedy_actions, ref, tgt_dict, batch_size) 
+                if opt.rf_baseline == 'greedy':
+                    # samples from greedy search
+                    baseline = rewards(greedy_actions.data, ref.data).repeat(n_samples)
+                else:
+                    # mean reward of the other samples of the same source
+                    total = sampled_reward.view(n_samples, batch_size).sum(0).repeat(n_samples)
+                    baseline = (total - sampled_reward) / (n_samples - 1)
                 
-                # the REINFORCE reward to be the difference between MC and greedy
-                rf_rewards = (sampled_reward - greedy_reward)
+                profiler.mark('rewards')
                 
-                R = torch.sum(sampled_reward)
+                # the REINFORCE reward to be the difference between MC and the baseline
+                rf_rewards = (sampled_reward - baseline)
+                
+                R = torch.sum(sampled_reward) / n_samples
                 
                 total_rewards[sampledSet] += R
                 
@@ -218,13 +221,21 @@ class SCSTTrainer(object):
                 # normalize the loss by batch size
                 action_loss.div(batch_size)
                 
-                loss = action_loss
+                # average over the samples of every source
+                loss = action_loss.div(n_samples)
                 
                 # back-prop and compute the gradients
                 loss.backward()
+                profiler.mark('backward')
        
+                # Average the gradients of all ranks
+                onmt.Distributed.allReduceGradients(optim.params, opt, optim.sparseParams)
+                profiler.mark('all_reduce')
+
                 # Update the parameters.
-                optim.step()
+                optim.step(profiler)
+                if self.average is not None:
+                    self.average.step()
 
                 # Statistics for the current set
                 report_rewards[sampledSet] += R
@@ -233,18 +244,22 @@ class SCSTTrainer(object):
                 total_rewards[sampledSet] += R
                 total_sents[sampledSet] += batch_size
                 report_tgt_sents[sampledSet] += batch_size
+                profiler.count(batch[0][1].data.sum(), batch[0][0].data.numel(),
+                               num_words_sampled, rl_actions.data.numel())
 
                 # Logging information
                 if i == 0 or (i % opt.log_interval == -1 % opt.log_interval):
                     #~ avgTrainLoss = averageReward(report_rewards, report_tgt_words)
                     avgTrainLoss = sum(report_rewards.values()) / sum(report_tgt_sents.values())
-                    logOut = ("Epoch %2d, %5d/%5d; ; %3.0f src tok/s; %3.0f tgt tok/s; %6.0f s elapsed; avg reward: %6.2f; lr: %.6f" %
+                    logOut = ("Epoch %2d, %5d/%5d; ; %3.0f src tok/s; %3.0f tgt tok/s; %6.0f s elapsed; %5.1f s data wait; avg reward: %6.2f; lr: %.6f" %
                                     (epoch, i+1, nSamples,
                                      sum(report_src_words)/(time.time()-start),
                                      sum(report_tgt_words)/(time.time()-start),
                                      time.time()-start_time,
+                                     prefetcher.waitTime - report_wait,
                                      avgTrainLoss,
                                      optim.get_learning_rate()))
+                    report_wait = prefetcher.waitTime
                                      
                     for j in xrange(len(setIDs)):
                         
@@ -258,7 +273,7 @@ class SCSTTrainer(object):
                                 
                     
                 # Saving checkpoints with validation perplexity
-                if opt.save_every > 0 and i % opt.save_every == -1 % opt.save_every :
+                if opt.save_every > 0 and i % opt.save_every == -1 % opt.save_every and onmt.Distributed.isMaster(opt):
                     valid_bleu_scores = evaluator.eval_translate(validSets)
                     avg_dev_bleu = sum(valid_bleu_scores.values()) / len(valid_bleu_scores)
                     for id in valid_bleu_scores:
@@ -284,9 +299,11 @@ class SCSTTrainer(object):
                             'opt': opt,
                             'epoch': ep,
                             'iteration' : i,
-                            'batchOrder' : batchOrder,
+                            'scheduler' : self.scheduler.state_dict(),
                             'optim': optim
                     }
+                    if self.average is not None:
+                        self.average.saveTo(checkpoint)
                     
                     
                     
@@ -295,25 +312,29 @@ class SCSTTrainer(object):
                             self.best_bleu = avg_dev_bleu
                         file_name='%s.best.pt' % opt.save_model
                         print('Writing to %s' % file_name)
-                        torch.save(checkpoint, file_name)
+                        self.checkpoints.save(checkpoint, file_name, score=avg_dev_bleu)
                     else:
                         file_name = '%s_bleu_%.2f_e%.2f.pt' % (opt.save_model, avg_dev_bleu, ep)
                         print('Writing to %s' % file_name)
-                        torch.save(checkpoint,  file_name)
+                        self.checkpoints.save(checkpoint, file_name, score=avg_dev_bleu)
+                
+                # logging, evaluation and saving are counted as 'other'
+                profiler.endStep()
                                     
                          
             return 
             #~ return [total_rewards[j] / total_sents[j] for j in xrange(len(setIDs))]
             
-        bleu_scores = evaluator.eval_translate(validSets)
-        #~ for id in xrange(len(setIDs)):
-        for id in bleu_scores:
-            setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][id])
-            print('Validation BLEU Scores for set %s : %g' % (setLangs, bleu_scores[id]))
-        avg_bleu = sum(bleu_scores.values()) / len(bleu_scores)
-        print("Average dev BLEU scores: %g" % avg_bleu)
-        
-        self.best_bleu = avg_bleu
+        if onmt.Distributed.isMaster(opt):
+            bleu_scores = evaluator.eval_translate(validSets)
+            #~ for id in xrange(len(setIDs)):
+            for id in bleu_scores:
+                setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][id])
+                print('Validation BLEU Scores for set %s : %g' % (setLangs, bleu_scores[id]))
+            avg_bleu = sum(bleu_scores.values()) / len(bleu_scores)
+            print("Average dev BLEU scores: %g" % avg_bleu)
+            
+            self.best_bleu = avg_bleu
                     
         for epoch in range(opt.start_epoch, opt.start_epoch + opt.epochs):
             print('')
@@ -321,6 +342,10 @@ class SCSTTrainer(object):
             #  (1) train for one epoch on the training set
             trainEpoch(epoch)
 
+            # only the first rank evaluates and saves
+            if not onmt.Distributed.isMaster(opt):
+                continue
+
             #  (2) evaluate BLEU on the validation set
             valid_bleu_scores = evaluator.eval_translate(validSets)
             avg_dev_bleu = sum(valid_bleu_scores.values()) / len(valid_bleu_scores)
@@ -347,18 +372,22 @@ class SCSTTrainer(object):
                 'opt': opt,
                 'epoch': epoch,
                 'iteration' : -1,
-                'batchOrder' : None,
+                'scheduler' : None,
                 'optim': optim
             }
+            if self.average is not None:
+                self.average.saveTo(checkpoint)
             
             if self.override:
                 if self.best_bleu <= avg_dev_bleu:
                     self.best_bleu = avg_dev_bleu
                 file_name='%s.best.pt' % opt.save_model
                 print('Writing to %s' % file_name)
-                torch.save(checkpoint, file_name)
+                self.checkpoints.save(checkpoint, file_name, score=avg_dev_bleu)
             else:
                 file_name = '%s_bleu_%.2f_e%d.pt' % (opt.save_model, avg_dev_bleu, epoch)
                 print('Writing to %s' % file_name)
-                torch.save(checkpoint,
-                             file_name)
+                self.checkpoints.save(checkpoint, file_name, score=avg_dev_bleu)
+
+        # wait for the last checkpoint
+        self.checkpoints.close()
@@ -4,6 +4,7 @@ import sys, tempfile
 import onmt
 import onmt.Markdown
 import onmt.modules
+import onmt.Distributed
 import argparse
 import torch
 import torch.nn as nn
@@ -49,6 +50,32 @@ class XETrainer(object):
         self.adapt_tgt = opt.adapt_tgt
         self.adapt_pair = opt.pairID
         
+        # The (set, batch) schedule of every epoch
+        seed = opt.seed[0] if isinstance(opt.seed, list) else opt.seed
+        self.scheduler = onmt.BatchScheduler(seed, opt.sampling_temperature,
+                                             adaptPair=(self.adapt_pair if self.adapt else None))
+        self.startIteration = 0
+        
+        # checkpoints are written in the background
+        self.checkpoints = onmt.CheckpointWriter(opt.save_model, self.dicts,
+                                                 keepLast=opt.keep_last,
+                                                 keepBest=opt.keep_best)
+        
+        # online average of the weights, also used by the evaluator
+        self.average = None
+        if opt.ema_decay > 0 or opt.average_window > 0:
+            self.average = onmt.ModelAverage(model, model.generator,
+                                             decay=opt.ema_decay,
+                                             window=opt.average_window,
+                                             every=opt.average_every)
+        evaluator.setAverage(self.average)
+
+        # phase timing (-profile), the model marks its own phases
+        self.profiler = onmt.Profiler(opt.profile if onmt.Distributed.isMaster(opt) else None,
+                                      format=opt.profile_format, interval=opt.log_interval,
+                                      cuda=(len(opt.gpus) >= 1))
+        (model.module if len(opt.gpus) > 1 else model).profiler = self.profiler
+        
     
     def run(self):
         
@@ -70,13 +97,13 @@ class XETrainer(object):
         
         start_time = time.time()
         
-        def trainEpoch(epoch, batchOrder=None):
+        def trainEpoch(epoch):
 
-            # Shuffle mini batch order.
-            if not batchOrder:
-                batchOrder = dict()
+            # Re-assign the mini-batches inside each length bucket
+            if opt.extra_shuffle and epoch > opt.curriculum:
+                seed = opt.seed[0] if isinstance(opt.seed, list) else opt.seed
                 for i in trainSets:
-                    batchOrder[i] = torch.randperm(len(trainSets[i]))
+                    trainSets[i].shuffle(seed, epoch)
 
             total_loss, total_words = dict(), dict()
             report_loss, report_tgt_words = dict(), []
@@ -90,90 +117,77 @@ class XETrainer(object):
                 report_tgt_words.append(0)
                 report_src_words.append(0)
             
-            dataSizes = [len(trainSets[i]) for i in trainSets]
-            
-            if self.adapt:
-                nSamples = dataSizes[self.adapt_pair]
-            else:
-                nSamples = sum(dataSizes)
-            
-            # In order to make sets sample randomly,
-            # We create a distribution over the data size
-            # In the future we can manipulate this distribution 
-            # to create biased sampling when training
-            sampleDist = torch.Tensor(len(setIDs))
-            iterators = dict()
-            for i in xrange(len(setIDs)):
-                        sampleDist[i] = len(trainSets[i])
-                        iterators[i] = -1
-            sampleDist = sampleDist / torch.sum(sampleDist)
+            schedule = self.scheduler.get(trainSets, epoch, curriculum=(epoch <= opt.curriculum))
 
-            for i in range(nSamples):
-                            
-                sampledSet = -1
+            # Every rank trains on its own part of the schedule
+            schedule = onmt.Distributed.scheduleSlice(schedule, opt)
+            nSamples = len(schedule)
 
-                if self.adapt:
-                    sampledSet = self.adapt_pair
-                else:
-                    # this loop is very dangerous 
-                    # because if the dataset is full then it will loop forever
-                    # need a mechanism to halt it
-                    while True:
-                        # if the sampled set is full then we re-sample 
-                        # to ensure that in one epoch we read each example once
-                        sampledSet = int(torch.multinomial(sampleDist, 1)[0])
-                        if iterators[sampledSet] + 1 < dataSizes[sampledSet]:
-                            break
-                
-                iterators[sampledSet] += 1 
+            # a resumed epoch continues after the saved iteration
+            startIteration = self.startIteration
+            self.startIteration = 0
+
+            prefetcher = onmt.BatchPrefetcher(trainSets, schedule[startIteration:],
+                                              bufferSize=opt.prefetch,
+                                              numWorkers=opt.prefetch_workers,
+                                              mode=opt.prefetch_mode,
+                                              pinMemory=opt.pin_memory)
+            report_wait = 0.0
+            profiler = self.profiler
+            profiler.start()
+            
+            for i, (sampledSet, batchIdx, batch) in enumerate(prefetcher, startIteration):
                 
-                # Get the batch index from batch order
-                batchIdx = batchOrder[sampledSet][iterators[sampledSet]] if epoch > opt.curriculum else iterators[sampledSet]
+                profiler.mark('data')
                 
                 # Get the batch
-                batch = trainSets[sampledSet][batchIdx][:-1]
+                batch = batch[:-1]
                 batch_size = batch[1].size(1)
                 
                 # And switch the model to the desired language mode
                 model.switchLangID(setIDs[sampledSet][0], setIDs[sampledSet][1])
                 model.switchPairID(sampledSet)
                 
-                # Do forward to the newly created graph
-                model.zero_grad()
-                outputs, hiddens = model(batch)
-                
-                # Exclude <s> from targets.
-                targets = batch[1][1:]
                 # The criterion is for the target language side
                 criterion = criterions[setIDs[sampledSet][1]]
                 
-                loss_v = criterion(outputs.view(-1, outputs.size(-1)), targets.view(-1))
-                
-                loss = loss_v.data[0]
-                
-                loss_v.div(batch_size).backward()
+                # Do forward to the newly created graph, the loss is
+                # computed (and back-propagated) in chunks of time steps
+                model.zero_grad()
+                loss, num_words = model(batch, mode='xe_loss', criterion=criterion,
+                                        normalizer=batch_size, backward=True,
+                                        timestep_group=opt.max_generator_batches)
                              
+                # Average the gradients of all ranks
+                onmt.Distributed.allReduceGradients(optim.params, opt, optim.sparseParams)
+                profiler.mark('all_reduce')
+
                 # Update the parameters.
-                optim.step()
+                optim.step(profiler)
+                if self.average is not None:
+                    self.average.step()
 
                 # Statistics for the current set
-                num_words = targets.data.ne(onmt.Constants.PAD).sum()
                 report_loss[sampledSet] += loss
                 report_tgt_words[sampledSet] += num_words
                 report_src_words[sampledSet] += batch[0][1].data.sum()
                 total_loss[sampledSet] += loss
                 total_words[sampledSet] += num_words
+                profiler.count(batch[0][1].data.sum(), batch[0][0].data.numel(),
+                               num_words, (batch[1].size(0) - 1) * batch_size)
 
                 # Logging information
                 if i == 0 or (i % opt.log_interval == -1 % opt.log_interval):
                     avgTrainLoss = averagePPL(report_loss, report_tgt_words)
-                    logOut = ("Epoch %2d, %5d/%5d; ; %3.0f src tok/s; %3.0f tgt tok/s; %6.0f s elapsed; ppl: %6.2f; lr: %.6f" %
+                    logOut = ("Epoch %2d, %5d/%5d; ; %3.0f src tok/s; %3.0f tgt tok/s; %6.0f s elapsed; %5.1f s data wait; ppl: %6.2f; lr: %.6f" %
                                     (epoch, i+1, nSamples,
                                      sum(report_src_words)/(time.time()-start),
                                      sum(report_tgt_words)/(time.time()-start),
                                      time.time()-start_time,
+                                     prefetcher.waitTime - report_wait,
                                      avgTrainLoss,
                                      optim.get_learning_rate()))
+                    report_wait = prefetcher.waitTime
                                      
                     for j in xrange(len(setIDs)):
                         
@@ -186,16 +200,15 @@ class XETrainer(object):
                                 
                     
                 # Saving checkpoints with validation perplexity
-                if opt.save_every > 0 and i % opt.save_every == -1 % opt.save_every :
-                    valid_losses = evaluator.eval_perplexity(validSets, criterions, setIDs=setIDs)
-                    valid_ppl = [math.exp(min(valid_loss, 100)) for valid_loss in valid_losses]
-                    #~ valid_ppl = " ".join([str(math.exp(min(valid_loss, 100))) for valid_loss in valid_losses])
-                    for i in xrange(len(setIDs)):
-                        setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][i])
-                        print('Validation perplexity for set %s : %g' % (setLangs, valid_ppl[i]))
+                if opt.save_every > 0 and i % opt.save_every == -1 % opt.save_every and onmt.Distributed.isMaster(opt):
+                    # the perplexity of every set (dict)
+                    valid_ppl = evaluator.eval_perplexity(validSets, criterions, setIDs=setIDs)
+                    for j in sorted(valid_ppl):
+                        setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][j])
+                        print('Validation perplexity for set %s : %g' % (setLangs, valid_ppl[j]))
                     
                     
-                    avgDevPpl = sum(valid_ppl) / len(valid_ppl)
+                    avgDevPpl = sum(valid_ppl.values()) / len(valid_ppl)
                     model_state_dict = (model.module.state_dict() if len(opt.gpus) > 1
                     else model.state_dict())
                     model_state_dict = {k: v for k, v in model_state_dict.items()
@@ -214,30 +227,34 @@ class XETrainer(object):
                             'opt': opt,
                             'epoch': ep,
                             'iteration' : i,
-                            'batchOrder' : batchOrder,
+                            'scheduler' : self.scheduler.state_dict(),
                             'optim': optim
                     }
+                    if self.average is not None:
+                        self.average.saveTo(checkpoint)
                     
                     file_name = '%s_ppl_%.2f_e%.2f.pt'
                     #~ valid_ppl = "_".join([("%.2f" % math.exp(min(valid_loss, 100))) for valid_loss in valid_losses])
                     print('Writing to %s_ppl_%.2f_e%.2f.pt' % (opt.save_model, avgDevPpl, ep))
-                    torch.save(checkpoint,
-                         file_name
-                         % (opt.save_model, avgDevPpl, ep))
-            return [total_loss[j] / total_words[j] for j in xrange(len(setIDs))]
+                    self.checkpoints.save(checkpoint, file_name % (opt.save_model, avgDevPpl, ep), score=avgDevPpl)
+                
+                # logging, evaluation and saving are counted as 'other'
+                profiler.endStep()
+            return [total_loss[j] / max(total_words[j], 1) for j in xrange(len(setIDs))]
             
         #~ valid_losses = eval(model, criterions, validSets, setIDs)
-        bleu_scores = evaluator.eval_translate(validSets)
-        for i in xrange(len(setIDs)):
-            setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][i])
-            print('Validation BLEU Scores for set %s : %g' % (setLangs, bleu_scores[i]))
-        
-        valid_losses = evaluator.eval_perplexity(validSets, criterions, setIDs=setIDs)
-        
-        #~ for i in xrange(len(setIDs)):
-        for id in valid_losses:
-            setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][id])
-            print('Validation perplexity for set %s : %g' % (setLangs, valid_losses[id]))
+        if onmt.Distributed.isMaster(opt):
+            bleu_scores = evaluator.eval_translate(validSets)
+            for i in xrange(len(setIDs)):
+                setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][i])
+                print('Validation BLEU Scores for set %s : %g' % (setLangs, bleu_scores[i]))
+            
+            valid_losses = evaluator.eval_perplexity(validSets, criterions, setIDs=setIDs)
+            
+            #~ for i in xrange(len(setIDs)):
+            for id in valid_losses:
+                setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][id])
+                print('Validation perplexity for set %s : %g' % (setLangs, valid_losses[id]))
             
         
                     
@@ -250,12 +267,16 @@ class XETrainer(object):
             for i in xrange(len(setIDs)):
                 print('Training perplexity for set %d : %g' % (i, train_ppl[i]))
 
+            # only the first rank evaluates and saves
+            if not onmt.Distributed.isMaster(opt):
+                continue
+
             #  (2) evaluate on the validation set
             valid_ppl = evaluator.eval_perplexity(validSets, criterions, setIDs=setIDs)
-            avgDevPpl = sum(valid_ppl) / len(valid_ppl)
-            for id in valid_losses:
+            avgDevPpl = sum(valid_ppl.values()) / len(valid_ppl)
+            for id in valid_ppl:
                 setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][id])
-                print('Validation perplexity for set %s : %g' % (setLangs, valid_losses[id]))
+                print('Validation perplexity for set %s : %g' % (setLangs, valid_ppl[id]))
             
             # learning rate is changed manually - or automatically
 
@@ -274,13 +295,16 @@ class XETrainer(object):
                 'opt': opt,
                 'epoch': epoch,
                 'iteration' : -1,
-                'batchOrder' : None,
+                'scheduler' : None,
                 'optim': optim
             }
+            if self.average is not None:
+                self.average.saveTo(checkpoint)
             
                     
             file_name = '%s_ppl_%.2f_e%d.pt'
             print('Writing to %s_ppl_%.2f_e%d.pt' % (opt.save_model, avgDevPpl, epoch))
-            torch.save(checkpoint,
-                                         file_name
-                                         % (opt.save_model, avgDevPpl, epoch))
+            self.checkpoints.save(checkpoint, file_name % (opt.save_model, avgDevPpl, epoch), score=avgDevPpl)
+
+        # wait for the last checkpoint
+        self.checkpoints.close()
@@ -3,6 +3,7 @@ import onmt.Markdown
 import argparse
 import torch
 import os.path
+import multiprocessing
 from collections import OrderedDict
 
 
@@ -15,6 +16,12 @@ parser.add_argument('-config',    help="Read options from this file")
 
 parser.add_argument('-src_type', default="text",
                     help="Type of the source input. Options are [text|img].")
+parser.add_argument('-src_img_dir', default="",
+                    help="Source image directory")
+parser.add_argument('-src_img_features', default="",
+                    help="""Prefix of the CNN features written by
+                    tools/extract_img_features.py. The source images are
+                    then read from this store instead of decoded again.""")
 parser.add_argument('-load_from', default="",
                     help="Load the preprocessed data.")
 
@@ -54,6 +61,26 @@ parser.add_argument('-tgt_seq_length', type=int, default=50,
 parser.add_argument('-tgt_seq_length_trunc', type=int, default=0,
                     help="Truncate target sequence length.")
 
+parser.add_argument('-dedup', action='store_true',
+                    help="""Remove exact duplicates (after lower casing and
+                    removing punctuation) from the training pairs""")
+parser.add_argument('-near_dup', action='store_true',
+                    help="""Remove training pairs whose source is a near
+                    duplicate of a kept source (MinHash/LSH over word n-grams)""")
+parser.add_argument('-near_dup_ngram', type=int, default=3,
+                    help="Size of the source n-grams compared by -near_dup")
+parser.add_argument('-near_dup_bands', type=int, default=10,
+                    help="Number of LSH bands of the MinHash signature")
+parser.add_argument('-near_dup_rows', type=int, default=12,
+                    help="""Number of MinHash values per LSH band. More rows
+                    (or fewer bands) only remove more similar sources.""")
+parser.add_argument('-max_length_ratio', type=float, default=0,
+                    help="""Remove training pairs where one side is more than
+                    this many times longer than the other. 0 keeps all.""")
+parser.add_argument('-filter_capacity', type=int, default=1 << 24,
+                    help="""Number of hashes each duplicate index can hold
+                    (8 bytes each), this bounds the memory of the filters""")
+
 parser.add_argument('-shuffle',    type=int, default=1,
                     help="Shuffle data")
 parser.add_argument('-seed',       type=int, default=3435,
@@ -61,30 +88,68 @@ parser.add_argument('-seed',       type=int, default=3435,
 
 parser.add_argument('-lower', action='store_true', help='lowercase data')
 
+parser.add_argument('-bpe_codes', default="",
+                    help="""Segment the raw text of both sides with the BPE
+                    merges in this file (subword-nmt format) before building
+                    the vocabularies.""")
+
+parser.add_argument('-num_shards', type=int, default=1,
+                    help="""Split the training data of every pair into this
+                    many shards, saved in separate files next to
+                    save_data.train.pt. The trainer then only keeps a few
+                    shards in memory. 1 keeps everything in one file.""")
+
 parser.add_argument('-report_every', type=int, default=100000,
                     help="Report status every this many sentences")
+parser.add_argument('-workers', type=int, default=1,
+                    help="""Number of processes counting the words of the
+                    files and encoding the training and validation data of
+                    the pairs in parallel""")
 
 opt = parser.parse_args()
 
 torch.manual_seed(opt.seed)
 
+bpe = onmt.BPE(opt.bpe_codes) if opt.bpe_codes else None
+
+featureStore = None
+if opt.src_img_features:
+    featureStore = onmt.FeatureStore(opt.src_img_features)
+
+
+def loadImageLibs():
+    "Conditional import of torch image libs."
+    global Image, transforms
+    from PIL import Image
+    from torchvision import transforms
+
+
+def tokenize(line):
+    words = line.split()
+    return bpe.segmentTokens(words) if bpe is not None else words
+
+
+def countWords(filename):
+    "Word counts of a file, in the order the words first appear."
+    print("Reading file " + filename)
+    counts = OrderedDict()
+    with open(filename) as f:
+        for sent in f:
+            for word in tokenize(sent):
+                counts[word] = counts.get(word, 0) + 1
+    return filename, counts
+
 
-def makeVocabulary(filenames, size):
+def makeVocabulary(filenames, size, counts):
     vocab = onmt.Dict([onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD,
                        onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD],
                       lower=opt.lower)
                       
+    # the counts of every file were gathered once in the counting pass
     for filename in filenames:
-            print("Reading file " + filename)
-            with open(filename) as f:
-                for sent in f.readlines():
-                    for word in sent.split():
-                        vocab.add(word)
-    #~ with open(filename) as f:
-        #~ for sent in f.readlines():
-            #~ for word in sent.split():
-                #~ vocab.add(word)
-#~ 
+        for word, count in counts[filename].items():
+            vocab.add(word, count=count)
+
     originalSize = vocab.size()
     vocab = vocab.prune(size)
     print('Created dictionary of size %d (pruned from %d)' %
@@ -93,22 +158,27 @@ def makeVocabulary(filenames, size):
     return vocab
 
 
-def initVocabulary(name, dataFiles, vocabFile, vocabSize):
+def vocabFileOf(name, vocabFile):
+    if vocabFile is not None and os.path.isfile(vocabFile + "." + name):
+        return vocabFile + "." + name
+    return None
+
+
+def initVocabulary(name, dataFiles, vocabFile, vocabSize, counts):
 
     vocab = None
+    vocabFile = vocabFileOf(name, vocabFile)
     if vocabFile is not None:
-                vocabFile = vocabFile + "." + name
-                if os.path.isfile(vocabFile):
         # If given, load existing word dictionary.
-                    print('Reading ' + name + ' vocabulary from \'' + vocabFile + '\'...')
-                    vocab = onmt.Dict()
-                    vocab.loadFile(vocabFile)
-                    print('Loaded ' + str(vocab.size()) + ' ' + name + ' words')
+        print('Reading ' + name + ' vocabulary from \'' + vocabFile + '\'...')
+        vocab = onmt.Dict()
+        vocab.loadFile(vocabFile)
+        print('Loaded ' + str(vocab.size()) + ' ' + name + ' words')
 
     if vocab is None:
         # If a dictionary is still missing, generate it.
         print('Building ' + name + ' vocabulary...')
-        genWordVocab = makeVocabulary(dataFiles, vocabSize)
+        genWordVocab = makeVocabulary(dataFiles, vocabSize, counts)
         vocab = genWordVocab
 
     print("Done")
@@ -120,7 +190,7 @@ def saveVocabulary(name, vocab, file):
     vocab.writeFile(file)
 
 
-def makeData(srcFile, tgtFile, srcDicts, tgtDicts):
+def makeData(srcFile, tgtFile, srcDicts, tgtDicts, corpusFilter=None):
     src, tgt = [], []
     sizes = []
     count, ignored = 0, 0
@@ -150,12 +220,18 @@ def makeData(srcFile, tgtFile, srcDicts, tgtDicts):
             print('WARNING: ignoring an empty line ('+str(count+1)+')')
             continue
 
-        srcWords = sline.split()
-        tgtWords = tline.split()
+        srcWords = tokenize(sline) if opt.src_type == "text" else sline.split()
+        tgtWords = tokenize(tline)
 
         if len(srcWords) <= opt.src_seq_length \
            and len(tgtWords) <= opt.tgt_seq_length:
 
+            # Duplicates and misaligned pairs
+            if corpusFilter is not None and \
+               corpusFilter.check(sline, tline) is not None:
+                count += 1
+                continue
+
             # Check truncation condition.
             if opt.src_seq_length_trunc != 0:
                 srcWords = srcWords[:opt.src_seq_length_trunc]
@@ -165,6 +241,12 @@ def makeData(srcFile, tgtFile, srcDicts, tgtDicts):
             if opt.src_type == "text":
                 src += [srcDicts.convertToIdx(srcWords,
                                               onmt.Constants.UNK_WORD)]
+            elif opt.src_type == "img" and featureStore is not None:
+                # only the id in the feature store is kept
+                featureID = featureStore.lookup(srcWords[0])
+                assert featureID is not None, \
+                    'No features for image %s' % srcWords[0]
+                src += [featureID]
             elif opt.src_type == "img":
                 loadImageLibs()
                 src += [transforms.ToTensor()(
@@ -174,7 +256,13 @@ def makeData(srcFile, tgtFile, srcDicts, tgtDicts):
                                           onmt.Constants.UNK_WORD,
                                           onmt.Constants.BOS_WORD,
                                           onmt.Constants.EOS_WORD)]
-            sizes += [len(srcWords)]
+            # images are sorted by width, the length the encoder reads
+            if opt.src_type == "text":
+                sizes += [len(srcWords)]
+            elif featureStore is not None:
+                sizes += [featureStore.width(src[-1])]
+            else:
+                sizes += [src[-1].size(2)]
         else:
             ignored += 1
 
@@ -198,13 +286,101 @@ def makeData(srcFile, tgtFile, srcDicts, tgtDicts):
     src = [src[idx] for idx in perm]
     tgt = [tgt[idx] for idx in perm]
 
+    if opt.src_type == "img" and featureStore is not None:
+        src = onmt.FeatureSequence(featureStore.prefix, src)
+
     print(('Prepared %d sentences ' +
           '(%d ignored due to length == 0 or src len > %d or tgt len > %d)') %
           (len(src), ignored, opt.src_seq_length, opt.tgt_seq_length))
 
+    if corpusFilter is not None:
+        corpusFilter.report('%s & %s' % (srcFile, tgtFile))
+
     return src, tgt
 
 
+def makeFilter():
+    if not (opt.dedup or opt.near_dup or opt.max_length_ratio > 0):
+        return None
+    return onmt.CorpusFilter(exact=opt.dedup, nearDup=opt.near_dup,
+                             maxLengthRatio=opt.max_length_ratio,
+                             ngram=opt.near_dup_ngram,
+                             bands=opt.near_dup_bands,
+                             rows=opt.near_dup_rows,
+                             capacity=opt.filter_capacity,
+                             seed=opt.seed)
+
+
+def packSentences(sents):
+    """
+    One token buffer and the lengths for a list of sentences: much cheaper
+    to send between processes (and to save) than many small tensors.
+    """
+    lengths = [x.size(0) for x in sents]
+    if len(sents) == 0:
+        return torch.LongTensor(), lengths
+    return torch.cat(sents, 0), lengths
+
+
+def unpackSentences(tokens, lengths):
+    "The sentences of a packed buffer, as views into it."
+    sents, offset = [], 0
+    for length in lengths:
+        sents.append(tokens.narrow(0, offset, length))
+        offset += length
+    return sents
+
+
+def encodeJob(job):
+    "Encode one (pair, split) of the DAG, runs in a worker process."
+    i, split, srcFile, tgtFile, srcDict, tgtDict = job
+    # the shuffling of every job only depends on the seed
+    torch.manual_seed(opt.seed + 2 * i + (split == 'valid'))
+    print('Preparing %s data ... for set %d ' %
+          ('training' if split == 'train' else 'validation', i))
+    # every training pair is filtered on its own
+    corpusFilter = makeFilter() if split == 'train' else None
+    src, tgt = makeData(srcFile, tgtFile, srcDict, tgtDict, corpusFilter)
+    if opt.src_type == "text":
+        src = packSentences(src)
+    return i, split, src, packSentences(tgt)
+
+
+def runJobs(function, jobs, pool):
+    "Results of the jobs in order, computed by the pool if there is one."
+    if pool is None:
+        return (function(job) for job in jobs)
+    return pool.imap(function, jobs)
+
+
+def saveShards(i, src, tgt, shardIndex):
+    """
+    Write the training data of pair i into opt.num_shards files. Shard k
+    takes every num_shards-th example starting at k, so every shard stays
+    sorted by length and has the same length distribution.
+    """
+    for k in range(opt.num_shards):
+        # each shard gets its own buffer, views would save the whole pair
+        shardSrc = unpackSentences(*packSentences(src[k::opt.num_shards]))
+        shardTgt = unpackSentences(*packSentences(tgt[k::opt.num_shards]))
+
+        lengthCounts = dict()
+        for s in shardSrc:
+            lengthCounts[s.size(0)] = lengthCounts.get(s.size(0), 0) + 1
+        maxSrc = max([s.size(0) for s in shardSrc] + [0])
+        maxTgt = max([t.size(0) for t in shardTgt] + [0])
+
+        fileName = opt.save_data + '.train.shard%d.pair%d.pt' % (k, i)
+        print('Saving shard %d of set %d to \'%s\'...' % (k, i, fileName))
+        torch.save({'src': shardSrc, 'tgt': shardTgt}, fileName)
+
+        # file names are relative to the directory of the main file
+        shardIndex['shards'][k].append(os.path.basename(fileName))
+        shardIndex['sizes'][k].append(len(shardSrc))
+        shardIndex['lengthCounts'][k].append(lengthCounts)
+        shardIndex['maxLengths'][k].append((maxSrc, maxTgt))
+
+
 def main():
     
     if len(opt.load_from) == 0:
@@ -241,103 +417,100 @@ def main():
         dicts['tgtLangs'] = uniqTgtLangs
         #~ print(uniqSrcLangs, uniqTgtLangs)
         
-        for lang in langs:
-            if lang not in dicts['vocabs']:
-                dataFilesWithLang = []
-                for i in range(len(srcFiles)):
-                    if srcLangs[i] == lang:
-                        dataFilesWithLang.append(srcFiles[i])
-                    if tgtLangs[i] == lang:
-                        dataFilesWithLang.append(tgtFiles[i])
-                        
-                # We need to remove duplicate of this list 
-                
-                sortedDataFiles = list(OrderedDict.fromkeys(dataFilesWithLang))
-                dicts['vocabs'][lang] = initVocabulary(lang, sortedDataFiles, 
-                                                                                                         opt.vocab, opt.vocab_size)
-                #~ print(dataFilesWithLang)
-        
-        # store the actual dictionaries for each side
-        dicts['src'] = dict()
-        dicts['tgt'] = dict()
-
-        train = {}
-        train['src'] = list()
-        train['tgt'] = list()
-        dicts['setIDs'] = list()
-        dicts['setLangs'] = list()
-        
-        valid = {}
-        valid['src'] = list()
-        valid['tgt'] = list()
-
-        for i in range(dicts['nSets']):
-            
-            dicts['setIDs'].append([uniqSrcLangs.index(srcLangs[i]), uniqTgtLangs.index(tgtLangs[i])])
-            dicts['setLangs'].append([srcLangs[i], tgtLangs[i]])
-            
-            srcID = dicts['setIDs'][i][0]
-            tgtID = dicts['setIDs'][i][1]
-            
-            if srcID not in dicts['src']:
-                dicts['src'][srcID] = dicts['vocabs'][srcLangs[i]]
-            if tgtID not in dicts['tgt']:
-                dicts['tgt'][tgtID] = dicts['vocabs'][tgtLangs[i]]
-            
-            srcDict = dicts['vocabs'][srcLangs[i]]
-            tgtDict = dicts['vocabs'][tgtLangs[i]]
-            
-            print('Preparing training ... for set %d ' % i)
-            srcSet, tgtSet = makeData(srcFiles[i], tgtFiles[i], 
-                                                                                                     srcDict, tgtDict)
-            train['src'].append(srcSet)
-            train['tgt'].append(tgtSet)
-            
-        #dataset = torch.load(opt.load_from)
-        
-        #dicts = dataset['dicts']
-        
-        #srcLangs = opt.src_langs.split("|")
-        #tgtLangs = opt.tgt_langs.split("|")
-        
-        #srcFiles = opt.train_src.split("|")
-        #tgtFiles = opt.train_tgt.split("|")
-
-        #validSrcFiles = opt.valid_src.split("|")
-        #validTgtFiles = opt.valid_tgt.split("|")
-        
-        #langs = dicts['langs']
-        
-        nPairs = len(srcLangs)
-        
-        print(dicts['setIDs'])
-        
-        for i in range(dicts['nSets']):
-            srcDict = dicts['vocabs'][srcLangs[i]]
-            tgtDict = dicts['vocabs'][tgtLangs[i]]
-            
-            #~ setID = uniqSrcLangs.index(srcLangs[i])
-            
-            srcID = dicts['srcLangs'].index(srcLangs[i])
-            tgtID = dicts['tgtLangs'].index(tgtLangs[i])
-            
-            setID = dicts['setIDs'].index([srcID, tgtID])
-            
-            #print('Preparing training ... for set %d ' % setID)
-            print('Preparing validation ... for set %d ' % i)
-                
-            validSrcSet, validTgtSet = makeData(validSrcFiles[i], validTgtFiles[i],
-                                                 srcDict, tgtDict)
-                                                                                                     
-            valid['src'].append(validSrcSet)
-            valid['tgt'].append(validTgtSet)
-                
-                
-            if opt.vocab is None:
-                print('Saving vocabularies ... ')
-                for lang in langs:
-                    saveVocabulary(lang, dicts['vocabs'][lang], opt.save_data + '.dict.' + lang)
-                print('Done')
+        pool = multiprocessing.Pool(opt.workers) if opt.workers > 1 else None
+
+        try:
+            # (1) one counting pass for every file a vocabulary is built from,
+            # even if the file is used by several pairs
+            dataFilesWithLang = OrderedDict((lang, []) for lang in langs)
+            for i in range(len(srcFiles)):
+                dataFilesWithLang[srcLangs[i]].append(srcFiles[i])
+                dataFilesWithLang[tgtLangs[i]].append(tgtFiles[i])
+
+            countFiles = []
+            for lang in langs:
+                # We need to remove duplicate of this list
+                dataFilesWithLang[lang] = list(OrderedDict.fromkeys(dataFilesWithLang[lang]))
+                if vocabFileOf(lang, opt.vocab) is None:
+                    countFiles += dataFilesWithLang[lang]
+            countFiles = list(OrderedDict.fromkeys(countFiles))
+            counts = dict(runJobs(countWords, countFiles, pool))
+
+            for lang in langs:
+                dicts['vocabs'][lang] = initVocabulary(lang, dataFilesWithLang[lang],
+                                                       opt.vocab, opt.vocab_size,
+                                                       counts)
+            del counts
+
+            # store the actual dictionaries for each side
+            dicts['src'] = dict()
+            dicts['tgt'] = dict()
+            dicts['setIDs'] = list()
+            dicts['setLangs'] = list()
+
+            for i in range(dicts['nSets']):
+                dicts['setIDs'].append([uniqSrcLangs.index(srcLangs[i]), uniqTgtLangs.index(tgtLangs[i])])
+                dicts['setLangs'].append([srcLangs[i], tgtLangs[i]])
+
+                srcID = dicts['setIDs'][i][0]
+                tgtID = dicts['setIDs'][i][1]
+
+                if srcID not in dicts['src']:
+                    dicts['src'][srcID] = dicts['vocabs'][srcLangs[i]]
+                if tgtID not in dicts['tgt']:
+                    dicts['tgt'][tgtID] = dicts['vocabs'][tgtLangs[i]]
+
+            print(dicts['setIDs'])
+
+            # (2) training and validation data of all pairs are encoded
+            # in parallel
+            jobs = []
+            for i in range(dicts['nSets']):
+                srcDict = dicts['vocabs'][srcLangs[i]]
+                tgtDict = dicts['vocabs'][tgtLangs[i]]
+                jobs.append((i, 'train', srcFiles[i], tgtFiles[i], srcDict, tgtDict))
+                jobs.append((i, 'valid', validSrcFiles[i], validTgtFiles[i], srcDict, tgtDict))
+
+            train = {}
+            train['src'] = [None] * dicts['nSets']
+            train['tgt'] = [None] * dicts['nSets']
+
+            valid = {}
+            valid['src'] = [None] * dicts['nSets']
+            valid['tgt'] = [None] * dicts['nSets']
+
+            if opt.num_shards > 1:
+                assert opt.src_type == "text"
+                # the training data is replaced by the index of the shards
+                train = {key: [list() for k in range(opt.num_shards)]
+                         for key in ['shards', 'sizes', 'lengthCounts',
+                                     'maxLengths']}
+
+            # the results come back in the order of the jobs
+            for i, split, srcSet, tgtSet in runJobs(encodeJob, jobs, pool):
+                if opt.src_type == "text":
+                    srcSet = unpackSentences(*srcSet)
+                tgtSet = unpackSentences(*tgtSet)
+                if split == 'valid':
+                    valid['src'][i] = srcSet
+                    valid['tgt'][i] = tgtSet
+                elif opt.num_shards > 1:
+                    saveShards(i, srcSet, tgtSet, train)
+                else:
+                    train['src'][i] = srcSet
+                    train['tgt'][i] = tgtSet
+                del srcSet, tgtSet
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # (3) a single write of the vocabularies and the data
+        if opt.vocab is None:
+            print('Saving vocabularies ... ')
+            for lang in langs:
+                saveVocabulary(lang, dicts['vocabs'][lang], opt.save_data + '.dict.' + lang)
+            print('Done')
             
         print('Saving data to \'' + opt.save_data + '.train.pt\'...')
         save_data = {'dicts': dicts,
@@ -3,6 +3,7 @@ import onmt.Markdown
 import argparse
 import torch
 import os.path
+import hashlib
 from collections import OrderedDict
 
 
@@ -64,6 +65,16 @@ parser.add_argument('-lower', action='store_true', help='lowercase data')
 parser.add_argument('-report_every', type=int, default=100000,
                     help="Report status every this many sentences")
 
+parser.add_argument('-cache', default=None,
+                    help="""File keeping the encoded chunks of every input file
+                    with their content hash. Only new or changed chunks are
+                    encoded again. Default: save_data.cache.pt""")
+parser.add_argument('-no_cache', action='store_true',
+                    help="Encode all data and do not write the cache.")
+parser.add_argument('-chunk_size', type=int, default=100000,
+                    help="""Number of lines of the input files hashed and
+                    cached together""")
+
 opt = parser.parse_args()
 
 torch.manual_seed(opt.seed)
@@ -120,28 +131,55 @@ def saveVocabulary(name, vocab, file):
     vocab.writeFile(file)
 
 
-def makeData(srcFile, tgtFile, srcDicts, tgtDicts):
-    src, tgt = [], []
-    sizes = []
-    count, ignored = 0, 0
+def readChunks(srcFile, tgtFile, chunkSize):
+    "Yield the lines of the two files in chunks of chunkSize line pairs."
+    srcLines, tgtLines = [], []
 
-    print('Processing %s & %s ...' % (srcFile, tgtFile))
-    srcF = open(srcFile)
-    tgtF = open(tgtFile)
+    with open(srcFile) as srcF, open(tgtFile) as tgtF:
+        while True:
+            sline = srcF.readline()
+            tline = tgtF.readline()
 
-    while True:
-        sline = srcF.readline()
-        tline = tgtF.readline()
+            # normal end of file
+            if sline == "" and tline == "":
+                break
 
-        # normal end of file
-        if sline == "" and tline == "":
-            break
+            # source or target does not have same number of lines
+            if sline == "" or tline == "":
+                print('WARNING: src and tgt do not have the same # of sentences')
+                break
 
-        # source or target does not have same number of lines
-        if sline == "" or tline == "":
-            print('WARNING: src and tgt do not have the same # of sentences')
-            break
+            srcLines.append(sline)
+            tgtLines.append(tline)
+
+            if len(srcLines) == chunkSize:
+                yield srcLines, tgtLines
+                srcLines, tgtLines = [], []
+
+    if len(srcLines) > 0:
+        yield srcLines, tgtLines
 
+
+def chunkHash(srcLines, tgtLines, signature):
+    """
+    Hash of a chunk together with everything its encoding depends on:
+    the vocabularies and the length options.
+    """
+    h = hashlib.md5()
+    h.update(signature.encode('utf-8'))
+    for lines in [srcLines, tgtLines]:
+        for line in lines:
+            h.update(line if isinstance(line, bytes) else line.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def encodeChunk(srcLines, tgtLines, srcDicts, tgtDicts, count):
+    src, tgt = [], []
+    sizes = []
+    ignored = 0
+
+    for sline, tline in zip(srcLines, tgtLines):
         sline = sline.strip()
         tline = tline.strip()
 
@@ -162,14 +200,8 @@ def makeData(srcFile, tgtFile, srcDicts, tgtDicts):
             if opt.tgt_seq_length_trunc != 0:
                 tgtWords = tgtWords[:opt.tgt_seq_length_trunc]
 
-            if opt.src_type == "text":
-                src += [srcDicts.convertToIdx(srcWords,
-                                              onmt.Constants.UNK_WORD)]
-            elif opt.src_type == "img":
-                loadImageLibs()
-                src += [transforms.ToTensor()(
-                    Image.open(opt.src_img_dir + "/" + srcWords[0]))]
-
+            src += [srcDicts.convertToIdx(srcWords,
+                                          onmt.Constants.UNK_WORD)]
             tgt += [tgtDicts.convertToIdx(tgtWords,
                                           onmt.Constants.UNK_WORD,
                                           onmt.Constants.BOS_WORD,
@@ -183,8 +215,58 @@ def makeData(srcFile, tgtFile, srcDicts, tgtDicts):
         if count % opt.report_every == 0:
             print('... %d sentences prepared' % count)
 
-    srcF.close()
-    tgtF.close()
+    return src, tgt, sizes, ignored, count
+
+
+def makeData(srcFile, tgtFile, srcDicts, tgtDicts, oldCache=None, newCache=None):
+    """
+    Encode a parallel corpus chunk by chunk. A chunk found in oldCache with
+    the same hash is reused as is; every chunk is stored in newCache.
+    """
+    assert opt.src_type == "text", "Only text data can be updated"
+
+    src, tgt = [], []
+    sizes = []
+    count, ignored = 0, 0
+    reused, encoded = 0, 0
+
+    signature = '%s %s %d %d %d %d\n' % (srcDicts.checksum(),
+                                        tgtDicts.checksum(),
+                                        opt.src_seq_length,
+                                        opt.src_seq_length_trunc,
+                                        opt.tgt_seq_length,
+                                        opt.tgt_seq_length_trunc)
+
+    print('Processing %s & %s ...' % (srcFile, tgtFile))
+    for c, (srcLines, tgtLines) in enumerate(readChunks(srcFile, tgtFile,
+                                                         opt.chunk_size)):
+        key = (os.path.abspath(srcFile), os.path.abspath(tgtFile), c)
+        digest = chunkHash(srcLines, tgtLines, signature)
+
+        cached = oldCache.get(key) if oldCache is not None else None
+        if cached is not None and cached['hash'] == digest:
+            chunk = cached
+            count += chunk['count']
+            reused += 1
+        else:
+            chunkSrc, chunkTgt, chunkSizes, chunkIgnored, newCount = \
+                encodeChunk(srcLines, tgtLines, srcDicts, tgtDicts, count)
+            chunk = {'hash': digest, 'src': chunkSrc, 'tgt': chunkTgt,
+                     'sizes': chunkSizes, 'ignored': chunkIgnored,
+                     'count': newCount - count}
+            count = newCount
+            encoded += 1
+
+        if newCache is not None:
+            newCache[key] = chunk
+
+        src += chunk['src']
+        tgt += chunk['tgt']
+        sizes += chunk['sizes']
+        ignored += chunk['ignored']
+
+    print('... %d chunks encoded, %d chunks reused from the cache' %
+          (encoded, reused))
 
     if opt.shuffle == 1:
         print('... shuffling sentences')
@@ -227,52 +309,53 @@ def main():
     
     print(dicts['setIDs'])
     
-    train = {}
-    train['src'] = list()
-    train['tgt'] = list()
-    dicts['setIDs'] = list()
-    dicts['setLangs'] = list()
+    # Encoded chunks of the previous run
+    cacheFile = opt.cache if opt.cache is not None else opt.save_data + '.cache.pt'
+    oldCache, newCache = None, None
+    if not opt.no_cache:
+        newCache = dict()
+        if os.path.isfile(cacheFile):
+            print("Loading the chunk cache from " + cacheFile)
+            oldCache = torch.load(cacheFile)
     
-    valid = {}
-    valid['src'] = list()
-    valid['tgt'] = list()
+    # the data of the pairs which are not given is kept as it is,
+    # the given pairs replace theirs
+    assert 'shards' not in dataset['train'], \
+        "The training data of sharded datasets cannot be updated"
+    train = {'src': list(dataset['train']['src']),
+             'tgt': list(dataset['train']['tgt'])}
+    valid = {'src': list(dataset['valid']['src']),
+             'tgt': list(dataset['valid']['tgt'])}
+    assert len(train['src']) == dicts['nSets'] and len(valid['src']) == dicts['nSets']
     
     for i in range(nPairs):
         srcDict = dicts['vocabs'][srcLangs[i]]
         tgtDict = dicts['vocabs'][tgtLangs[i]]
         
-        #~ setID = uniqSrcLangs.index(srcLangs[i])
-        
         srcID = int(dicts['srcLangs'].index(srcLangs[i]))
         tgtID = int(dicts['tgtLangs'].index(tgtLangs[i]))
         
-        print srcID, tgtID
-        
         setID = -1
-        for i, cur_pair in enumerate(dicts['setIDs']):
-            print cur_pair
-            print cur_pair[0], cur_pair[1]
+        for j, cur_pair in enumerate(dicts['setIDs']):
             if cur_pair[0] == srcID and cur_pair[1] == tgtID:
-                setID = i
+                setID = j
             
         assert setID >= 0, "Cannot find the language pair"
-            #~ 
-        #~ setID = dicts['setIDs'].index([srcID, tgtID])
         
         print('Preparing training ... for set %d ' % setID)
         
         srcSet, tgtSet = makeData(srcFiles[i], tgtFiles[i], 
-                                  srcDict, tgtDict)
+                                  srcDict, tgtDict, oldCache, newCache)
         
-        train['src'].append(srcSet)
-        train['tgt'].append(tgtSet)
+        train['src'][setID] = srcSet
+        train['tgt'][setID] = tgtSet
             
-        print('Preparing validation ... for set %d ' % i)
+        print('Preparing validation ... for set %d ' % setID)
             
         validSrcSet, validTgtSet = makeData(validSrcFiles[i], validTgtFiles[i],
-                                             srcDict, tgtDict)
-        valid['src'].append(validSrcSet)
-        valid['tgt'].append(validTgtSet)
+                                             srcDict, tgtDict, oldCache, newCache)
+        valid['src'][setID] = validSrcSet
+        valid['tgt'][setID] = validTgtSet
         
         
         #~ 
@@ -370,6 +453,11 @@ def main():
                  'valid': valid}
         
     torch.save(save_data, opt.save_data + '.train.pt')
+    
+    # Chunks of files which are not given any more are dropped
+    if newCache is not None:
+        print('Saving the chunk cache to \'' + cacheFile + '\'...')
+        torch.save(newCache, cacheFile)
     print('Finished.')
         
 
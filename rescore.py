@@ -2,11 +2,11 @@ from __future__ import division
 
 import onmt
 import onmt.Markdown
+import onmt.StreamReader
 import torch
 import argparse
 import math
 import numpy
-from itertools import repeat
 
 parser = argparse.ArgumentParser(description='translate.py')
 onmt.Markdown.add_md_help_argument(parser)
@@ -62,12 +62,6 @@ def reportScore(name, scoreTotal, wordsTotal):
         name, math.exp(-scoreTotal/wordsTotal)))
 
 
-def addone(f):
-    for line in f:
-        yield line
-    yield None
-
-
 def main():
     opt = parser.parse_args()
     opt.cuda = opt.gpu > -1
@@ -80,96 +74,40 @@ def main():
 
     outF = open(opt.output, 'w')
 
-    goldScoreTotal, goldWordsTotal = 0, 0
-
-    srcBatch, tgtBatch = [], []
-    
-    tgtScores = []
-    tgtWords = []
-
-    sent_count = -1 # counting every source sentence
-    global_count = 0 # counting every target sentence (n times more than src)
+    # the n-best blocks of several source sentences are rescored together,
+    # only the current group of blocks is kept in memory
+    groups = []
+    nHyps = 0
 
-    tgtF = open(opt.tgt).readlines() 
-    srcF = open(opt.src).readlines() 
-    
-    def run_rescore(hyp_id, srcBatch, tgtBatch, tgtWords, tgtScores):
-        
-        #~ repeatedSrcBatch = [sent for sent in repeat(sent, 
-        
-        srcSent = srcBatch[0]
-        
-        repeatedSrcBatch = [sent for sent in repeat(srcSent, len(tgtBatch))] 
+    def run_rescore(groups):
         
-        #~ print(repeatedSrcBatch)
+        repeatedSrcBatch, tgtBatch = [], []
+        for hyp_id, srcTokens, hypotheses in groups:
+            repeatedSrcBatch += [srcTokens for _ in hypotheses]
+            tgtBatch += [hypothesis.split() for hypothesis, _ in hypotheses]
         
         scores = rescorer.rescore(repeatedSrcBatch, tgtBatch)
         
-        #~ print(len(scores))
-        
-        #~ print(scores)
-        #~ print(srcSent)
+        i = 0
+        for hyp_id, srcTokens, hypotheses in groups:
+            for tgtWords, tgtScores in hypotheses:
+                output_line = str(hyp_id) + " ||| " + tgtWords + " ||| " + tgtScores + " " + str(scores[i])
+                print(output_line)
+                outF.write(output_line + '\n')
+                i += 1
+        outF.flush()
     
-        for i in xrange(len(scores)):
-            
-            
-            #~ 
-            output_line = str(hyp_id) + " ||| " + tgtWords[i] + " ||| " + tgtScores[i] + " " + str(scores[i])
-            #~ 
-            print(output_line)
-    
-    
-    while True:
-        
-        tgtLine = tgtF[global_count] 
-        
-        tgtLine = tgtLine.strip()
-        
-        # Moses format 
-        tgtParts = tgtLine.split(" ||| ")
-        
-        hyp_id = int(tgtParts[0].strip())
-        
-        #~ print(hyp_id)
-        
-        # get a new sentence id
-        if hyp_id != sent_count:
-            
-            if len(srcBatch) > 0:
-                
-                run_rescore(hyp_id - 1, srcBatch, tgtBatch, tgtWords, tgtScores)
-            
-            # add data for new sentence 
-            srcBatch = []
-            tgtBatch = []
-            tgtScores = []
-            tgtWords = []
-            
-            
-            sent_count += 1 
-            srcLine = srcF[sent_count]
-            print(srcLine)
-            srcTokens = srcLine.strip().split()
-            srcBatch += [srcTokens]
-            
-        tgtSent = tgtParts[1].strip()
-        
-        
-        
-        tgtTokens = tgtSent.split()  
-        tgtBatch += [tgtTokens]
-        tgtWords += [tgtSent]
-        tgtScores += [tgtParts[2]]
-        
-        global_count += 1  
-        
-        # end of line
-        if global_count >= len(tgtF):
-            
-            if len(srcBatch) > 0:
-                run_rescore(hyp_id, srcBatch, tgtBatch, tgtWords, tgtScores)
-            
-            break
+    for group in onmt.StreamReader.readNBest(opt.src, opt.tgt):
+        groups.append(group)
+        nHyps += len(group[2])
+        if nHyps >= opt.batch_size:
+            run_rescore(groups)
+            groups, nHyps = [], 0
+
+    if len(groups) > 0:
+        run_rescore(groups)
+
+    outF.close()
         
     
     # Read data from input file
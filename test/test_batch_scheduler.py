@@ -0,0 +1,85 @@
+from __future__ import division
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import onmt
+
+SIZES = [1, 7, 40, 0, 152]
+
+
+def makeSets(sizes=SIZES):
+    "Stand-ins for the Datasets of the pairs, only their length is read."
+    return dict((i, [None] * n) for i, n in enumerate(sizes))
+
+
+def test_counts_follow_the_temperature():
+    total = sum(SIZES)
+    shares = []
+    for temperature in [1.0, 1.5, 2.0, 5.0]:
+        scheduler = onmt.BatchScheduler(1, temperature)
+        counts = scheduler._counts(SIZES)
+        assert sum(counts) == total
+        assert counts[SIZES.index(0)] == 0
+
+        weights = [n ** (1.0 / temperature) for n in SIZES]
+        for count, w in zip(counts, weights):
+            assert abs(count - total * w / sum(weights)) < 1
+        shares.append(counts[0] + counts[1])
+
+    # temperature 1 reads every batch once, higher ones up-sample the small pairs
+    assert onmt.BatchScheduler(1, 1.0)._counts(SIZES) == SIZES
+    assert shares == sorted(shares) and shares[0] < shares[-1]
+
+
+def test_no_batches_gives_an_empty_schedule():
+    scheduler = onmt.BatchScheduler(1, 2.0)
+    assert scheduler._counts([0, 0, 0]) == [0, 0, 0]
+    assert scheduler._counts([]) == []
+    assert scheduler.build(makeSets([0, 0]), 1) == []
+
+
+def test_build_is_deterministic():
+    sets = makeSets()
+    for temperature in [1.0, 3.0]:
+        first = onmt.BatchScheduler(17, temperature).build(sets, 4)
+        again = onmt.BatchScheduler(17, temperature).build(sets, 4)
+        assert first == again
+        assert onmt.BatchScheduler(17, temperature).build(sets, 5) != first
+        assert onmt.BatchScheduler(18, temperature).build(sets, 4) != first
+
+    # with temperature 1 the epoch reads every batch exactly once
+    schedule = onmt.BatchScheduler(17).build(sets, 4)
+    assert sorted(schedule) == [(i, b) for i, n in enumerate(SIZES) for b in range(n)]
+
+    # the curriculum epochs take the batches of every pair in order
+    schedule = onmt.BatchScheduler(17).build(sets, 1, curriculum=True)
+    for i, n in enumerate(SIZES):
+        assert [b for setID, b in schedule if setID == i] == list(range(n))
+
+
+def test_adapt_pair_only():
+    schedule = onmt.BatchScheduler(3, 2.0, adaptPair=2).build(makeSets(), 1)
+    assert sorted(schedule) == [(2, b) for b in range(SIZES[2])]
+
+
+def test_state_dict_round_trip():
+    sets = makeSets()
+    scheduler = onmt.BatchScheduler(5, 2.0)
+    schedule = scheduler.get(sets, 3)
+
+    resumed = onmt.BatchScheduler(0)
+    resumed.load_state_dict(scheduler.state_dict())
+    assert resumed.get(sets, 3) == schedule
+    assert (resumed.seed, resumed.temperature, resumed.epoch) == (5, 2.0, 3)
+
+    # the epochs after the resumed one are the same too
+    assert resumed.get(sets, 4) == scheduler.get(sets, 4)
+
+    # before the first epoch there is no schedule to resume
+    fresh = onmt.BatchScheduler(5, 2.0)
+    resumed = onmt.BatchScheduler(0)
+    resumed.load_state_dict(fresh.state_dict())
+    assert resumed.schedule is None
+    assert resumed.get(sets, 1) == fresh.get(sets, 1)
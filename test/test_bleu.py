@@ -0,0 +1,124 @@
+from __future__ import division
+
+import math
+import random
+from collections import Counter
+
+from onmt.metrics.bleu import CorpusBleu
+
+
+def multiBleu(hyps, refs, order=4):
+    "Corpus BLEU with n-gram Counters, as multi-bleu.perl computes it."
+    correct = [0] * order
+    total = [0] * order
+    hypLength = refLength = 0
+    for hyp, ref in zip(hyps, refs):
+        hypLength += len(hyp)
+        refLength += len(ref)
+        for n in range(1, order + 1):
+            hypNgrams = Counter(tuple(hyp[i:i + n]) for i in range(len(hyp) - n + 1))
+            refNgrams = Counter(tuple(ref[i:i + n]) for i in range(len(ref) - n + 1))
+            total[n - 1] += sum(hypNgrams.values())
+            correct[n - 1] += sum(min(count, refNgrams[ngram])
+                                  for ngram, count in hypNgrams.items())
+
+    if hypLength == 0 or refLength == 0 or min(correct) == 0:
+        return 0.0
+    logPrecision = sum(math.log(c / t) for c, t in zip(correct, total)) / order
+    brevityPenalty = 1.0
+    if hypLength < refLength:
+        brevityPenalty = math.exp(1.0 - refLength / hypLength)
+    return round(100 * brevityPenalty * math.exp(logPrecision), 2)
+
+
+def randomSentence(rng, vocabSize, maxLength):
+    return [rng.randrange(vocabSize) for _ in range(rng.randint(0, maxLength))]
+
+
+def randomHypothesis(rng, ref, vocabSize):
+    "ref with some words replaced, dropped or inserted."
+    hyp = []
+    for word in ref:
+        edit = rng.random()
+        if edit < 0.1:
+            continue
+        hyp.append(rng.randrange(vocabSize) if edit < 0.3 else word)
+        if edit > 0.9:
+            hyp.append(rng.randrange(vocabSize))
+    return hyp
+
+
+def randomBatch(rng, batchSize, vocabSize=8, maxLength=15):
+    refs = [randomSentence(rng, vocabSize, maxLength) for _ in range(batchSize)]
+    hyps = [randomHypothesis(rng, ref, vocabSize) for ref in refs]
+    return hyps, refs
+
+
+def scoreBatches(batches):
+    bleu = CorpusBleu()
+    for hyps, refs in batches:
+        bleu.addBatch(hyps, refs)
+    return bleu.score()
+
+
+def test_random_batches():
+    rng = random.Random(1234)
+    for trial in range(50):
+        batches = [randomBatch(rng, rng.randint(1, 8))
+                   for _ in range(rng.randint(1, 5))]
+        allHyps = [h for hyps, refs in batches for h in hyps]
+        allRefs = [r for hyps, refs in batches for r in refs]
+        assert scoreBatches(batches) == multiBleu(allHyps, allRefs)
+
+
+def test_statistics_do_not_cross_sentences():
+    # the n-grams over the boundary of two sentences must not match
+    hyps = [[1, 2], [3, 4, 5, 6]]
+    refs = [[1, 2, 3, 4], [5, 6]]
+    assert scoreBatches([(hyps, refs)]) == multiBleu(hyps, refs) == 0.0
+
+
+def test_empty_hypotheses():
+    assert scoreBatches([([[]], [[1, 2, 3]])]) == 0.0
+    assert scoreBatches([([[], []], [[1, 2, 3, 4], [5, 6]])]) == 0.0
+
+    # an empty hypothesis among others only adds its reference length
+    hyps = [[1, 2, 3, 4, 5], [], [6, 7, 8, 9]]
+    refs = [[1, 2, 3, 4, 5], [1, 2], [6, 7, 8, 9]]
+    expected = multiBleu(hyps, refs)
+    assert 0.0 < expected < 100.0
+    assert scoreBatches([(hyps[:2], refs[:2]), (hyps[2:], refs[2:])]) == expected
+
+    # a batch with sentences shorter than the higher orders
+    hyps = [[1, 2, 3, 4, 5, 6]]
+    refs = [[1, 2, 3, 4, 5, 6]]
+    assert scoreBatches([(hyps, refs), ([[], [1]], [[2], [1, 3]])]) == \
+        multiBleu(hyps + [[], [1]], refs + [[2], [1, 3]])
+
+
+def test_brevity_penalty():
+    ref = list(range(10))
+    # a perfect hypothesis
+    assert scoreBatches([([ref], [ref])]) == 100.0
+    # a shorter hypothesis is penalized ...
+    short = ref[:6]
+    expected = round(100 * math.exp(1.0 - 10 / 6), 2)
+    assert scoreBatches([([short], [ref])]) == multiBleu([short], [ref]) == expected
+    # ... a longer one only loses precision
+    longer = ref + [20, 21]
+    expected = round(100 * math.exp(sum(math.log((10 - n + 1) / (12 - n + 1))
+                                        for n in range(1, 5)) / 4), 2)
+    assert scoreBatches([([longer], [ref])]) == multiBleu([longer], [ref]) == expected
+    # the penalty is over the corpus lengths, not per sentence
+    hyps = [short, longer]
+    refs = [ref, ref]
+    assert scoreBatches([([short], [ref]), ([longer], [ref])]) == multiBleu(hyps, refs)
+
+
+def test_intern():
+    bleu = CorpusBleu()
+    hyp = bleu.intern('the cat sat on the mat'.split())
+    ref = bleu.intern('the cat sat on the mat .'.split())
+    assert hyp == ref[:6]
+    bleu.addBatch([hyp], [ref])
+    assert bleu.score() == multiBleu([hyp], [ref])
@@ -0,0 +1,140 @@
+from __future__ import division
+
+import os
+import json
+import shutil
+import socket
+import argparse
+import tempfile
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from torch.autograd import Variable
+
+import onmt
+import onmt.Distributed
+
+# the options of the ranks, set by the test before launching them
+opt = None
+
+VOCAB_SIZE = 20
+
+
+def freePort():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def makeDicts():
+    vocab = onmt.Dict([onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD,
+                       onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD])
+    for i in range(vocab.size(), VOCAB_SIZE):
+        vocab.add('w%d' % i)
+    return {'src': {0: vocab}, 'tgt': {0: vocab}, 'nSets': 1,
+            'setIDs': [[0, 0]], 'langs': ['en', 'de'],
+            'vocabs': {'en': vocab, 'de': vocab}}
+
+
+def makeModel(dicts):
+    modelOpt = argparse.Namespace(layers=1, rnn_size=8, word_vec_size=8,
+                                  brnn=False, input_feed=1, dropout=0.0,
+                                  share_rnn_enc=False, share_rnn_dec=False,
+                                  share_attention=False)
+    encoder = onmt.Models.Encoder(modelOpt, dicts['src'])
+    decoder = onmt.Models.Decoder(modelOpt, dicts['tgt'], dicts['nSets'])
+    model = onmt.Models.NMTModel(encoder, decoder)
+    model.generator = onmt.Models.Generator(modelOpt, dicts['tgt'])
+    return model
+
+
+def makeBatch(k):
+    "The k-th batch of the synthetic data, the same on every rank."
+    generator = torch.Generator()
+    generator.manual_seed(1000 + k)
+    src = torch.LongTensor(5, 3).random_(onmt.Constants.EOS + 1, VOCAB_SIZE,
+                                         generator=generator)
+    tgt = torch.LongTensor(6, 3).random_(onmt.Constants.EOS + 1, VOCAB_SIZE,
+                                         generator=generator)
+    tgt[0].fill_(onmt.Constants.BOS)
+    lengths = torch.LongTensor(1, 3).fill_(5)
+    return (Variable(src), Variable(lengths)), Variable(tgt)
+
+
+def rankMain():
+    "The training of one rank: a few steps on its slice of the schedule."
+    onmt.Distributed.initialize(opt)
+
+    dicts = makeDicts()
+    # every rank starts from other weights, the broadcast aligns them
+    torch.manual_seed(opt.rank)
+    model = makeModel(dicts)
+    # a module that is in no batch, as those of an unused language
+    model.unused = torch.nn.Linear(2, 2)
+    onmt.Distributed.broadcastParameters(model)
+    unusedWeight = model.unused.weight.data.clone()
+    criterion = onmt.Models.NMTCriterion(dicts['tgt'], cuda=False)[0]
+
+    optim = onmt.Optim('sgd', 0.5, 5)
+    optim.set_parameters(model.parameters())
+
+    schedule = [(0, k) for k in range(opt.steps)]
+    mySlice = onmt.Distributed.scheduleSlice(schedule, opt)
+    with open(os.path.join(opt.out, 'slice.%d.json' % opt.rank), 'w') as f:
+        json.dump(mySlice, f)
+
+    for sampledSet, k in mySlice:
+        batch = makeBatch(k)
+        model.zero_grad()
+        model(batch, mode='xe_loss', criterion=criterion,
+              normalizer=batch[1].size(1), backward=True)
+        onmt.Distributed.allReduceGradients(optim.params, opt, optim.sparseParams)
+        # no rank has a gradient for it: it is not updated
+        assert model.unused.weight.grad is None
+        optim.step()
+    assert torch.equal(model.unused.weight.data, unusedWeight)
+
+    state = dict((k, v.clone()) for k, v in model.state_dict().items())
+    torch.save(state, os.path.join(opt.out, 'params.%d.pt' % opt.rank))
+
+    # as in the trainers, every rank reaches the save but only the first writes
+    if onmt.Distributed.isMaster(opt):
+        checkpoints = onmt.CheckpointWriter(os.path.join(opt.out, 'model'), dicts)
+        checkpoints.save({'model': state, 'dicts': dicts, 'epoch': 1},
+                         os.path.join(opt.out, 'model_rank%d.pt' % opt.rank))
+        checkpoints.close()
+
+
+def test_two_ranks_stay_identical():
+    global opt
+    out = tempfile.mkdtemp()
+    opt = argparse.Namespace(world_size=2, rank=-1, gpus=[],
+                             dist_backend='gloo',
+                             dist_init='tcp://127.0.0.1:%d' % freePort(),
+                             steps=7, out=out)
+    try:
+        onmt.Distributed.launch(rankMain, opt)
+
+        slices = []
+        for rank in range(opt.world_size):
+            with open(os.path.join(out, 'slice.%d.json' % rank)) as f:
+                slices.append([tuple(entry) for entry in json.load(f)])
+        # disjoint, the same number of steps, and the whole cut schedule
+        assert len(slices[0]) == len(slices[1]) == 3
+        assert not set(slices[0]) & set(slices[1])
+        assert set(slices[0]) | set(slices[1]) == set((0, k) for k in range(6))
+
+        params = [torch.load(os.path.join(out, 'params.%d.pt' % rank))
+                  for rank in range(opt.world_size)]
+        assert set(params[0]) == set(params[1])
+        for key in params[0]:
+            assert torch.equal(params[0][key], params[1][key]), key
+
+        assert os.path.exists(os.path.join(out, 'model_rank0.pt'))
+        assert not os.path.exists(os.path.join(out, 'model_rank1.pt'))
+    finally:
+        shutil.rmtree(out, ignore_errors=True)
@@ -0,0 +1,133 @@
+from __future__ import division
+
+import random
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import onmt
+from onmt.metrics.gleu import sentence_gleu
+from onmt.metrics.sbleu import sentence_bleu
+from onmt.metrics.hit import HitMetrics
+from onmt.metrics.rewards import BatchRewards
+
+# 'zz' is not in the vocabulary: the phrases with it cannot be found
+WORDS = ['a', 'b', 'c', 'd', 'e', 'f', '.', ';', 'c;d', ';e', 'f;', 'a;zz']
+PHRASE_WORDS = ['a', 'b', 'c', 'd', 'e', 'f', 'c;d', ';e', 'f;', 'a;zz']
+
+
+def makeDict():
+    vocab = onmt.Dict([onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD,
+                       onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD])
+    for w in WORDS:
+        vocab.add(w)
+    return vocab
+
+
+def mutate(rng, words):
+    "words with some of them replaced, dropped or inserted."
+    result = []
+    for w in words:
+        edit = rng.random()
+        if edit < 0.1:
+            continue
+        result.append(rng.choice(WORDS) if edit < 0.3 else w)
+        if edit > 0.9:
+            result.append(rng.choice(WORDS))
+    return result
+
+
+def hitReference(rng):
+    "'sentence . ; . phrase ; phrase', sometimes without the phrases."
+    words = [rng.choice(WORDS) for _ in range(rng.randint(0, 5))]
+    if rng.random() < 0.8:
+        words += ['.', ';', '.']
+        for k in range(rng.randint(0, 3)):
+            if k > 0:
+                words.append(';')
+            words += [rng.choice(PHRASE_WORDS) for _ in range(rng.randint(1, 3))]
+    return words
+
+
+def toBatch(vocab, sentences, T, rng):
+    """
+    T x B ids of the sentences, ended by </s> and padded, or cut at T
+    without </s> for some of them.
+    """
+    columns = []
+    for words in sentences:
+        ids = [vocab.lookup(w) for w in words]
+        if len(ids) < T and rng.random() < 0.8:
+            ids.append(onmt.Constants.EOS)
+        else:
+            ids = (ids + [vocab.lookup(rng.choice(WORDS)) for _ in range(T)])[:T]
+        columns.append(ids + [onmt.Constants.PAD] * (T - len(ids)))
+    return torch.LongTensor(columns).t().contiguous()
+
+
+def stringScores(metric, vocab, hyp, ref):
+    "The metric on the words of every sentence, as the trainers computed it."
+    scores = []
+    for hypIDs, refIDs in zip(hyp.t().tolist(), ref.t().tolist()):
+        hypWords = vocab.convertToLabels(hypIDs, onmt.Constants.EOS)
+        refWords = vocab.convertToLabels(refIDs, onmt.Constants.EOS)
+        scores.append(metric(refWords, hypWords))
+    return scores
+
+
+def assertSameScores(rewards, metric, vocab, hyp, ref):
+    expected = stringScores(metric, vocab, hyp, ref)
+    scores = rewards.score(hyp, ref)
+    assert len(scores) == len(expected[0])
+    for k, score in enumerate(scores):
+        for b, value in enumerate(score.tolist()):
+            assert abs(value - expected[b][k]) <= 1e-5 * max(1.0, abs(expected[b][k])), \
+                (k, b, value, expected[b][k])
+
+
+def randomBatches(rng, makeReference, trials=30):
+    for trial in range(trials):
+        B = rng.randint(1, 6)
+        refs = [makeReference(rng) for _ in range(B)]
+        hyps = [mutate(rng, r) for r in refs]
+        refT = max(len(r) for r in refs) + rng.randint(0, 2)
+        hypT = max(len(h) for h in hyps) + rng.randint(-2, 2)
+        yield hyps, max(hypT, 1), refs, max(refT, 1)
+
+
+def randomReference(rng):
+    return [rng.choice(WORDS) for _ in range(rng.randint(0, 10))]
+
+
+@pytest.mark.parametrize('metric', ['gleu', 'sbleu'])
+def test_sentence_metrics(metric):
+    rng = random.Random(metric)
+    vocab = makeDict()
+    rewards = BatchRewards(vocab, metric)
+    stringMetric = sentence_gleu if metric == 'gleu' else sentence_bleu
+    for hyps, hypT, refs, refT in randomBatches(rng, randomReference):
+        hyp = toBatch(vocab, hyps, hypT, rng)
+        ref = toBatch(vocab, refs, refT, rng)
+        assertSameScores(rewards, stringMetric, vocab, hyp, ref)
+
+
+def test_hit():
+    rng = random.Random(5)
+    vocab = makeDict()
+    rewards = BatchRewards(vocab, 'hit', hit_alpha=0.3)
+    hitMetric = HitMetrics(0.3).hit
+    for hyps, hypT, refs, refT in randomBatches(rng, hitReference, trials=60):
+        hyp = toBatch(vocab, hyps, hypT, rng)
+        ref = toBatch(vocab, refs, refT, rng)
+        assertSameScores(rewards, hitMetric, vocab, hyp, ref)
+
+
+def test_rewards_are_the_first_score():
+    rng = random.Random(7)
+    vocab = makeDict()
+    rewards = BatchRewards(vocab, 'hit')
+    hyps, hypT, refs, refT = next(randomBatches(rng, hitReference))
+    hyp = toBatch(vocab, hyps, hypT, rng)
+    ref = toBatch(vocab, refs, refT, rng)
+    assert rewards(hyp, ref).tolist() == rewards.score(hyp, ref)[0].tolist()
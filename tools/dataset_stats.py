@@ -0,0 +1,190 @@
+from __future__ import division
+
+import os
+import onmt
+import torch
+import argparse
+
+parser = argparse.ArgumentParser(description='dataset_stats.py')
+
+parser.add_argument('-data', required=True,
+                    help='Path to the *.train.pt file from preprocess.py')
+parser.add_argument('-batch_size', type=int, default=64,
+                    help="""Maximum batch size of Dataset.allocateBatch and of
+                    the simulated policies""")
+parser.add_argument('-token_budgets', default="2000,4000,8000",
+                    help="""Comma separated token budgets (padded source +
+                    target tokens per batch) to simulate""")
+parser.add_argument('-bucket_widths', default="2,5,10",
+                    help="Comma separated source length bucket widths to simulate")
+parser.add_argument('-hist_bin', type=int, default=5,
+                    help="Width of the bins of the length histograms")
+parser.add_argument('-valid', action='store_true',
+                    help="Report on the validation data instead")
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return 0
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def printHistogram(name, lengths, binWidth, width=50):
+    print(' * %s length histogram' % name)
+    counts = dict()
+    for l in lengths:
+        counts[l // binWidth] = counts.get(l // binWidth, 0) + 1
+    top = max(counts.values())
+    for b in sorted(counts):
+        bar = '#' * max(1, int(round(width * counts[b] / top)))
+        print('   %4d-%-4d %8d %s' % (b * binWidth, (b + 1) * binWidth - 1,
+                                      counts[b], bar))
+
+
+def batchCost(batch, srcLengths, tgtLengths):
+    "(real tokens, padded tokens) of a batch of example indices."
+    real = sum(srcLengths[i] + tgtLengths[i] for i in batch)
+    padded = len(batch) * (max(srcLengths[i] for i in batch) +
+                           max(tgtLengths[i] for i in batch))
+    return real, padded
+
+
+def sentencePolicy(order, srcLengths, tgtLengths, batchSize):
+    "Consecutive examples of the length sorted data, batchSize at a time."
+    return [order[i:i + batchSize] for i in range(0, len(order), batchSize)]
+
+
+def bucketPolicy(order, srcLengths, tgtLengths, batchSize, width):
+    "Examples whose source lengths fall in the same bucket, batchSize at a time."
+    batches, cur, curBucket = [], [], None
+    for i in order:
+        bucket = srcLengths[i] // width
+        if bucket != curBucket or len(cur) == batchSize:
+            if cur:
+                batches.append(cur)
+            cur, curBucket = [], bucket
+        cur.append(i)
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def tokenPolicy(order, srcLengths, tgtLengths, budget):
+    "As many consecutive examples as fit into `budget` padded tokens."
+    batches, cur = [], []
+    maxSrc, maxTgt = 0, 0
+    for i in order:
+        newSrc = max(maxSrc, srcLengths[i])
+        newTgt = max(maxTgt, tgtLengths[i])
+        if cur and (len(cur) + 1) * (newSrc + newTgt) > budget:
+            batches.append(cur)
+            cur, newSrc, newTgt = [], srcLengths[i], tgtLengths[i]
+        cur.append(i)
+        maxSrc, maxTgt = newSrc, newTgt
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def reportPolicy(name, batches, srcLengths, tgtLengths):
+    real, padded = 0, 0
+    for batch in batches:
+        r, p = batchCost(batch, srcLengths, tgtLengths)
+        real += r
+        padded += p
+    nBatches = max(len(batches), 1)
+    print('   %-24s %8d batches %9.1f tokens/step %9.1f padded/step %6.2f%% padding' %
+          (name, len(batches), real / nBatches, padded / nBatches,
+           100.0 * (padded - real) / max(padded, 1)))
+
+
+def loadPairs(dataset, dataDir, split):
+    "The (src, tgt) lists of every pair, sharded data is read shard by shard."
+    data = dataset[split]
+    if 'shards' not in data:
+        return [(data['src'][i], data['tgt'][i]) for i in range(len(data['src']))]
+
+    pairs = []
+    for i in range(len(data['shards'][0])):
+        src, tgt = [], []
+        for shard in data['shards']:
+            part = torch.load(os.path.join(dataDir, shard[i]))
+            src += part['src']
+            tgt += part['tgt']
+        # restore the length order of the unsharded data
+        order = sorted(range(len(src)), key=lambda k: src[k].size(0))
+        pairs.append(([src[k] for k in order], [tgt[k] for k in order]))
+    return pairs
+
+
+def main():
+    opt = parser.parse_args()
+    budgets = [int(b) for b in opt.token_budgets.split(',') if b]
+    widths = [int(w) for w in opt.bucket_widths.split(',') if w]
+
+    print("Loading data from '%s'" % opt.data)
+    dataset = torch.load(opt.data)
+    dicts = dataset['dicts']
+    if dataset.get('type', 'text') != 'text':
+        print('Only text data is supported')
+        return
+
+    split = 'valid' if opt.valid else 'train'
+    pairs = loadPairs(dataset, os.path.dirname(os.path.abspath(opt.data)), split)
+
+    for i, (src, tgt) in enumerate(pairs):
+        srcLang, tgtLang = dicts['setLangs'][i]
+        print('')
+        print('=== Set %d: %s-%s, %d pairs ===' % (i, srcLang, tgtLang, len(src)))
+        if len(src) == 0:
+            continue
+
+        # the target includes <s> and </s>
+        srcLengths = [s.size(0) for s in src]
+        tgtLengths = [t.size(0) for t in tgt]
+
+        for name, lengths in [('source', srcLengths), ('target', tgtLengths)]:
+            print(' * %s length: mean %.1f, median %d, 95%% %d, max %d' %
+                  (name, sum(lengths) / len(lengths), percentile(lengths, 50),
+                   percentile(lengths, 95), max(lengths)))
+        printHistogram('source', srcLengths, opt.hist_bin)
+        printHistogram('target', tgtLengths, opt.hist_bin)
+
+        ratios = [(t - 2) / max(s, 1) for s, t in zip(srcLengths, tgtLengths)]
+        print(' * target/source length ratio: mean %.2f, 5%% %.2f, median %.2f, 95%% %.2f' %
+              (sum(ratios) / len(ratios), percentile(ratios, 5),
+               percentile(ratios, 50), percentile(ratios, 95)))
+
+        for name, lang, data in [('source', srcLang, src), ('target', tgtLang, tgt)]:
+            unk = sum(int(x.eq(onmt.Constants.UNK).sum()) for x in data)
+            tokens = sum(x.size(0) for x in data)
+            if name == 'target':
+                tokens -= 2 * len(data)
+            print(' * OOV rate of the %s (%s, vocab %d): %.2f%% (%d tokens)' %
+                  (name, lang, dicts['vocabs'][lang].size(),
+                   100.0 * unk / max(tokens, 1), unk))
+
+        # the batches the trainer actually uses
+        print(' * padding of the batching policies (source + target tokens)')
+        allocated = onmt.Dataset(src, tgt, opt.batch_size, False)
+        reportPolicy('allocateBatch (%d)' % opt.batch_size, allocated.batches,
+                     srcLengths, tgtLengths)
+
+        order = list(range(len(src)))
+        reportPolicy('sentences (%d)' % opt.batch_size,
+                     sentencePolicy(order, srcLengths, tgtLengths, opt.batch_size),
+                     srcLengths, tgtLengths)
+        for width in widths:
+            reportPolicy('bucket width %d (%d)' % (width, opt.batch_size),
+                         bucketPolicy(order, srcLengths, tgtLengths,
+                                      opt.batch_size, width),
+                         srcLengths, tgtLengths)
+        for budget in budgets:
+            reportPolicy('token budget %d' % budget,
+                         tokenPolicy(order, srcLengths, tgtLengths, budget),
+                         srcLengths, tgtLengths)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+from __future__ import division
+
+import onmt
+import onmt.modules
+import torch
+import argparse
+import numpy as np
+from torch.autograd import Variable
+from PIL import Image
+from torchvision import transforms
+
+parser = argparse.ArgumentParser(description='extract_img_features.py')
+
+parser.add_argument('-model', required=True,
+                    help="""Path to the model .pt file whose ImageEncoder
+                    conv layers compute the features""")
+parser.add_argument('-src', required=True,
+                    help="""Image file names, one per line (the first token of
+                    each line, as in the source files of preprocess.py)""")
+parser.add_argument('-src_img_dir', default="",
+                    help='Source image directory')
+parser.add_argument('-output', required=True,
+                    help="""Output prefix, writes output.feats and
+                    output.index.pt""")
+parser.add_argument('-batch_size', type=int, default=32,
+                    help='Number of images of the same size run together')
+parser.add_argument('-gpu', type=int, default=-1,
+                    help="Device to run on")
+
+
+def main():
+    opt = parser.parse_args()
+    opt.cuda = opt.gpu > -1
+    if opt.cuda:
+        torch.cuda.set_device(opt.gpu)
+
+    checkpoint = torch.load(opt.model)
+    model_opt = checkpoint['opt']
+    model_opt.img_features = False
+
+    encoder = onmt.modules.ImageEncoder(model_opt)
+    encoder_state_dict = {k[len('encoder.'):]: v
+                          for k, v in checkpoint['model'].items()
+                          if k.startswith('encoder.')}
+    encoder.load_state_dict(encoder_state_dict)
+    encoder.eval()
+    if opt.cuda:
+        encoder.cuda()
+
+    names, seen = [], set()
+    with open(opt.src) as f:
+        for line in f:
+            words = line.split()
+            if len(words) > 0 and words[0] not in seen:
+                seen.add(words[0])
+                names.append(words[0])
+    print('Extracting features of %d images' % len(names))
+
+    def load(name):
+        return Image.open(opt.src_img_dir + "/" + name)
+
+    # only images of the same size are batched, padding would change
+    # the features (PIL only reads the header here)
+    bySize = dict()
+    for i, name in enumerate(names):
+        bySize.setdefault(load(name).size, []).append(i)
+    toTensor = transforms.ToTensor()
+
+    offsets = [0] * len(names)
+    shapes = [None] * len(names)
+    offset = 0
+    with open(opt.output + '.feats', 'wb') as out:
+        for size in sorted(bySize):
+            ids = bySize[size]
+            for start in range(0, len(ids), opt.batch_size):
+                batchIds = ids[start:start + opt.batch_size]
+                batch = torch.stack([toTensor(load(names[i])) for i in batchIds], 0)
+                if opt.cuda:
+                    batch = batch.cuda()
+                features = encoder.extractFeatures(
+                    Variable(batch, volatile=True)).data.float().cpu()
+
+                for b, i in enumerate(batchIds):
+                    array = features[b].contiguous().numpy().astype(np.float32)
+                    array.tofile(out)
+                    offsets[i] = offset
+                    shapes[i] = tuple(array.shape)
+                    offset += array.size
+
+    torch.save({'names': names, 'offsets': offsets, 'shapes': shapes},
+               opt.output + '.index.pt')
+    print('Wrote %d feature maps (%d floats) to %s.feats' %
+          (len(names), offset, opt.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ from __future__ import division
 import onmt
 import onmt.Markdown
 import onmt.modules
+import onmt.Distributed
+import onmt.Checkpoints
 import argparse
 import torch
 import torch.nn as nn
@@ -11,6 +13,7 @@ from torch.autograd import Variable
 from onmt.trainer.Evaluator import Evaluator
 from onmt.trainer.XETrainer import XETrainer
 from onmt.trainer.SelfCriticalTrainer import SCSTTrainer
+import os
 import math
 import time
 
@@ -62,6 +65,16 @@ parser.add_argument('-brnn_merge', default='concat',
 # Optimization options
 parser.add_argument('-encoder_type', default='text',
                     help="Type of encoder to use. Options are [text|img].")
+parser.add_argument('-img_features', action='store_true',
+                    help="""The source images were replaced by CNN features
+                    (tools/extract_img_features.py, preprocess.py
+                    -src_img_features): the img encoder only runs its
+                    row LSTM.""")
+parser.add_argument('-img_brnn_split', action='store_true',
+                    help="""With -brnn, split -rnn_size between the two
+                    directions of the img encoder LSTM, as the text encoder
+                    does. Without it every direction has -rnn_size units,
+                    as in the img models trained before.""")
 parser.add_argument('-batch_size', type=int, default=64,
                     help='Maximum batch size')
 parser.add_argument('-max_generator_batches', type=int, default=32,
@@ -80,6 +93,10 @@ parser.add_argument('-optim', default='sgd',
 parser.add_argument('-max_grad_norm', type=float, default=5,
                     help="""If the norm of the gradient vector exceeds this,
                     renormalize it to have the norm equal to max_grad_norm""")
+parser.add_argument('-sparse_embeddings', action='store_true',
+                    help="""Sparse gradients for the word embeddings: the
+                    optimizer (sgd, adagrad or adam, as lazy Adam) only
+                    updates the rows of the words in the batch.""")
 parser.add_argument('-dropout', type=float, default=0.3,
                     help='Dropout probability; applied between LSTM stacks.')
 parser.add_argument('-curriculum', action="store_true",
@@ -89,10 +106,36 @@ parser.add_argument('-curriculum', action="store_true",
 parser.add_argument('-extra_shuffle', action="store_true",
                     help="""By default only shuffle mini-batch order; when true,
                     shuffle and re-assign mini-batches""")
+parser.add_argument('-prefetch', type=int, default=0,
+                    help="""Number of batches to prepare ahead in the
+                    background. 0 collates every batch in the training loop.""")
+parser.add_argument('-prefetch_workers', type=int, default=1,
+                    help="Number of background workers preparing batches.")
+parser.add_argument('-prefetch_mode', default='thread',
+                    help="""Type of the background workers.
+                    Options are [thread|process].""")
+parser.add_argument('-pin_memory', action='store_true',
+                    help="""Collate batches into page-locked memory for
+                    faster host to GPU copies.""")
+parser.add_argument('-max_resident_shards', type=int, default=3,
+                    help="""Maximum number of training shards kept in memory
+                    when the data was preprocessed with -num_shards.""")
+parser.add_argument('-sampling_temperature', type=float, default=1.0,
+                    help="""Temperature of the language pair sampling: every
+                    pair gets a share of the steps of an epoch proportional to
+                    (number of batches) ** (1 / temperature). 1 reads every
+                    batch once, higher values up-sample the small pairs.""")
 parser.add_argument('-reinforce', action='store_true',
                     help="""Using reinforcement learning""")
+parser.add_argument('-rf_samples', type=int, default=1,
+                    help="""Number of samples drawn for every source sentence
+                    in reinforcement learning, decoded in one batch.""")
+parser.add_argument('-rf_baseline', default='greedy',
+                    help="""Baseline of the rewards. Options are [greedy|mean]:
+                    the greedy output, or the mean reward of the other
+                    samples of the same source (needs -rf_samples > 1).""")
 parser.add_argument('-reinforce_metrics', default='gleu',
-                    help="Type of metrics to use. Options are [gleu|hit].")    
+                    help="Type of metrics to use. Options are [gleu|sbleu|hit].")    
 parser.add_argument('-hit_alpha', type=float, default=0.3,
                     help='Dropout probability; applied between LSTM stacks.')
 
@@ -129,10 +172,51 @@ parser.add_argument('-gpus', default=[], nargs='+', type=int,
 parser.add_argument('-seed', default=9999, nargs='+', type=int,
                     help="Seed for deterministic runs.")
 
+# Multi-process training
+parser.add_argument('-world_size', type=int, default=1,
+                    help="""Number of training processes. Every process trains
+                    on its own part of the batches and the gradients are
+                    averaged over all processes.""")
+parser.add_argument('-rank', type=int, default=-1,
+                    help="""Rank of this process (0 .. world_size-1), one
+                    process per rank is started on every machine. The default
+                    starts all the ranks on this machine.""")
+parser.add_argument('-dist_init', default='tcp://127.0.0.1:23456',
+                    help="""URL to set up the processes, the address of rank 0
+                    (tcp://host:port) or a shared file (file:///path).""")
+parser.add_argument('-dist_backend', default='gloo',
+                    help="""Backend of torch.distributed. gloo runs on CPU
+                    and GPU.""")
+
 parser.add_argument('-log_interval', type=int, default=100,
                     help="Print stats at this interval.")
+parser.add_argument('-profile', default="",
+                    help="""Time the phases of the training steps (data,
+                    encoder, decoder, generator and loss, backward, gradient
+                    clipping, optimizer) and write them with the token and
+                    padding statistics to this file every -log_interval
+                    steps. The GPU is synchronized at every phase.""")
+parser.add_argument('-profile_format', default='json',
+                    help="""Format of the -profile file. Options are
+                    [json|prometheus]: one JSON line per interval, or a
+                    Prometheus text file rewritten every interval.""")
 parser.add_argument('-save_every', type=int, default=-1,
                     help="Save every this interval.")
+parser.add_argument('-keep_last', type=int, default=0,
+                    help="""Keep only the checkpoints of the last N saves
+                    (0 keeps all). Combined with -keep_best.""")
+parser.add_argument('-keep_best', type=int, default=0,
+                    help="""Keep only the K best checkpoints by validation
+                    score (0 keeps all). Combined with -keep_last.""")
+parser.add_argument('-ema_decay', type=float, default=0,
+                    help="""Keep an exponential moving average of the weights
+                    with this decay (e.g. 0.9999), used for validation and
+                    saved in the checkpoints (0 disables it).""")
+parser.add_argument('-average_window', type=int, default=0,
+                    help="""Instead of -ema_decay, average the weights over
+                    about the last N updates.""")
+parser.add_argument('-average_every', type=int, default=1,
+                    help="""Update the weight average every K steps.""")
 
 # For multilingual configs
 parser.add_argument('-share_rnn_enc', action='store_true',
@@ -150,7 +234,8 @@ print(opt)
 if torch.cuda.is_available() and not opt.gpus:
     print("WARNING: You have a CUDA device, should run with -gpus 0")
 
-if opt.gpus:
+# with several processes, each rank picks its device in main()
+if opt.gpus and opt.world_size <= 1:
     cuda.set_device(opt.gpus[0])
 
 torch.manual_seed(opt.seed)
@@ -243,25 +328,18 @@ def trainModel(model, trainSets, validSets, dataset, optim, evaluator):
             
             # Do forward to the newly created graph
             model.zero_grad()
-            outputs, hiddens = model(batch)
             
-            # Exclude <s> from targets.
-            targets = batch[1][1:]
             # The criterion is for the target language side
             criterion = criterions[setIDs[sampledSet][1]]
             
-            loss_v = criterion(outputs.view(-1, outputs.size(-1)), targets.view(-1))
-            
-            loss = loss_v.data[0]
-            
-            loss_v.div(batch_size).backward()
+            loss, num_words = model(batch, mode='xe_loss', criterion=criterion,
+                                    normalizer=batch_size, backward=True)
             
                         
             # Update the parameters.
             optim.step()
 
             # Statistics for the current set
-            num_words = targets.data.ne(onmt.Constants.PAD).sum()
             report_loss[sampledSet] += loss
             report_tgt_words[sampledSet] += num_words
             report_src_words[sampledSet] += batch[0][1].data.sum()
@@ -384,6 +462,14 @@ def trainModel(model, trainSets, validSets, dataset, optim, evaluator):
 
 
 def main():
+    if opt.world_size > 1 and opt.rank < 0:
+        # start all the ranks on this machine
+        onmt.Distributed.launch(main, opt)
+        return
+
+    if opt.world_size > 1:
+        onmt.Distributed.initialize(opt)
+
     print("Loading data from '%s'" % opt.data)
 
     dataset = torch.load(opt.data)
@@ -393,7 +479,7 @@ def main():
                        else opt.train_from_state_dict)
     if dict_checkpoint:
         print('Loading dicts from checkpoint at %s' % dict_checkpoint)
-        checkpoint = torch.load(dict_checkpoint)
+        checkpoint = onmt.Checkpoints.loadCheckpoint(dict_checkpoint)
         dataset['dicts'] = checkpoint['dicts']
     
     dicts = dataset['dicts']
@@ -402,17 +488,39 @@ def main():
     for lang in dicts['langs']:
             print(' * ' + lang + ' = %d' % dicts['vocabs'][lang].size())
 
-    trainSets = dict()
+    sharded = 'shards' in dataset['train']
+    if sharded:
+      # the shard files are next to the main data file
+      trainSets = onmt.ShardedDataset(dataset['train'],
+                                      os.path.dirname(os.path.abspath(opt.data)),
+                                      opt.batch_size, opt.gpus,
+                                      maxResident=opt.max_resident_shards)
+      print(' * training data split into %d shards' % trainSets.numShards)
+    else:
+      trainSets = dict()
     validSets = dict()
     for i in xrange(nSets):
-      trainSets[i] = onmt.Dataset(dataset['train']['src'][i],
-                             dataset['train']['tgt'][i], opt.batch_size, opt.gpus)
+      if sharded:
+        nTrain = sum(sizes[i] for sizes in dataset['train']['sizes'])
+      else:
+        trainSets[i] = onmt.Dataset(dataset['train']['src'][i],
+                               dataset['train']['tgt'][i], opt.batch_size, opt.gpus,
+                               data_type=dataset['type'])
+        nTrain = trainSets[i].fullSize
             
       validSets[i] = onmt.Dataset(dataset['valid']['src'][i],
-                             dataset['valid']['tgt'][i], opt.batch_size, opt.gpus)
+                             dataset['valid']['tgt'][i], opt.batch_size, opt.gpus,
+                             data_type=dataset['type'])
       
       print(' * number of training sentences for set %d: %d' %
-          (i, len(dataset['train']['src'][i])))
+          (i, nTrain))
+
+    # the Datasets keep the text flattened, the sentences are released
+    if dataset['type'] == "text":
+      for split in ['train', 'valid']:
+        if 'src' in dataset[split]:
+          dataset[split]['src'] = [None] * nSets
+          dataset[split]['tgt'] = [None] * nSets
         
 
     print(' * maximum batch size. %d' % opt.batch_size)
@@ -420,7 +528,10 @@ def main():
     print('Building model...')
     
     
-    encoder = onmt.Models.Encoder(opt, dicts['src'])
+    if opt.encoder_type == "img":
+        encoder = onmt.modules.ImageEncoder(opt)
+    else:
+        encoder = onmt.Models.Encoder(opt, dicts['src'])
     decoder = onmt.Models.Decoder(opt, dicts['tgt'], nSets)
     generator = onmt.Models.Generator(opt, dicts['tgt'])
 
@@ -443,6 +554,22 @@ def main():
         generator.load_state_dict(checkpoint['generator'])
         opt.start_epoch = int(math.floor(checkpoint['epoch'] + 1))
 
+    # a checkpoint saved inside an epoch resumes that epoch exactly
+    schedulerState, resumeIteration = None, -1
+    if dict_checkpoint and checkpoint.get('scheduler') is not None \
+            and checkpoint['iteration'] >= 0:
+        schedulerState = checkpoint['scheduler']
+        resumeIteration = checkpoint['iteration']
+        opt.start_epoch = schedulerState['epoch']
+        print('Resuming epoch %d after iteration %d' % (opt.start_epoch, resumeIteration))
+
+    # the weight average continues from the checkpoint
+    averageState = None
+    if dict_checkpoint and 'model_ema' in checkpoint:
+        averageState = {'model_ema': checkpoint['model_ema'],
+                        'generator_ema': checkpoint['generator_ema'],
+                        'ema_updates': checkpoint['ema_updates']}
+
     if len(opt.gpus) >= 1:
         model.cuda()
         generator.cuda()
@@ -478,7 +605,11 @@ def main():
             start_decay_at=opt.start_decay_at
         )
 
-    optim.set_parameters(model.parameters())
+    if opt.world_size > 1:
+        onmt.Distributed.broadcastParameters(model)
+
+    optim.set_parameters(model.parameters(),
+                         onmt.gradient_utils.sparseParameters(model))
     optim.set_learning_rate(opt.learning_rate)
     
     
@@ -528,6 +659,13 @@ def main():
     else:
         trainer = XETrainer(model, trainSets, validSets, dataset, optim, evaluator, opt)
     
+    if schedulerState is not None:
+        trainer.scheduler.load_state_dict(schedulerState)
+        trainer.startIteration = resumeIteration + 1
+    
+    if averageState is not None and trainer.average is not None:
+        trainer.average.loadFrom(averageState)
+    
     trainer.run()
 
     #~ trainModel(model, trainSets, validSets, dataset, optim, evaluator)
@@ -3,11 +3,11 @@ from __future__ import division
 import onmt
 import onmt.Markdown
 import onmt.modules
+import onmt.Checkpoints
 import argparse
 import torch
 import torch.nn as nn
 from torch import cuda
-from torch.autograd import Variable
 import math
 import time
 
@@ -76,6 +76,10 @@ parser.add_argument('-optim', default='sgd',
 parser.add_argument('-max_grad_norm', type=float, default=5,
                     help="""If the norm of the gradient vector exceeds this,
                     renormalize it to have the norm equal to max_grad_norm""")
+parser.add_argument('-sparse_embeddings', action='store_true',
+                    help="""Sparse gradients for the word embeddings: the
+                    optimizer (sgd, adagrad or adam, as lazy Adam) only
+                    updates the rows of the words in the batch.""")
 parser.add_argument('-dropout', type=float, default=0.3,
                     help='Dropout probability; applied between LSTM stacks.')
 parser.add_argument('-curriculum', action="store_true",
@@ -122,6 +126,12 @@ parser.add_argument('-log_interval', type=int, default=100,
                     help="Print stats at this interval.")
 parser.add_argument('-save_every', type=int, default=-1,
                     help="Save every this interval.")
+parser.add_argument('-keep_last', type=int, default=0,
+                    help="""Keep only the checkpoints of the last N saves
+                    (0 keeps all). Combined with -keep_best.""")
+parser.add_argument('-keep_best', type=int, default=0,
+                    help="""Keep only the K best checkpoints by validation
+                    score (0 keeps all). Combined with -keep_last.""")
 
 # For multilingual configs
 parser.add_argument('-share_rnn_enc', action='store_true',
@@ -172,26 +182,6 @@ def NMTCriterion(dicts):
     
     return crits
 
-def memoryEfficientLoss(outputs, targets, generator, crit, eval=False):
-    # compute generations one piece at a time
-    loss = 0
-    outputs = Variable(outputs.data, requires_grad=(not eval), volatile=eval)
-
-    batch_size = outputs.size(1)
-    outputs_split = torch.split(outputs, opt.max_generator_batches)
-    targets_split = torch.split(targets, opt.max_generator_batches)
-    for i, (out_t, targ_t) in enumerate(zip(outputs_split, targets_split)):
-        out_t = out_t.view(-1, out_t.size(2))
-        scores_t = generator(out_t)
-        loss_t = crit(scores_t, targ_t.view(-1))
-        loss += loss_t.data[0]
-        if not eval:
-            loss_t.div(batch_size).backward()
-
-    grad_output = None if outputs.grad is None else outputs.grad.data
-    return loss, grad_output
-
-
 def eval(model, criterions, data, setIDs, pairID):
     model.eval()
     loss = 0
@@ -210,13 +200,10 @@ def eval(model, criterions, data, setIDs, pairID):
     for i in range(len(dset)):
         # exclude original indices
         batch = dset[i][:-1]
-        outputs = model(batch)
-        # exclude <s> from targets
-        targets = batch[1][1:]
-        loss, _ = memoryEfficientLoss(
-                        outputs, targets, model.generator, criterion, eval=True)
+        loss, num_words = model(batch, mode='xe_loss', criterion=criterion,
+                                timestep_group=opt.max_generator_batches)
         total_loss += loss
-        total_words += targets.data.ne(onmt.Constants.PAD).sum()
+        total_words += num_words
     
     loss = total_loss / total_words
     
@@ -275,6 +262,11 @@ def trainModel(model, trainSets, validSets, dataset, optim):
                     
     assert pairID >= 0, "Cannot find any language pair with your provided src and tgt id"
     print(" * Adapting pair %i " % pairID)
+
+    # checkpoints are written in the background
+    checkpoints = onmt.CheckpointWriter(opt.save_model, dataset['dicts'],
+                                        keepLast=opt.keep_last,
+                                        keepBest=opt.keep_best)
     
 
     def trainEpoch(epoch, batchOrder=None):
@@ -332,23 +324,18 @@ def trainModel(model, trainSets, validSets, dataset, optim):
             
             # Do forward to the newly created graph
             model.zero_grad()
-            outputs = model(batch)
             
-            # Exclude <s> from targets.
-            targets = batch[1][1:]
             # The criterion is for the target language side
             criterion = criterions[setIDs[sampledSet][1]]
 
-            loss, gradOutput = memoryEfficientLoss(
-                            outputs, targets, model.generator, criterion)
-            
-            outputs.backward(gradOutput)
+            loss, num_words = model(batch, mode='xe_loss', criterion=criterion,
+                                    normalizer=batch[1].size(1), backward=True,
+                                    timestep_group=opt.max_generator_batches)
             
             # Update the parameters.
             optim.step()
 
             # Statistics for the current set
-            num_words = targets.data.ne(onmt.Constants.PAD).sum()
             report_loss[sampledSet] += loss
             report_tgt_words[sampledSet] += num_words
             report_src_words[sampledSet] += batch[0][1].data.sum()
@@ -416,9 +403,8 @@ def trainModel(model, trainSets, validSets, dataset, optim):
                 file_name = '%s_ppl_%.2f_e%.2f.pt'
                 #~ valid_ppl = "_".join([("%.2f" % math.exp(min(valid_loss, 100))) for valid_loss in valid_losses])
                 print('Writing to %s_ppl_%.2f_e%.2f.pt' % (opt.save_model, avgDevPpl, ep))
-                torch.save(checkpoint,
-                                     file_name
-                                     % (opt.save_model, avgDevPpl, ep))
+                checkpoints.save(checkpoint, file_name % (opt.save_model, avgDevPpl, ep),
+                                 score=avgDevPpl)
         return total_loss[pairID] / total_words[pairID]
         
     valid_loss = eval(model, criterions, validSets, setIDs, pairID)
@@ -466,9 +452,10 @@ def trainModel(model, trainSets, validSets, dataset, optim):
                 
         file_name = '%s.adapted.pt'
         print('Writing to %s.adapted.pt' % (opt.save_model))
-        torch.save(checkpoint,
-                                     file_name
-                                     % (opt.save_model))
+        checkpoints.save(checkpoint, file_name % (opt.save_model), score=avgDevPpl)
+
+    # wait for the last checkpoint
+    checkpoints.close()
 
 
 def main():
@@ -481,7 +468,7 @@ def main():
                        else opt.train_from_state_dict)
     if dict_checkpoint:
         print('Loading dicts from checkpoint at %s' % dict_checkpoint)
-        checkpoint = torch.load(dict_checkpoint)
+        checkpoint = onmt.Checkpoints.loadCheckpoint(dict_checkpoint)
         dataset['dicts'] = checkpoint['dicts']
     
     dicts = dataset['dicts']
@@ -500,7 +487,12 @@ def main():
                              dataset['valid']['tgt'][i], opt.batch_size, opt.gpus)
       
       print(' * number of training sentences for set %d: %d' %
-          (i, len(dataset['train']['src'][i])))
+          (i, trainSets[i].fullSize))
+
+    # the Datasets keep the text flattened, the sentences are released
+    for split in ['train', 'valid']:
+      dataset[split]['src'] = [None] * nSets
+      dataset[split]['tgt'] = [None] * nSets
         
 
     print(' * maximum batch size. %d' % opt.batch_size)
@@ -565,7 +557,8 @@ def main():
         print(optim)
 
 
-    optim.set_parameters(model.parameters())
+    optim.set_parameters(model.parameters(),
+                         onmt.gradient_utils.sparseParameters(model))
     optim.set_learning_rate(opt.learning_rate)
 
     #~ if opt.train_from or opt.train_from_state_dict:
@@ -3,11 +3,14 @@ from __future__ import division
 import onmt
 import onmt.Markdown
 import onmt.modules
+import onmt.Distributed
+import onmt.Checkpoints
 import argparse
 import torch
 import torch.nn as nn
 from torch import cuda
 from torch.autograd import Variable
+import os
 import math
 import time
 
@@ -53,10 +56,32 @@ parser.add_argument('-brnn_merge', default='concat',
 # Optimization options
 parser.add_argument('-encoder_type', default='text',
                     help="Type of encoder to use. Options are [text|img].")
+parser.add_argument('-img_features', action='store_true',
+                    help="""The source images were replaced by CNN features
+                    (tools/extract_img_features.py, preprocess.py
+                    -src_img_features): the img encoder only runs its
+                    row LSTM.""")
+parser.add_argument('-img_brnn_split', action='store_true',
+                    help="""With -brnn, split -rnn_size between the two
+                    directions of the img encoder LSTM, as the text encoder
+                    does. Without it every direction has -rnn_size units,
+                    as in the img models trained before.""")
 parser.add_argument('-batch_size', type=int, default=64,
                     help='Maximum batch size')
 parser.add_argument('-batch_size_split', type=int, default=64,
                     help='The size of the splitted mini-batch')
+parser.add_argument('-memory_budget', type=float, default=0,
+                    help="""Split every batch into as few micro-batches as
+                    fit this much GPU memory (in GB), instead of
+                    -batch_size_split. The peak memory of a step is
+                    calibrated on synthetic batches before training. Leave
+                    room for the optimizer state. Needs CUDA.""")
+parser.add_argument('-calibration_batch', type=int, default=32,
+                    help="""Largest number of sentences of the calibration
+                    batches of -memory_budget""")
+parser.add_argument('-calibration_length', type=int, default=50,
+                    help="""Largest source and target length of the
+                    calibration batches of -memory_budget""")
 parser.add_argument('-max_generator_batches', type=int, default=32,
                     help="""Maximum batches of words in a sequence to run
                     the generator on in parallel. Higher is faster, but uses
@@ -73,6 +98,10 @@ parser.add_argument('-optim', default='sgd',
 parser.add_argument('-max_grad_norm', type=float, default=5,
                     help="""If the norm of the gradient vector exceeds this,
                     renormalize it to have the norm equal to max_grad_norm""")
+parser.add_argument('-sparse_embeddings', action='store_true',
+                    help="""Sparse gradients for the word embeddings: the
+                    optimizer (sgd, adagrad or adam, as lazy Adam) only
+                    updates the rows of the words in the batch.""")
 parser.add_argument('-dropout', type=float, default=0.3,
                     help='Dropout probability; applied between LSTM stacks.')
 parser.add_argument('-curriculum', action="store_true",
@@ -82,6 +111,25 @@ parser.add_argument('-curriculum', action="store_true",
 parser.add_argument('-extra_shuffle', action="store_true",
                     help="""By default only shuffle mini-batch order; when true,
                     shuffle and re-assign mini-batches""")
+parser.add_argument('-prefetch', type=int, default=0,
+                    help="""Number of batches to prepare ahead in the
+                    background. 0 collates every batch in the training loop.""")
+parser.add_argument('-prefetch_workers', type=int, default=1,
+                    help="Number of background workers preparing batches.")
+parser.add_argument('-prefetch_mode', default='thread',
+                    help="""Type of the background workers.
+                    Options are [thread|process].""")
+parser.add_argument('-pin_memory', action='store_true',
+                    help="""Collate batches into page-locked memory for
+                    faster host to GPU copies.""")
+parser.add_argument('-max_resident_shards', type=int, default=3,
+                    help="""Maximum number of training shards kept in memory
+                    when the data was preprocessed with -num_shards.""")
+parser.add_argument('-sampling_temperature', type=float, default=1.0,
+                    help="""Temperature of the language pair sampling: every
+                    pair gets a share of the steps of an epoch proportional to
+                    (number of batches) ** (1 / temperature). 1 reads every
+                    batch once, higher values up-sample the small pairs.""")
 
 # learning rate
 parser.add_argument('-learning_rate', type=float, default=1.0,
@@ -115,10 +163,51 @@ parser.add_argument('-gpus', default=[], nargs='+', type=int,
 parser.add_argument('-seed', default=9999, nargs='+', type=int,
                     help="Seed for deterministic runs.")
 
+# Multi-process training
+parser.add_argument('-world_size', type=int, default=1,
+                    help="""Number of training processes. Every process trains
+                    on its own part of the batches and the gradients are
+                    averaged over all processes.""")
+parser.add_argument('-rank', type=int, default=-1,
+                    help="""Rank of this process (0 .. world_size-1), one
+                    process per rank is started on every machine. The default
+                    starts all the ranks on this machine.""")
+parser.add_argument('-dist_init', default='tcp://127.0.0.1:23456',
+                    help="""URL to set up the processes, the address of rank 0
+                    (tcp://host:port) or a shared file (file:///path).""")
+parser.add_argument('-dist_backend', default='gloo',
+                    help="""Backend of torch.distributed. gloo runs on CPU
+                    and GPU.""")
+
 parser.add_argument('-log_interval', type=int, default=100,
                     help="Print stats at this interval.")
+parser.add_argument('-profile', default="",
+                    help="""Time the phases of the training steps (data,
+                    encoder, decoder, generator and loss, backward, gradient
+                    clipping, optimizer) and write them with the token and
+                    padding statistics to this file every -log_interval
+                    steps. The GPU is synchronized at every phase.""")
+parser.add_argument('-profile_format', default='json',
+                    help="""Format of the -profile file. Options are
+                    [json|prometheus]: one JSON line per interval, or a
+                    Prometheus text file rewritten every interval.""")
 parser.add_argument('-save_every', type=int, default=-1,
                     help="Save every this interval.")
+parser.add_argument('-keep_last', type=int, default=0,
+                    help="""Keep only the checkpoints of the last N saves
+                    (0 keeps all). Combined with -keep_best.""")
+parser.add_argument('-keep_best', type=int, default=0,
+                    help="""Keep only the K best checkpoints by validation
+                    score (0 keeps all). Combined with -keep_last.""")
+parser.add_argument('-ema_decay', type=float, default=0,
+                    help="""Keep an exponential moving average of the weights
+                    with this decay (e.g. 0.9999), used for validation and
+                    saved in the checkpoints (0 disables it).""")
+parser.add_argument('-average_window', type=int, default=0,
+                    help="""Instead of -ema_decay, average the weights over
+                    about the last N updates.""")
+parser.add_argument('-average_every', type=int, default=1,
+                    help="""Update the weight average every K steps.""")
 
 # For multilingual configs
 parser.add_argument('-share_rnn_enc', action='store_true',
@@ -136,13 +225,15 @@ print(opt)
 if torch.cuda.is_available() and not opt.gpus:
     print("WARNING: You have a CUDA device, should run with -gpus 0")
 
-if opt.gpus:
+# with several processes, each rank picks its device in main()
+if opt.gpus and opt.world_size <= 1:
     cuda.set_device(opt.gpus[0])
 
 torch.manual_seed(opt.seed)
 
 # split the mini-batch (large) into smaller ones
-def splitMiniBatch(batch):
+# with a memory budget the splits are as large as the budget allows
+def splitMiniBatch(batch, budget=None):
     
     splittedBatches = []
     
@@ -150,13 +241,26 @@ def splitMiniBatch(batch):
     tgt = batch[1].data
     length = batch[0][1].data
     volatile = batch[1].volatile
+    text = src.dim() == 2
     
-    src_splits = torch.split(src, opt.batch_size_split, dim=1)
-    tgt_splits = torch.split(tgt, opt.batch_size_split, dim=1)
-    length_splits = torch.split(length, opt.batch_size_split, dim=1)
+    if budget is not None and text:
+        tgtLengths = tgt.ne(onmt.Constants.PAD).long().sum(0).view(-1).tolist()
+        splits = budget.split(length.view(-1).tolist(), tgtLengths)
+        src_splits = [src[:, s:e] for s, e in splits]
+        tgt_splits = [tgt[:, s:e] for s, e in splits]
+        length_splits = [length[:, s:e] for s, e in splits]
+    else:
+        src_splits = torch.split(src, opt.batch_size_split, dim=1)
+        tgt_splits = torch.split(tgt, opt.batch_size_split, dim=1)
+        length_splits = torch.split(length, opt.batch_size_split, dim=1)
     
     for i, (src_new, tgt_new, length_new) in enumerate(zip(src_splits, tgt_splits, length_splits)):
         
+        # only the padding of the longest sentences of the split is kept
+        if text:
+            src_new = src_new[:int(length_new.max())]
+            tgt_new = tgt_new[:int(tgt_new.ne(onmt.Constants.PAD).long().sum(0).max())]
+        
         src_var = Variable(src_new.contiguous(), volatile=volatile)
         tgt_var = Variable(tgt_new.contiguous(), volatile=volatile)
         length_var = Variable(length_new, volatile=volatile)
@@ -196,27 +300,104 @@ def NMTCriterion(dicts):
     
     return crits
 
-def memoryEfficientLoss(outputs, targets, generator, crit, batch_size, eval=False):
-    # compute generations one piece at a time
-    loss = 0
-    outputs = Variable(outputs.data, requires_grad=(not eval), volatile=eval)
-
-    outputs_split = torch.split(outputs, opt.max_generator_batches)
-    targets_split = torch.split(targets, opt.max_generator_batches)
-    for i, (out_t, targ_t) in enumerate(zip(outputs_split, targets_split)):
-        out_t = out_t.view(-1, out_t.size(2))
-        scores_t = generator(out_t)
-        loss_t = crit(scores_t, targ_t.view(-1))
-        loss += loss_t.data[0]
-        if not eval:
-            loss_t.div(batch_size).backward()
-
-    grad_output = None if outputs.grad is None else outputs.grad.data
-    return loss, grad_output
+def optimizerStateMemory(optim):
+    """
+    Bytes of the optimizer state not allocated yet: Adam and Adadelta
+    create their two buffers per parameter on the first update, Adagrad
+    its sums with the optimizer.
+    """
+    buffers = {'adam': 2, 'adadelta': 2, 'adagrad': 1}.get(optim.method, 0)
+    total = 0
+    for optimizer in (optim.optimizer, optim.sparseOptimizer):
+        if optimizer is None:
+            continue
+        for group in optimizer.param_groups:
+            for p in group['params']:
+                allocated = sum(v.numel() for v in optimizer.state[p].values()
+                                if torch.is_tensor(v))
+                missing = max(buffers * p.numel() - allocated, 0)
+                total += missing * p.data.storage().element_size()
+    return total
+
+def calibrateMemory(model, criterions, dicts, optim):
+    """
+    Fit the peak memory of the training steps (onmt.MemoryBudget) on
+    synthetic batches of growing shapes, up to -calibration_batch
+    sentences of -calibration_length tokens. None (after a warning) when
+    the peak memory cannot be measured: without reset_max_memory_allocated
+    the peak of a step would include the peaks of the steps before it.
+    The steps make no update, the optimizer state is added to the fit.
+    """
+    if (not opt.gpus or opt.encoder_type != 'text'
+            or not hasattr(torch.cuda, 'max_memory_allocated')
+            or not hasattr(torch.cuda, 'reset_max_memory_allocated')):
+        print('WARNING: -memory_budget needs a CUDA device with memory '
+              'statistics and a text encoder, splitting with -batch_size_split')
+        return None
+    
+    budget = onmt.MemoryBudget(opt.memory_budget * 2 ** 30)
+    setIDs = dicts['setIDs']
+    model.switchLangID(setIDs[0][0], setIDs[0][1])
+    model.switchPairID(0)
+    criterion = criterions[setIDs[0][1]]
+    srcVocab = dicts['src'][setIDs[0][0]].size()
+    tgtVocab = dicts['tgt'][setIDs[0][1]].size()
+    
+    sizes = [max(1, opt.calibration_batch // 4), max(1, opt.calibration_batch // 2),
+             opt.calibration_batch]
+    lengths = [max(2, opt.calibration_length // 2), max(2, opt.calibration_length)]
+    shapes = sorted(set((B, Ts, Tt) for B in sizes for Ts in lengths for Tt in lengths),
+                    key=lambda shape: shape[0] * (shape[1] + shape[2]))
+    
+    # the first step allocates the gradients, it is not measured
+    for k, (B, Ts, Tt) in enumerate([shapes[0]] + shapes):
+        src = torch.LongTensor(Ts, B).random_(onmt.Constants.EOS + 1, srcVocab)
+        tgt = torch.LongTensor(Tt, B).random_(onmt.Constants.EOS + 1, tgtVocab)
+        tgt[0].fill_(onmt.Constants.BOS)
+        srcLengths = torch.LongTensor(1, B).fill_(Ts)
+        batch = ((Variable(src.cuda()), Variable(srcLengths)), Variable(tgt.cuda()))
+        
+        torch.cuda.reset_max_memory_allocated()
+        model.zero_grad()
+        try:
+            model(batch, mode='xe_loss', criterion=criterion, normalizer=B,
+                  backward=True, timestep_group=opt.max_generator_batches)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            # the larger shapes do not fit either
+            break
+        torch.cuda.synchronize()
+        if k > 0:
+            budget.add(B, Ts, Tt, torch.cuda.max_memory_allocated())
+    
+    model.zero_grad()
+    if hasattr(torch.cuda, 'empty_cache'):
+        torch.cuda.empty_cache()
+    
+    if len(budget.samples) < 3:
+        print('WARNING: too few calibration batches fit in memory, '
+              'splitting with -batch_size_split')
+        return None
+    budget.fit(optimizerStateMemory(optim))
+    print(' * memory budget: %s' % budget)
+    return budget
 
 
-def eval(model, criterions, data, setIDs):
+def eval(model, criterions, data, setIDs, average=None, budget=None):
         model.eval()
+        if average is not None:
+            average.swap()
+        try:
+            return evalLosses(model, criterions, data, setIDs, budget)
+        finally:
+            # the trained weights are restored even on errors
+            if average is not None:
+                average.swap()
+            model.train()
+
+
+def evalLosses(model, criterions, data, setIDs, budget=None):
         losses = []
         
         for sid in data: # sid = setid
@@ -233,30 +414,23 @@ def eval(model, criterions, data, setIDs):
                     # exclude original indices
                     batch = dset[i][:-1]
                     
-                    batch_size = batch[1].size(1)
-                    
-                    splitted_batches = splitMiniBatch(batch)
+                    splitted_batches = splitMiniBatch(batch, budget)
                     
                     for minibatch in splitted_batches:
                     
-                        outputs = model(minibatch)
-                        # exclude <s> from targets
-                        targets = minibatch[1][1:]
-                        loss, _ = memoryEfficientLoss(
-                                        outputs, targets, model.generator, criterion, batch_size, eval=True)
+                        loss, num_words = model(minibatch, mode='xe_loss', criterion=criterion,
+                                                timestep_group=opt.max_generator_batches)
                         total_loss += loss
-                        total_words += targets.data.ne(onmt.Constants.PAD).sum()
+                        total_words += num_words
             
             loss = total_loss / total_words
             losses.append(loss)
             
-        
-        
-        model.train()
         return losses
 
 
-def trainModel(model, trainSets, validSets, dataset, optim):
+def trainModel(model, trainSets, validSets, dataset, optim,
+               schedulerState=None, resumeIteration=-1, averageState=None):
     print(model)
     model.train()
 
@@ -264,19 +438,49 @@ def trainModel(model, trainSets, validSets, dataset, optim):
     criterions = NMTCriterion(dataset['dicts']['tgt'])
     setIDs = dataset['dicts']['setIDs']
 
+    # The (set, batch) schedule of every epoch
+    seed = opt.seed[0] if isinstance(opt.seed, list) else opt.seed
+    scheduler = onmt.BatchScheduler(seed, opt.sampling_temperature)
+    resume = {'iteration': 0}
+    if schedulerState is not None:
+        scheduler.load_state_dict(schedulerState)
+        resume['iteration'] = resumeIteration + 1
+
+    # checkpoints are written in the background
+    checkpoints = onmt.CheckpointWriter(opt.save_model, dataset['dicts'],
+                                        keepLast=opt.keep_last,
+                                        keepBest=opt.keep_best)
+
+    # online average of the weights, used for validation
+    average = None
+    if opt.ema_decay > 0 or opt.average_window > 0:
+        average = onmt.ModelAverage(model, model.generator,
+                                    decay=opt.ema_decay,
+                                    window=opt.average_window,
+                                    every=opt.average_every)
+        if averageState is not None:
+            average.loadFrom(averageState)
+
+    # micro-batches sized by the peak memory (-memory_budget)
+    budget = None
+    if opt.memory_budget > 0:
+        budget = calibrateMemory(model, criterions, dataset['dicts'], optim)
+
+    # phase timing (-profile), the model marks its own phases
+    profiler = onmt.Profiler(opt.profile if onmt.Distributed.isMaster(opt) else None,
+                             format=opt.profile_format, interval=opt.log_interval,
+                             cuda=(len(opt.gpus) >= 1))
+    (model.module if len(opt.gpus) > 1 else model).profiler = profiler
+
     start_time = time.time()
 
-    def trainEpoch(epoch, batchOrder=None):
+    def trainEpoch(epoch):
 
+        # Re-assign the mini-batches inside each length bucket
         if opt.extra_shuffle and epoch > opt.curriculum:
-            trainData.shuffle()
-
-        # Shuffle mini batch order.
-        
-        if not batchOrder:
-                    batchOrder = dict()
-                    for i in trainSets:
-                        batchOrder[i] = torch.randperm(len(trainSets[i]))
+            seed = opt.seed[0] if isinstance(opt.seed, list) else opt.seed
+            for i in trainSets:
+                trainSets[i].shuffle(seed, epoch)
 
         total_loss, total_words = dict(), dict()
         report_loss, report_tgt_words = dict(), []
@@ -290,42 +494,35 @@ def trainModel(model, trainSets, validSets, dataset, optim):
                     report_tgt_words.append(0)
                     report_src_words.append(0)
         
-        dataSizes = [len(trainSets[i]) for i in trainSets]
-        nSamples = sum(dataSizes)
-        
-        # In order to make sets sample randomly,
-        # We create a distribution over the data size
-        # In the future we can manipulate this distribution 
-        # to create biased sampling when training
-        sampleDist = torch.Tensor(len(setIDs))
-        iterators = dict()
-        for i in xrange(len(setIDs)):
-                    sampleDist[i] = len(trainSets[i])
-                    iterators[i] = -1
-        sampleDist = sampleDist / torch.sum(sampleDist)
-
-        for i in range(nSamples):
-                        
-            sampledSet = -1
-            while True:
-                # if the sampled set is full then we re-sample 
-                # to ensure that in one epoch we read each example once
-                sampledSet = int(torch.multinomial(sampleDist, 1)[0])
-                if iterators[sampledSet] + 1 < dataSizes[sampledSet]:
-                    break
-            
-            iterators[sampledSet] += 1 
+        schedule = scheduler.get(trainSets, epoch, curriculum=(epoch <= opt.curriculum))
+
+        # Every rank trains on its own part of the schedule
+        schedule = onmt.Distributed.scheduleSlice(schedule, opt)
+        nSamples = len(schedule)
+
+        # a resumed epoch continues after the saved iteration
+        startIteration = resume['iteration']
+        resume['iteration'] = 0
+
+        prefetcher = onmt.BatchPrefetcher(trainSets, schedule[startIteration:],
+                                          bufferSize=opt.prefetch,
+                                          numWorkers=opt.prefetch_workers,
+                                          mode=opt.prefetch_mode,
+                                          pinMemory=opt.pin_memory)
+        report_wait = 0.0
+        profiler.start()
+
+        for i, (sampledSet, batchIdx, batch) in enumerate(prefetcher, startIteration):
             
-            # Get the batch index from batch order
-            batchIdx = batchOrder[sampledSet][iterators[sampledSet]] if epoch > opt.curriculum else iterators[sampledSet]
+            profiler.mark('data')
             
             # Get the batch
-            batch = trainSets[sampledSet][batchIdx][:-1]
+            batch = batch[:-1]
             
             # Important: we have to use this batch size, not the splitted batch size
             batch_size = batch[1].size(1)
             
-            splittedBatches = splitMiniBatch(batch)
+            splittedBatches = splitMiniBatch(batch, budget)
             
             # And switch the model to the desired language mode
             model.switchLangID(setIDs[sampledSet][0], setIDs[sampledSet][1])
@@ -342,20 +539,23 @@ def trainModel(model, trainSets, validSets, dataset, optim):
             
             for mini_batch in splittedBatches:
                 
-                outputs = model(mini_batch)
-                targets = mini_batch[1][1:]
-                num_words += targets.data.ne(onmt.Constants.PAD).sum()
-                
-                loss_b, gradOutput = memoryEfficientLoss(
-                        outputs, targets, model.generator, criterion, batch_size)
+                # normalized by the size of the full batch
+                loss_b, num_words_b = model(mini_batch, mode='xe_loss', criterion=criterion,
+                                            normalizer=batch_size, backward=True,
+                                            timestep_group=opt.max_generator_batches)
                 loss += loss_b
-                
-                outputs.backward(gradOutput)
+                num_words += num_words_b
                 
                 del mini_batch
             
+            # Average the gradients of all ranks
+            onmt.Distributed.allReduceGradients(optim.params, opt, optim.sparseParams)
+            profiler.mark('all_reduce')
+
             # Update the parameters.
-            optim.step()
+            optim.step(profiler)
+            if average is not None:
+                average.step()
 
             # Statistics for the current set
             
@@ -364,17 +564,21 @@ def trainModel(model, trainSets, validSets, dataset, optim):
             report_src_words[sampledSet] += batch[0][1].data.sum()
             total_loss[sampledSet] += loss
             total_words[sampledSet] += num_words
+            profiler.count(batch[0][1].data.sum(), batch[0][0].data.numel(),
+                           num_words, (batch[1].size(0) - 1) * batch_size)
 
             # Logging information
             if i == 0 or (i % opt.log_interval == -1 % opt.log_interval):
                 avgTrainLoss = averagePPL(report_loss, report_tgt_words)
-                logOut = ("Epoch %2d, %5d/%5d; ; %3.0f src tok/s; %3.0f tgt tok/s; %6.0f s elapsed; ppl: %6.2f; lr: %.6f" %
+                logOut = ("Epoch %2d, %5d/%5d; ; %3.0f src tok/s; %3.0f tgt tok/s; %6.0f s elapsed; %5.1f s data wait; ppl: %6.2f; lr: %.6f" %
                                 (epoch, i+1, nSamples,
                                  sum(report_src_words)/(time.time()-start),
                                  sum(report_tgt_words)/(time.time()-start),
                                  time.time()-start_time,
+                                 prefetcher.waitTime - report_wait,
                                  avgTrainLoss,
                                  optim.get_learning_rate()))
+                report_wait = prefetcher.waitTime
                                  
                 for j in xrange(len(setIDs)):
                     #~ ppl = math.exp(report_loss[j] / (report_tgt_words[j] + 1e-6))
@@ -391,13 +595,13 @@ def trainModel(model, trainSets, validSets, dataset, optim):
                             
                 
             # Saving checkpoints with validation perplexity
-            if opt.save_every > 0 and i % opt.save_every == -1 % opt.save_every :
-                valid_losses = eval(model, criterions, validSets, setIDs)
+            if opt.save_every > 0 and i % opt.save_every == -1 % opt.save_every and onmt.Distributed.isMaster(opt):
+                valid_losses = eval(model, criterions, validSets, setIDs, average, budget)
                 valid_ppl = [math.exp(min(valid_loss, 100)) for valid_loss in valid_losses]
                 #~ valid_ppl = " ".join([str(math.exp(min(valid_loss, 100))) for valid_loss in valid_losses])
-                for i in xrange(len(setIDs)):
-                    setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][i])
-                    print('Validation perplexity for set %s : %g' % (setLangs, valid_ppl[i]))
+                for j in xrange(len(setIDs)):
+                    setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][j])
+                    print('Validation perplexity for set %s : %g' % (setLangs, valid_ppl[j]))
                 
                 
                 avgDevPpl = sum(valid_ppl) / len(valid_ppl)
@@ -419,23 +623,27 @@ def trainModel(model, trainSets, validSets, dataset, optim):
                         'opt': opt,
                         'epoch': ep,
                         'iteration' : i,
-                        'batchOrder' : batchOrder,
+                        'scheduler' : scheduler.state_dict(),
                         'optim': optim
                 }
+                if average is not None:
+                    average.saveTo(checkpoint)
                 
                 file_name = '%s_ppl_%.2f_e%.2f.pt'
                 #~ valid_ppl = "_".join([("%.2f" % math.exp(min(valid_loss, 100))) for valid_loss in valid_losses])
                 print('Writing to %s_ppl_%.2f_e%.2f.pt' % (opt.save_model, avgDevPpl, ep))
-                torch.save(checkpoint,
-                                     file_name
-                                     % (opt.save_model, avgDevPpl, ep))
-        return [total_loss[j] / total_words[j] for j in xrange(len(setIDs))]
+                checkpoints.save(checkpoint, file_name % (opt.save_model, avgDevPpl, ep), score=avgDevPpl)
+            
+            # logging, evaluation and saving are counted as 'other'
+            profiler.endStep()
+        return [total_loss[j] / max(total_words[j], 1) for j in xrange(len(setIDs))]
         
-    valid_losses = eval(model, criterions, validSets, setIDs)
-    valid_ppl = [math.exp(min(valid_loss, 100)) for valid_loss in valid_losses]
-    for i in xrange(len(setIDs)):
-            setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][i])
-            print('Validation perplexity for set %s : %g' % (setLangs, valid_ppl[i]))
+    if onmt.Distributed.isMaster(opt):
+        valid_losses = eval(model, criterions, validSets, setIDs, average, budget)
+        valid_ppl = [math.exp(min(valid_loss, 100)) for valid_loss in valid_losses]
+        for i in xrange(len(setIDs)):
+                setLangs = "-".join(lang for lang in dataset['dicts']['setLangs'][i])
+                print('Validation perplexity for set %s : %g' % (setLangs, valid_ppl[i]))
         
     #~ train_loss = trainEpoch(0)
         
@@ -448,8 +656,12 @@ def trainModel(model, trainSets, validSets, dataset, optim):
         for i in xrange(len(setIDs)):
                     print('Training perplexity for set %d : %g' % (i, train_ppl[i]))
 
+        # only the first rank evaluates and saves
+        if not onmt.Distributed.isMaster(opt):
+            continue
+
         #  (2) evaluate on the validation set
-        valid_losses = eval(model, criterions, validSets, setIDs)
+        valid_losses = eval(model, criterions, validSets, setIDs, average, budget)
         valid_ppl = [math.exp(min(valid_loss, 100)) for valid_loss in valid_losses]
         avgDevPpl = sum(valid_ppl) / len(valid_ppl)
         for i in xrange(len(setIDs)):
@@ -472,20 +684,31 @@ def trainModel(model, trainSets, validSets, dataset, optim):
             'opt': opt,
             'epoch': epoch,
             'iteration' : -1,
-            'batchOrder' : None,
+            'scheduler' : None,
             'optim': optim
         }
+        if average is not None:
+            average.saveTo(checkpoint)
         
                 
         #~ valid_ppl = "_".join([("%.2f" % math.exp(min(valid_loss, 100))) for valid_loss in valid_losses])
         file_name = '%s_ppl_%.2f_e%d.pt'
         print('Writing to %s_ppl_%.2f_e%d.pt' % (opt.save_model, avgDevPpl, epoch))
-        torch.save(checkpoint,
-                                     file_name
-                                     % (opt.save_model, avgDevPpl, epoch))
+        checkpoints.save(checkpoint, file_name % (opt.save_model, avgDevPpl, epoch), score=avgDevPpl)
+
+    # wait for the last checkpoint
+    checkpoints.close()
 
 
 def main():
+    if opt.world_size > 1 and opt.rank < 0:
+        # start all the ranks on this machine
+        onmt.Distributed.launch(main, opt)
+        return
+
+    if opt.world_size > 1:
+        onmt.Distributed.initialize(opt)
+
     print("Loading data from '%s'" % opt.data)
 
     dataset = torch.load(opt.data)
@@ -495,7 +718,7 @@ def main():
                        else opt.train_from_state_dict)
     if dict_checkpoint:
         print('Loading dicts from checkpoint at %s' % dict_checkpoint)
-        checkpoint = torch.load(dict_checkpoint)
+        checkpoint = onmt.Checkpoints.loadCheckpoint(dict_checkpoint)
         dataset['dicts'] = checkpoint['dicts']
     
     dicts = dataset['dicts']
@@ -504,17 +727,39 @@ def main():
     for lang in dicts['langs']:
             print(' * ' + lang + ' = %d' % dicts['vocabs'][lang].size())
 
-    trainSets = dict()
+    sharded = 'shards' in dataset['train']
+    if sharded:
+      # the shard files are next to the main data file
+      trainSets = onmt.ShardedDataset(dataset['train'],
+                                      os.path.dirname(os.path.abspath(opt.data)),
+                                      opt.batch_size, opt.gpus,
+                                      maxResident=opt.max_resident_shards)
+      print(' * training data split into %d shards' % trainSets.numShards)
+    else:
+      trainSets = dict()
     validSets = dict()
     for i in xrange(nSets):
-      trainSets[i] = onmt.Dataset(dataset['train']['src'][i],
-                             dataset['train']['tgt'][i], opt.batch_size, opt.gpus)
+      if sharded:
+        nTrain = sum(sizes[i] for sizes in dataset['train']['sizes'])
+      else:
+        trainSets[i] = onmt.Dataset(dataset['train']['src'][i],
+                               dataset['train']['tgt'][i], opt.batch_size, opt.gpus,
+                               data_type=dataset['type'])
+        nTrain = trainSets[i].fullSize
             
       validSets[i] = onmt.Dataset(dataset['valid']['src'][i],
-                             dataset['valid']['tgt'][i], opt.batch_size, opt.gpus)
+                             dataset['valid']['tgt'][i], opt.batch_size, opt.gpus,
+                             data_type=dataset['type'])
       
       print(' * number of training sentences for set %d: %d' %
-          (i, len(dataset['train']['src'][i])))
+          (i, nTrain))
+
+    # the Datasets keep the text flattened, the sentences are released
+    if dataset['type'] == "text":
+      for split in ['train', 'valid']:
+        if 'src' in dataset[split]:
+          dataset[split]['src'] = [None] * nSets
+          dataset[split]['tgt'] = [None] * nSets
         
 
     print(' * maximum batch size. %d' % opt.batch_size)
@@ -522,7 +767,10 @@ def main():
     print('Building model...')
     
     
-    encoder = onmt.Models.Encoder(opt, dicts['src'])
+    if opt.encoder_type == "img":
+        encoder = onmt.modules.ImageEncoder(opt)
+    else:
+        encoder = onmt.Models.Encoder(opt, dicts['src'])
     decoder = onmt.Models.Decoder(opt, dicts['tgt'], nSets)
     generator = onmt.Models.Generator(opt, dicts['tgt'])
 
@@ -546,6 +794,22 @@ def main():
         opt.start_epoch = int(math.floor(checkpoint['epoch'] + 1))
         del checkpoint['model'] # to save memory 
 
+    # a checkpoint saved inside an epoch resumes that epoch exactly
+    schedulerState, resumeIteration = None, -1
+    if dict_checkpoint and checkpoint.get('scheduler') is not None \
+            and checkpoint['iteration'] >= 0:
+        schedulerState = checkpoint['scheduler']
+        resumeIteration = checkpoint['iteration']
+        opt.start_epoch = schedulerState['epoch']
+        print('Resuming epoch %d after iteration %d' % (opt.start_epoch, resumeIteration))
+
+    # the weight average continues from the checkpoint
+    averageState = None
+    if dict_checkpoint and 'model_ema' in checkpoint:
+        averageState = {'model_ema': checkpoint['model_ema'],
+                        'generator_ema': checkpoint['generator_ema'],
+                        'ema_updates': checkpoint['ema_updates']}
+
     if len(opt.gpus) >= 1:
         model.cuda()
         generator.cuda()
@@ -577,7 +841,11 @@ def main():
         optim = checkpoint['optim']
         print(optim)
 
-    optim.set_parameters(model.parameters())
+    if opt.world_size > 1:
+        onmt.Distributed.broadcastParameters(model)
+
+    optim.set_parameters(model.parameters(),
+                         onmt.gradient_utils.sparseParameters(model))
     optim.set_learning_rate(opt.learning_rate)
 
     #~ if opt.train_from or opt.train_from_state_dict:
@@ -589,7 +857,8 @@ def main():
     
    
 
-    trainModel(model, trainSets, validSets, dataset, optim)
+    trainModel(model, trainSets, validSets, dataset, optim,
+               schedulerState, resumeIteration, averageState)
 
 
 if __name__ == "__main__":
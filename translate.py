@@ -2,6 +2,7 @@ from __future__ import division
 
 import onmt
 import onmt.Markdown
+import onmt.StreamReader
 import torch
 import argparse
 import math
@@ -57,6 +58,17 @@ parser.add_argument('-normalize', action='store_true',
                     help='To normalize the scores based on output length')
 parser.add_argument('-gpu', type=int, default=-1,
                     help="Device to run on")
+parser.add_argument('-use_ema', action='store_true',
+                    help="""Translate with the weight average saved in the
+                    checkpoint (trained with -ema_decay or -average_window).""")
+parser.add_argument('-bpe_codes', default="",
+                    help="""Segment the raw source (and target) text with the
+                    BPE merges in this file and join the subwords of the
+                    output again.""")
+parser.add_argument('-read_ahead', type=int, default=1,
+                    help="""Read this many batches of the input at a time and
+                    sort them by source length to reduce padding. The output
+                    keeps the input order.""")
 
 
 def reportScore(name, scoreTotal, wordsTotal):
@@ -65,12 +77,6 @@ def reportScore(name, scoreTotal, wordsTotal):
         name, math.exp(-scoreTotal/wordsTotal)))
 
 
-def addone(f):
-    for line in f:
-        yield line
-    yield None
-
-
 def main():
     opt = parser.parse_args()
     opt.cuda = opt.gpu > -1
@@ -82,34 +88,68 @@ def main():
         
     translator = onmt.Translator(opt)
 
-    outF = open(opt.output, 'w')
+    bpe = onmt.BPE(opt.bpe_codes) if opt.bpe_codes else None
 
-    predScoreTotal, predWordsTotal, goldScoreTotal, goldWordsTotal = 0, 0, 0, 0
+    def tokenize(line):
+        words = line.split()
+        return bpe.segmentTokens(words) if bpe is not None else words
 
-    srcBatch, tgtBatch = [], []
+    def detokenize(words):
+        sent = " ".join(words)
+        return bpe.desegment(sent) if bpe is not None else sent
 
-    count = 0
+    outF = open(opt.output, 'w')
+
+    predScoreTotal, predWordsTotal, goldScoreTotal, goldWordsTotal = 0, 0, 0, 0
 
-    tgtF = open(opt.tgt) if opt.tgt else None
+    hasTgt = bool(opt.tgt)
 
     if opt.dump_beam != "":
         import json
         translator.initBeamAccum()
 
-    for line in addone(open(opt.src)):
-        if line is not None:
-            srcTokens = line.split()
-            srcBatch += [srcTokens]
-            if tgtF:
-                tgtTokens = tgtF.readline().split() if tgtF else None
-                tgtBatch += [tgtTokens]
+    def write(index, result):
+        srcTokens, tgtTokens, pred, score, goldScore = result
+        count = index + 1
+        # Best sentence = having highest log prob
 
-            if len(srcBatch) < opt.batch_size:
-                continue
+        if not opt.print_nbest:
+            outF.write(detokenize(pred[0]) + '\n')
+            outF.flush()
         else:
-            # at the end of file, check last batch
-            if len(srcBatch) == 0:
-                break
+            for n in range(opt.n_best):
+                idx = n
+                #~ if opt.verbose:
+                print("%d ||| %s ||| %.6f" % (count-1, detokenize(pred[idx]), score[idx]))
+                outF.write("%d ||| %s ||| %.6f\n" % (count-1, detokenize(pred[idx]), score[idx]))
+                outF.flush()
+
+        if opt.verbose:
+            srcSent = ' '.join(srcTokens)
+            if translator.tgt_dict.lower:
+                srcSent = srcSent.lower()
+            print('SENT %d: %s' % (count, srcSent))
+            print('PRED %d: %s' % (count, detokenize(pred[0])))
+            print("PRED SCORE: %.4f" % score[0])
+
+            if hasTgt:
+                tgtSent = ' '.join(tgtTokens)
+                if translator.tgt_dict.lower:
+                    tgtSent = tgtSent.lower()
+                print('GOLD %d: %s ' % (count, tgtSent))
+                print("GOLD SCORE: %.4f" % goldScore)
+            print('')
+
+    # the input is read -read_ahead batches at a time, the results of the
+    # length sorted batches are written back in the input order
+    reorder = onmt.ReorderBuffer(write, opt.batch_size * opt.read_ahead)
+    records = onmt.StreamReader.readRecords(opt.src, opt.tgt, tokenize)
+
+    for batch in onmt.StreamReader.readBatches(records, opt.batch_size,
+                                               opt.read_ahead):
+        indices = [record[0] for record in batch]
+        srcBatch = [record[1] for record in batch]
+        tgtBatch = [record[2] for record in batch] if hasTgt else []
 
         predBatch, predScore, goldScore = translator.translate(srcBatch,
                                                                tgtBatch)
@@ -127,60 +167,24 @@ def main():
                                                               
         predScoreTotal += sum(score[0] for score in predScore)
         predWordsTotal += sum(len(x[0]) for x in predBatch)
-        if tgtF is not None:
+        if hasTgt:
             goldScoreTotal += sum(goldScore)
             goldWordsTotal += sum(len(x) for x in tgtBatch)
-            
 
         for b in range(len(predBatch)):
             # Pred Batch always have n-best outputs  
-            #~ scores = torch.Tensor(len(predBatch[b]))
-            #~ for n in range(opt.n_best):
-                            #~ scores[n] = predScore[b][n]
-                            #~ if opt.normalize:
-                                #~ scores[n] = scores[n] / ( len(predBatch[b][n]) + 1)
-                        #~ 
-            #~ sorted_scores, sorted_index = torch.sort(scores, 0, True)
-            #~ bestSent = predBatch[b][sorted_index[0]]
-            #~ bestIndex = sorted_index[0]
-            count += 1
-            # Best sentence = having highest log prob
-
-            if not opt.print_nbest:
-                outF.write(" ".join(predBatch[b][0]) + '\n')
-                outF.flush()
-            else:
-                for n in range(opt.n_best):
-                    idx = n
-                    #~ if opt.verbose:
-                    print("%d ||| %s ||| %.6f" % (count-1, " ".join(predBatch[b][idx]), predScore[b][idx]))
-                    outF.write("%d ||| %s ||| %.6f\n" % (count-1, " ".join(predBatch[b][idx]), predScore[b][idx]))
-                    outF.flush()
-
-            if opt.verbose:
-                srcSent = ' '.join(srcBatch[b])
-                if translator.tgt_dict.lower:
-                    srcSent = srcSent.lower()
-                print('SENT %d: %s' % (count, srcSent))
-                print('PRED %d: %s' % (count, " ".join(predBatch[b][0])))
-                print("PRED SCORE: %.4f" % predScore[b][0])
-
-                if tgtF is not None:
-                    tgtSent = ' '.join(tgtBatch[b])
-                    if translator.tgt_dict.lower:
-                        tgtSent = tgtSent.lower()
-                    print('GOLD %d: %s ' % (count, tgtSent))
-                    print("GOLD SCORE: %.4f" % goldScore[b])
-                print('')
+            reorder.put(indices[b],
+                        (srcBatch[b], tgtBatch[b] if hasTgt else None,
+                         predBatch[b], predScore[b],
+                         goldScore[b] if hasTgt else None))
 
-        srcBatch, tgtBatch = [], []
+    reorder.close()
 
     reportScore('PRED', predScoreTotal, predWordsTotal)
-    if tgtF:
+    if hasTgt:
         reportScore('GOLD', goldScoreTotal, goldWordsTotal)
 
-    if tgtF:
-        tgtF.close()
+    outF.close()
 
     if opt.dump_beam:
         json.dump(translator.beam_accum, open(opt.dump_beam, 'w'))